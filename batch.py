@@ -0,0 +1,176 @@
+#!/bin/python3.6
+"""
+Headless batch processing of whole directories of EEG captures
+
+For every capture found under the input directory the spectrogram is computed
+and saved as a binary container, its per-epoch band power features are saved
+as CSV (see psg_suite.band_features), and a JSON summary (recording length,
+spectrogram shape and, if a .stages file exists, per-stage durations) is
+written next to it in the output directory. Outputs newer than their inputs
+are skipped, so an interrupted run can simply be restarted.
+"""
+import argparse
+import concurrent.futures
+import csv
+import json
+import os
+import sys
+import traceback
+from timeit import default_timer as timer
+
+from psg_suite.eeg_data import load_capture
+from psg_suite.eeg_spectrum import EEGSpectralData
+from psg_suite.sleep_stage_label import SleepStageLabel, SLEEP_STAGE_LABELS
+from psg_suite.spectral_estimators import ESTIMATORS
+from psg_suite import band_features
+
+CAPTURE_EXTENSIONS = ('.csv', '.ovibe', '.dat', '.psgb')
+#Files written by this tool, never treated as captures
+OUTPUT_SUFFIXES = ('.spectrum.psgb', '.features.csv', '.summary.json', '.summary.json.tmp')
+SUMMARY_TABLE = 'summary.csv'
+
+def find_captures(indir, outdir=None):
+    """
+    Returns sorted list of capture files under a directory tree. Outputs of this tool are
+    skipped: the tree of outdir (unless it is indir itself), files with OUTPUT_SUFFIXES
+    and the summary table of outdir.
+    """
+    skip_dir = None
+    if outdir is not None and os.path.realpath(outdir) != os.path.realpath(indir):
+        skip_dir = os.path.realpath(outdir)
+    found = []
+    for root, dirs, files in os.walk(indir):
+        dirs[:] = [d for d in dirs if os.path.realpath(os.path.join(root, d)) != skip_dir]
+        for name in files:
+            lname = name.lower()
+            if not lname.endswith(CAPTURE_EXTENSIONS) or lname.endswith(OUTPUT_SUFFIXES):
+                continue
+            if (outdir is not None and name == SUMMARY_TABLE and
+                    os.path.realpath(root) == os.path.realpath(outdir)):
+                continue
+            found.append(os.path.join(root, name))
+    return sorted(found)
+
+def output_paths(fname, indir, outdir):
+    """
+    Returns (spectrogram, features, summary) output paths of a capture, mirroring its place in indir
+    """
+    base = os.path.join(outdir, os.path.relpath(fname, indir))
+    return base + '.spectrum.psgb', base + '.features.csv', base + '.summary.json'
+
+def is_up_to_date(fname, outputs):
+    """
+    True if all outputs exist and are newer than the capture and its .stages file
+    """
+    inputs = [fname] + ([fname + '.stages'] if os.path.isfile(fname + '.stages') else [])
+    newest = max(os.path.getmtime(p) for p in inputs)
+    return all(os.path.isfile(p) and os.path.getmtime(p) >= newest for p in outputs)
+
+def process_capture(fname, indir, outdir, cutoff, estimator=None):
+    """
+    Computes and saves spectrogram and summary of one capture, runs in a worker process
+
+    Returns:
+        summary: Dictionary saved to the summary JSON file
+    """
+    start = timer()
+    spectrum_path, features_path, summary_path = output_paths(fname, indir, outdir)
+    os.makedirs(os.path.dirname(spectrum_path), exist_ok=True)
+    data = load_capture(fname)
+    spectrum = EEGSpectralData(data, estimator=estimator)
+    #Features use the bands above the cutoff too
+    band_features.save_csv(spectrum.band_features(), features_path)
+    spectrum.frequency_cutoff(cutoff)
+    spectrum.save_bin(spectrum_path)
+    summary = {'file': os.path.relpath(fname, indir),
+               'bytes': os.path.getsize(fname),
+               'sleep_duration': data.sleep_duration(),
+               'estimator': spectrum.estimator,
+               'spectrum_shape': list(spectrum.data.shape)}
+    if os.path.isfile(fname + '.stages'):
+        labels = SleepStageLabel(None, None, None, None)
+        labels.load_txt(fname + '.stages')
+        summary['stage_durations'] = labels.stage_durations()
+    summary['seconds'] = timer() - start
+    #Summary is written last and atomically, it marks the capture as done
+    with open(summary_path + '.tmp', 'w') as f:
+        json.dump(summary, f)
+    os.replace(summary_path + '.tmp', summary_path)
+    return summary
+
+def _run_one(fname, indir, outdir, cutoff, estimator):
+    try:
+        return 'done', process_capture(fname, indir, outdir, cutoff, estimator)
+    except Exception:
+        return 'failed', traceback.format_exc()
+
+def write_table(summaries, fname):
+    """
+    Writes summaries of all captures into one CSV table
+    """
+    with open(fname, 'w') as f:
+        wr = csv.writer(f, delimiter=',', lineterminator='\n')
+        wr.writerow(['file', 'sleep_duration'] + SLEEP_STAGE_LABELS)
+        for s in summaries:
+            durations = s.get('stage_durations', {})
+            wr.writerow([s['file'], s['sleep_duration']] + [durations.get(l, '') for l in SLEEP_STAGE_LABELS])
+
+def run(indir, outdir, workers=None, cutoff=25, force=False, estimator=None):
+    """
+    Processes all captures under indir on a process pool
+
+    Returns:
+        failed: List of (file, traceback) of captures that could not be processed
+    """
+    start = timer()
+    os.makedirs(outdir, exist_ok=True)
+    captures = find_captures(indir, outdir)
+    todo = [f for f in captures if force or not is_up_to_date(f, output_paths(f, indir, outdir))]
+    print("Found " + str(len(captures)) + " captures, " + str(len(captures)-len(todo)) + " up to date")
+    failed = []
+    processed_bytes = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = dict((pool.submit(_run_one, f, indir, outdir, cutoff, estimator), f) for f in todo)
+        for fut in concurrent.futures.as_completed(futures):
+            fname = futures[fut]
+            try:
+                status, result = fut.result()
+            except Exception:
+                #Worker process died (e.g. out of memory), the pool cannot be trusted anymore
+                status, result = 'failed', traceback.format_exc()
+            if status == 'done':
+                processed_bytes += result['bytes']
+                print("done   " + fname + " (" + "{:.1f}".format(result['seconds']) + " s)")
+            else:
+                failed.append((fname, result))
+                print("FAILED " + fname + "\n" + result)
+    summaries = []
+    for f in captures:
+        summary_path = output_paths(f, indir, outdir)[2]
+        if os.path.isfile(summary_path):
+            with open(summary_path) as sf:
+                summaries.append(json.load(sf))
+    write_table(summaries, os.path.join(outdir, SUMMARY_TABLE))
+    elapsed = timer() - start
+    print("---------------------------------------------------------")
+    print("processed: " + str(len(todo)-len(failed)) + ", skipped: " + str(len(captures)-len(todo)) +
+          ", failed: " + str(len(failed)))
+    print("elapsed: " + "{:.1f}".format(elapsed) + " s, throughput: " +
+          "{:.2f}".format((len(todo)-len(failed))/elapsed) + " files/s, " +
+          "{:.2f}".format(processed_bytes/elapsed/2**20) + " MB/s")
+    return failed
+
+def mf():
+    parser = argparse.ArgumentParser(description="Precomputes spectrograms and stage summaries for a directory of captures")
+    parser.add_argument("indir", help="Directory searched recursively for captures")
+    parser.add_argument("outdir", help="Directory receiving spectrograms and summaries")
+    parser.add_argument("--workers", type=int, default=None, help="N. of worker processes (default: n. of CPUs)")
+    parser.add_argument("--cutoff", type=float, default=25, help="Frequency cutoff of saved spectrograms")
+    parser.add_argument("--estimator", default="periodogram", choices=sorted(ESTIMATORS), help="Spectral estimator of the spectrograms")
+    parser.add_argument("--force", action="store_true", help="Reprocess captures with up-to-date outputs")
+    args = parser.parse_args()
+    failed = run(args.indir, args.outdir, args.workers, args.cutoff, args.force, args.estimator)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    mf()
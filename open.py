@@ -2,37 +2,97 @@
 import numpy as np
 import csv
 import math
-import tkinter
-import tkinter.filedialog
 import sys
 import os
+import argparse
 
-from psg_suite.eeg_data import EEGData
+from psg_suite.eeg_data import load_capture
 from psg_suite.eeg_spectrum import EEGSpectralData
 from psg_suite.sleep_stage_label import SleepStageLabel
+from psg_suite.spectrum_cache import SpectrumCache
+from psg_suite import instrumentation
+from psg_suite.spectral_estimators import ESTIMATORS
+from psg_suite import auto_stage
+from psg_suite import artifacts
+from psg_suite import eeg_container
+from psg_suite import text_ingest
+from psg_suite.progressive import ProgressiveSpectrogram
 
-def mf():
-    if len(sys.argv) > 1:
-        fname = sys.argv[1]
-    else:
-        root_window = tkinter.Tk()
-        root_window.withdraw()
-        fname = tkinter.filedialog.askopenfilename(filetypes=[('All Supported Files (*.CSV, *.OVIBE, *.DAT)',('.csv','.ovibe','.dat')),('OpenVIBE CSV (*.CSV, *.OPENVIBE)',('.csv','.openvibe')),('Raw (*.DAT)','.dat'),('All Files (*.*)','.*')])
-        root_window.destroy()
-    if fname == "":
-        print("No file was selected - aborting")
-        return
-    print("---------------------------------------------------------")
-    data = EEGData()
+CUTOFF = 25
+#Sampling rate of raw captures (see EEGData.load_raw) and step of the spectrogram windows
+RAW_SAMPLING_RATE = 256
+STEP = 1792
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Displays EEG spectrogram and allows manual sleep stage labeling")
+    parser.add_argument("fname", nargs="?", default=None, help="EEG capture file, file dialog is shown if omitted")
+    parser.add_argument("--no-cache", action="store_true", help="Always recompute the spectrogram")
+    parser.add_argument("--cache-dir", default=None, help="Spectrogram cache directory (default: $PSG_CACHE_DIR or ~/.cache/psg_suite)")
+    parser.add_argument("--cache-size", type=int, default=4096, help="Spectrogram cache size cap in MB")
+    parser.add_argument("--no-blit", action="store_true", help="Redraw the whole labeling window on every click")
+    parser.add_argument("--frame-report", action="store_true", help="Print redraw times after clicks and of the cursor separately when the labeling window is closed")
+    parser.add_argument("--estimator", default="periodogram", choices=sorted(ESTIMATORS), help="Spectral estimator of the spectrogram")
+    parser.add_argument("--full-rate", action="store_true", help="Compute the spectrogram up to the Nyquist frequency and cut it off afterwards instead of decimating the signal first")
+    parser.add_argument("--workers", type=int, default=1, help="N. of processes parsing text captures and threads computing the spectrogram (0 = n. of CPUs)")
+    parser.add_argument("--no-artifacts", action="store_true", help="Compute all spectrogram windows instead of skipping detected artifact and electrode-off periods")
+    parser.add_argument("--start", type=float, default=None, help="Start of the sleep block to open in minutes from the start of the capture")
+    parser.add_argument("--end", type=float, default=None, help="End of the sleep block to open in minutes from the start of the capture")
+    parser.add_argument("--block", default="", help="Sleep block identifier (c1, c2, ... for cores, n1, n2, ... for naps), stages are saved to <capture>.<block>.stages")
+    parser.add_argument("--progressive", action="store_true", help="Open the labeling window right away and fill in the spectrogram while it is computed")
+    parser.add_argument("--auto-label", action="store_true", help="Pre-label stages automatically when no .stages file exists (unvalidated, check every label)")
+    parser.add_argument("--profile", nargs="?", const="-", default=None, metavar="FILE",
+                        help="Write JSON report of time, bytes, counters and the rise of the process peak memory per pipeline stage to FILE (default: standard output)")
+    return parser.parse_args()
+
+def probe_capture(fname):
+    """
+    Reads sampling rate and n. of samples of a capture without loading it
+
+    Returns:
+        (sampling_rate, n_samples): None if the format is unknown
+    """
     if fname.lower().endswith(".csv") or fname.lower().endswith(".ovibe"):
-        print("Loading OpenVIBE capture data from: " + fname + " ...")
-        data.load_openvibe(fname)
+        with open(fname) as f:
+            f.readline()
+            sampling_rate = int(f.readline().rstrip().split(';')[-1])
+        return sampling_rate, text_ingest.count_lines(fname) - 1
     elif fname.lower().endswith(".dat"):
-        print("Loading raw capture data from: " + fname + " ...")
-        data.load_raw(fname)
-    else:
+        return RAW_SAMPLING_RATE, text_ingest.count_lines(fname)
+    elif fname.lower().endswith(".psgb"):
+        meta = eeg_container.read_header(fname)
+        return meta["attrs"]["sampling_rate"], meta["arrays"]["data"]["shape"][0]
+    return None
+
+@instrumentation.timed("load_spectrum")
+def load_spectrum(fname, estimator=None, workers=1, decimate=True, detect=True, progress=None, segment=None):
+    """
+    Loads capture data and computes its spectrogram
+
+    Args:
+        fname: Path to the capture file
+        estimator: Name of the spectral estimator (see spectral_estimators), None = periodogram
+        workers: N. of processes parsing text captures and threads computing the spectrogram,
+                 None = n. of CPUs
+        decimate: True to compute only frequencies up to CUTOFF from a decimated signal,
+                  False to compute the full rate spectrogram and cut it off afterwards
+        detect: True to detect artifacts (see artifacts.detect_artifacts) and skip their windows
+        progress: Progress callback of EEGSpectralData, None = not reported
+        segment: (start, stop) time range in seconds (stop None = end of the capture),
+                 only the spectrogram of this range is computed, None = whole capture
+
+    Returns:
+        (spectrum, sleep_duration, mask): EEGSpectralData cut off at CUTOFF, length of the recording
+                                          (or segment) in seconds and array of artifact intervals (None if not detected),
+                                          (None, None, None) if the format is unknown
+    """
+    print("Loading capture data from: " + fname + " ...")
+    data = load_capture(fname, dtype=np.int16, workers=workers)
+    if data is None:
         print("Unknown capture format!")
-        return
+        return None, None, None
+    if segment is not None:
+        data = data.segment(*segment)
+        print("segment: " + str(data.start_time()) + " s to " + str(data.start_time() + data.sleep_duration()) + " s")
     print(data.data)
     length = len(data.data)
     print("---------------------------------------------------------")
@@ -40,25 +100,120 @@ def mf():
     print("data size: " + str(length) + " (" + str(minutes) + " minutes)")
     print("data shape: " + str(np.shape(data)))
     #eeg_data_visual.plot_eeg_data(data)
-    spectrum = EEGSpectralData(data)
+    mask = None
+    if detect:
+        mask = artifacts.detect_artifacts(data)
+        print("artifacts: " + str(len(mask)) + " periods (" +
+              str(int(np.sum(mask[:,1] - mask[:,0]))) + " seconds) will be masked")
+    spectrum = EEGSpectralData(data, step=STEP, estimator=estimator, workers=workers,
+                               cutoff=CUTOFF if decimate else None, mask=mask, progress=progress)
     print("hist shape: " + str(np.shape(spectrum.data)))
     print("freqs shape: " + str(np.shape(spectrum.frequencystamps)))
-    print("max: " + str(np.max(np.log(spectrum.data))))
-    print("min: " + str(np.min(np.log(spectrum.data))))
-    print("ptp: " + str(np.ptp(np.log(spectrum.data))))
+    print("max: " + str(np.nanmax(np.log(spectrum.data))))
+    print("min: " + str(np.nanmin(np.log(spectrum.data))))
+    print("ptp: " + str(np.nanmax(np.log(spectrum.data)) - np.nanmin(np.log(spectrum.data))))
+    spectrum.frequency_cutoff(CUTOFF)
+    return spectrum, data.sleep_duration(), mask
+
+def mf():
+    args = parse_args()
+    if args.profile is None:
+        label_file(args)
+        return
+    instrumentation.enable()
+    try:
+        label_file(args)
+    finally:
+        instrumentation.write_report(args.profile)
+
+def label_file(args):
+    if args.fname is not None:
+        fname = args.fname
+    else:
+        import tkinter
+        import tkinter.filedialog
+        root_window = tkinter.Tk()
+        root_window.withdraw()
+        fname = tkinter.filedialog.askopenfilename(filetypes=[('All Supported Files (*.CSV, *.OVIBE, *.DAT, *.PSGB)',('.csv','.ovibe','.dat','.psgb')),('OpenVIBE CSV (*.CSV, *.OPENVIBE)',('.csv','.openvibe')),('Raw (*.DAT)','.dat'),('PSG binary (*.PSGB)','.psgb'),('All Files (*.*)','.*')])
+        root_window.destroy()
+    if fname == "":
+        print("No file was selected - aborting")
+        return
+    print("---------------------------------------------------------")
+    spectrum = None
+    segment = None
+    if args.start is not None or args.end is not None:
+        segment = ((args.start or 0)*60.0, None if args.end is None else args.end*60.0)
+    if not args.no_cache:
+        cache = SpectrumCache(args.cache_dir, args.cache_size << 20)
+        key = cache.key(fname, cutoff=CUTOFF, estimator=ESTIMATORS[args.estimator]().describe(),
+                        decimated=not args.full_rate, masked=not args.no_artifacts, segment=segment)
+        spectrum, attrs = cache.get(key)
+    probe = probe_capture(fname) if spectrum is None and args.progressive else None
+    computed = {}
+    if spectrum is not None:
+        print("Spectrogram loaded from cache: " + cache.path(key))
+        sleep_duration = attrs["sleep_duration"]
+        mask = None if attrs.get("mask") is None else np.array(attrs["mask"]).reshape(-1, 2)
+    elif probe is not None:
+        #The labeling window opens right away, the spectrogram is computed in the background
+        sleep_duration = probe[1]/float(probe[0])
+        if segment is not None:
+            end = sleep_duration if segment[1] is None else min(segment[1], sleep_duration)
+            sleep_duration = max(0.0, end - min(segment[0], sleep_duration))
+        mask = None
+        def compute(progress):
+            result, duration, computed["mask"] = load_spectrum(fname, args.estimator, args.workers or None,
+                                                               not args.full_rate, not args.no_artifacts,
+                                                               progress, segment)
+            if not args.no_cache:
+                cache.put(key, result, sleep_duration=duration,
+                          mask=None if computed["mask"] is None else computed["mask"].tolist())
+                print("cache: " + str(cache.stats()))
+            return result
+        spectrum = ProgressiveSpectrogram(compute, STEP, probe[0], CUTOFF).start()
+    else:
+        spectrum, sleep_duration, mask = load_spectrum(fname, args.estimator, args.workers or None,
+                                                       not args.full_rate, not args.no_artifacts,
+                                                       segment=segment)
+        if spectrum is None:
+            return
+        if not args.no_cache:
+            cache.put(key, spectrum, sleep_duration=sleep_duration,
+                      mask=None if mask is None else mask.tolist())
+    if not args.no_cache and probe is None:
+        print("cache: " + str(cache.stats()))
     print("---------------------------------------------------------")
     print("Displaying spectrograms ...")
+    minutes = int(math.ceil(sleep_duration/60))
     figwidth = 7 if minutes < 40 else 16 # adjust figure size based on number of minutes in data set so that naps get a smaller display thats easier to read
     title = os.path.basename(fname).rsplit('.', 1)[0]
-    spectrum.frequency_cutoff(25)
-    sleep_labels = SleepStageLabel(title,"","",data.sleep_duration())
-    stages_file = fname + '.stages'
+    sleep_labels = SleepStageLabel(title,"",args.block,sleep_duration)
+    stages_file = fname + ('.' + args.block if args.block else '') + '.stages'
     if os.path.isfile(stages_file):
         print("Loading existing stage data ...")
         sleep_labels.load_txt(stages_file)
     else:
         print("No existing stage data found.")
-    sleep_labels.label_manual(((spectrum,{"elid":0,'colormap':'parula',"xlabels":False}),(spectrum,{"elid":1,'colormap':'parula',"xlabels":False})),title=title,figsize=(figwidth, 9))
+        if args.auto_label and probe is not None:
+            def apply_auto_labels(result):
+                if result is None:
+                    return
+                print("Pre-labelling stages automatically ...")
+                auto = auto_stage.auto_label(result, title, "", args.block, sleep_duration, mask=computed["mask"])
+                sleep_labels.loaded_stage_times = auto.loaded_stage_times
+                sleep_labels.loaded_stage_labels = auto.loaded_stage_labels
+                #Labels painted while the spectrogram was computed are kept
+                timeline = sleep_labels.timeline
+                if timeline is None or (len(timeline) == 1 and timeline.labels[0] == artifacts.MASK_OFF):
+                    sleep_labels.timeline = auto.timeline
+                    if sleep_labels.redraw_labels is not None:
+                        sleep_labels.redraw_labels(record=False)
+            spectrum.on_complete(apply_auto_labels)
+        elif args.auto_label:
+            print("Pre-labelling stages automatically ...")
+            sleep_labels = auto_stage.auto_label(spectrum, title, "", args.block, sleep_duration, mask=mask)
+    sleep_labels.label_manual(((spectrum,{"elid":0,'colormap':'parula',"xlabels":False}),(spectrum,{"elid":1,'colormap':'parula',"xlabels":False})),title=title,figsize=(figwidth, 9),blit=not args.no_blit,frame_report=args.frame_report)
     if sleep_labels.saving:
         print("Saving stage data ...")
         sleep_labels.save_txt(stages_file)
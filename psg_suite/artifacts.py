@@ -0,0 +1,207 @@
+'''
+Contains streaming detection of artifacts and electrode-off periods in EEG data
+
+The recording is read in chunks of whole blocks of step samples. Every block is
+reduced to its sums of samples, squared samples, clipped samples and samples
+demodulated at the mains frequency, so rolling statistics of windows of several
+blocks (variance, clipping ratio and the fraction of the variance at the mains
+frequency) are differences of cumulative sums of the block sums. Memory is
+bounded by the chunk size and time is linear in the recording length.
+'''
+import numpy as np
+from . import instrumentation
+from .stage_timeline import SLEEP_STAGE_LABELS
+
+MASK_OFF = SLEEP_STAGE_LABELS.index('MASK OFF')
+#Flags of artifact windows
+FLAT = 1
+HIGH_VARIANCE = 2
+CLIPPING = 4
+LINE_NOISE = 8
+#Windows with standard deviation below this many quantization steps are flat (electrode off)
+FLAT_STD = 1.0
+#Windows with variance this many times the median variance of the electrode are movement artifacts
+HIGH_VARIANCE_RATIO = 25.0
+#Windows with more than this fraction of samples at the ends of the range are clipped
+CLIP_FRACTION = 0.05
+#Windows with more than this fraction of the variance at the mains frequency are line noise
+LINE_NOISE_FRACTION = 0.5
+MAINS = 50
+
+def clip_levels(eegdata):
+    """
+    Returns (low, high): sample values at the ends of the range of the recording device,
+    origin-2^(bitrate-1) and origin+2^(bitrate-1)-1 as stored (e.g. 0 and 1023 for raw
+    captures, -512 and 511 for OpenVibe captures), -1 and 1-2^(1-bitrate) after standartization
+    """
+    half = 2**(eegdata.bitrate - 1)
+    if eegdata.standartized:
+        return -1.0, (half - 1)/float(half)
+    return eegdata.origin - half, eegdata.origin + half - 1
+
+def window_stats(eegdata, n_electrodes=2, window=2.0, step=1.0, mains=MAINS, chunk_size=1 << 20):
+    """
+    Computes rolling statistics of windows of the recording in one pass over bounded chunks
+
+    Args:
+        eegdata: EEGData (samples may be memory-mapped)
+        n_electrodes: N. of electrodes analysed
+        window: Length of a window in seconds, a multiple of step
+        step: Time between consecutive windows in seconds
+        mains: Frequency of the line noise in Hz
+        chunk_size: Approximate n. of samples per electrode read at once
+
+    Returns:
+        stats: Dictionary with "starts" (start of every window in seconds) and arrays of
+               shape (windows, electrodes) "variance", "clipped" (fraction of clipped samples)
+               and "line" (fraction of the variance at the mains frequency)
+    """
+    fs = eegdata.sampling_rate
+    step_n = int(round(step*fs))
+    blocks_per_window = max(1, int(round(window/step)))
+    n_blocks = eegdata.data.shape[0] // step_n
+    low, high = clip_levels(eegdata)
+    origin = 0 if eegdata.standartized else eegdata.origin
+    #Cumulative sums start with a zero row, block i is summed into row i+1
+    sums = np.zeros((3, n_blocks + 1, n_electrodes))
+    mains_sums = np.zeros((n_blocks + 1, n_electrodes), dtype=np.complex128)
+    phasor_sums = np.zeros((n_blocks + 1, 1), dtype=np.complex128)
+    #Mains phasor of the samples of a block, block j is rotated by the phase of its first sample.
+    #Sums of the samples and of their products with the phasor are one matrix product.
+    base = np.exp(-2j*np.pi*((mains/float(fs)*np.arange(step_n)) % 1.0))
+    kernel = np.stack([np.ones(step_n), base.real, base.imag], axis=1)
+    chunk_blocks = max(1, chunk_size // step_n)
+    for a in range(0, n_blocks, chunk_blocks):
+        b = min(a + chunk_blocks, n_blocks)
+        raw = eegdata.data[a*step_n:b*step_n,:n_electrodes].T
+        #Electrode major copy, so that every block is contiguous
+        x = np.empty(raw.shape)
+        np.subtract(raw, origin, out=x)
+        x = x.reshape(n_electrodes, b - a, step_n)
+        products = x.dot(kernel)
+        sums[0,a+1:b+1] = products[:,:,0].T
+        sums[1,a+1:b+1] = np.einsum("ebs,ebs->be", x, x)
+        sums[2,a+1:b+1] = np.count_nonzero(((raw <= low) | (raw >= high)).reshape(x.shape), axis=2).T
+        #Phase from the absolute sample index, so sums of consecutive blocks add up coherently
+        rotation = np.exp(-2j*np.pi*((mains/float(fs)*step_n*np.arange(a, b)) % 1.0))
+        mains_sums[a+1:b+1] = rotation[:,None]*(products[:,:,1] + 1j*products[:,:,2]).T
+        phasor_sums[a+1:b+1,0] = rotation*np.sum(base)
+    instrumentation.add_bytes(n_blocks*step_n*n_electrodes*eegdata.data.itemsize)
+    def rolling(values):
+        #Sums over windows of blocks_per_window consecutive blocks (the second to last axis)
+        csum = np.cumsum(values, axis=-2)
+        return csum[...,blocks_per_window:,:] - csum[...,:-blocks_per_window,:]
+    s1, s2, clipped = rolling(sums)
+    z = rolling(mains_sums)
+    p = rolling(phasor_sums)
+    n = float(blocks_per_window*step_n)
+    mean = s1/n
+    variance = np.maximum(s2/n - mean**2, 0)
+    #Amplitude of the mains component of the mean free window, 2|X|^2/n^2 is its power
+    line = 2*np.abs(z - mean*p)**2/n**2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        line = np.where(variance > 0, line/variance, 0)
+    return {"starts": np.arange(variance.shape[0])*step_n/float(fs), "variance": variance,
+            "clipped": clipped/n, "line": line}
+
+def window_flags(eegdata, stats):
+    """
+    Returns artifact flags (FLAT, HIGH_VARIANCE, CLIPPING, LINE_NOISE bits) of every window
+    of window_stats, combined over electrodes
+    """
+    variance = stats["variance"]
+    unit = 1.0/2**(eegdata.bitrate - 1) if eegdata.standartized else 1.0
+    flags = np.zeros(variance.shape, dtype=np.uint8)
+    if variance.size == 0:
+        return np.zeros(variance.shape[0], dtype=np.uint8)
+    flags[variance < (FLAT_STD*unit)**2] |= FLAT
+    flags[variance > HIGH_VARIANCE_RATIO*np.median(variance, axis=0)] |= HIGH_VARIANCE
+    flags[stats["clipped"] > CLIP_FRACTION] |= CLIPPING
+    flags[stats["line"] > LINE_NOISE_FRACTION] |= LINE_NOISE
+    return np.bitwise_or.reduce(flags, axis=1)
+
+def merge_intervals(starts, ends, merge_gap=0.0, min_length=0.0):
+    """
+    Merges sorted intervals overlapping or closer than merge_gap and drops merged
+    intervals shorter than min_length
+
+    Returns:
+        intervals: Array of shape (n, 2) of [start, end) times
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.maximum.accumulate(np.asarray(ends, dtype=np.float64)) if len(ends) else np.zeros(0)
+    if len(starts) == 0:
+        return np.zeros((0, 2))
+    new = np.r_[True, starts[1:] > ends[:-1] + merge_gap]
+    first = np.flatnonzero(new)
+    last = np.r_[first[1:] - 1, len(starts) - 1]
+    intervals = np.stack([starts[first], ends[last]], axis=1)
+    return intervals[intervals[:,1] - intervals[:,0] >= min_length]
+
+@instrumentation.timed("detect_artifacts")
+def detect_artifacts(eegdata, n_electrodes=2, window=2.0, step=1.0, mains=MAINS,
+                     merge_gap=2.0, min_length=4.0, chunk_size=1 << 20):
+    """
+    Finds flat (electrode off), clipped, high variance (movement) and line noise periods
+
+    Args:
+        eegdata: EEGData
+        n_electrodes: N. of electrodes analysed, a window is an artifact if any of them is
+        window, step, mains, chunk_size: See window_stats
+        merge_gap: Artifact windows closer than this many seconds are merged
+        min_length: Merged periods shorter than this many seconds are dropped
+
+    Returns:
+        intervals: Array of shape (n, 2) of sorted, disjoint [start, end) times in seconds
+    """
+    stats = window_stats(eegdata, n_electrodes, window, step, mains, chunk_size)
+    flags = window_flags(eegdata, stats)
+    bad = np.flatnonzero(flags)
+    instrumentation.count("artifact_windows", len(bad))
+    #Same rounding to whole samples and blocks as window_stats
+    fs = eegdata.sampling_rate
+    length = max(1, int(round(window/step)))*int(round(step*fs))/float(fs)
+    ends = np.minimum(stats["starts"][bad] + length, eegdata.sleep_duration())
+    return merge_intervals(stats["starts"][bad], ends, merge_gap, min_length)
+
+def masked_windows(samplestamps, window, sampling_rate, intervals):
+    """
+    Returns True for every spectrogram window whose centre lies in one of the intervals
+
+    Args:
+        samplestamps: End sample of every window (see EEGSpectralData)
+        window: N. of samples in a window
+        sampling_rate: Sampling rate of the recording
+        intervals: Sorted, disjoint [start, end) times in seconds
+    """
+    intervals = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+    centres = (np.asarray(samplestamps) - window/2.0)/sampling_rate
+    if len(intervals) == 0:
+        return np.zeros(len(centres), dtype=bool)
+    idx = np.searchsorted(intervals[:,0], centres, side="right") - 1
+    return (idx >= 0) & (centres < intervals[np.maximum(idx, 0),1])
+
+def mask_segments(times, labels, length, intervals, label=MASK_OFF):
+    """
+    Relabels the parts of stage segments covered by intervals
+
+    Args:
+        times, labels: Start times and labels of the segments
+        length: End of the last segment
+        intervals: Sorted, disjoint [start, end) times in seconds
+        label: Label of the covered parts
+
+    Returns:
+        (times, labels): Segments with adjacent equal labels merged
+    """
+    times = np.asarray(times, dtype=np.float64)
+    labels = np.asarray(labels)
+    intervals = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+    bounds = np.unique(np.r_[times, np.clip(intervals.ravel(), times[0], length)])
+    bounds = bounds[bounds < length]
+    new = labels[np.searchsorted(times, bounds, side="right") - 1]
+    idx = np.searchsorted(intervals[:,0], bounds, side="right") - 1
+    if len(intervals):
+        new[(idx >= 0) & (bounds < intervals[np.maximum(idx, 0),1])] = label
+    keep = np.r_[True, new[1:] != new[:-1]]
+    return bounds[keep], new[keep]
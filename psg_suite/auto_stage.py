@@ -0,0 +1,138 @@
+'''
+Contains automatic sleep stage pre-labelling used to seed manual labeling
+
+Every epoch is scored from its band power features (see band_features) by a
+small fixed linear model over robustly standardized log band powers, epochs
+with missing or implausible power are labelled MASK OFF, and isolated epochs
+are smoothed away by a majority filter. Everything is vectorized over epochs,
+so a whole night takes milliseconds. The result is only a starting point for
+the technician, not a validated scorer.
+'''
+import numpy as np
+from . import artifacts
+from . import band_features
+from . import instrumentation
+from .sleep_stage_label import SleepStageLabel
+from .stage_timeline import SLEEP_STAGE_LABELS
+
+MASK_OFF = SLEEP_STAGE_LABELS.index('MASK OFF')
+#Bands used by the model, in the column order of STAGE_WEIGHTS
+MODEL_BANDS = ("delta", "theta", "alpha", "sigma", "beta")
+#Weights of the standardized log band powers per stage (rows indexed like SLEEP_STAGE_LABELS)
+#and bias of every stage
+STAGE_WEIGHTS = np.array([[ 1.5, 0.0,-0.5, 0.0,-1.0],   #NREM3
+                          [ 0.5, 0.0, 0.0, 1.0,-0.5],   #NREM2
+                          [-0.5, 1.0,-0.5,-1.0, 0.0],   #REM
+                          [-0.5, 0.5, 0.0,-0.5, 0.0],   #NREM1
+                          [-1.0,-0.5, 1.0, 0.0, 1.5]])  #WAKE
+STAGE_BIAS = np.array([-1.0, 0.2, -0.2, -0.3, -0.5])
+#Epochs whose total power differs from that of the median epoch by more than this factor
+#are treated as electrode off/artifact. A fixed factor rather than a n. of robust standard
+#deviations, so the higher power of slow wave sleep in a night of stable power is not masked.
+MASK_OFF_FACTOR = 100.0
+
+def robust_z(values):
+    """
+    Returns (values - median) / (1.4826 * median absolute deviation) of every column, ignoring NaN
+    """
+    median = np.nanmedian(values, axis=0)
+    mad = 1.4826*np.nanmedian(np.abs(values - median), axis=0)
+    mad[~(mad > 0)] = 1.0
+    return (values - median)/mad
+
+def smooth_labels(labels, width=3):
+    """
+    Replaces every label by the most frequent label of the width epochs centred on it,
+    ties are kept as the original label
+
+    Args:
+        labels: 1D array of labels (indices into SLEEP_STAGE_LABELS)
+        width: Odd n. of epochs in the majority window
+    """
+    if len(labels) == 0 or width <= 1:
+        return labels
+    onehot = np.zeros((len(labels), len(SLEEP_STAGE_LABELS)))
+    onehot[np.arange(len(labels)), labels] = 1
+    half = width//2
+    csum = np.zeros((len(labels) + 2*half + 1, onehot.shape[1]))
+    np.cumsum(np.pad(onehot, ((half, half), (0, 0))), axis=0, out=csum[1:])
+    counts = csum[width:] - csum[:-width]
+    #Half a vote for the current label resolves ties in its favour
+    counts += 0.5*onehot
+    return np.argmax(counts, axis=1)
+
+def stage_epochs(table):
+    """
+    Assigns a stage to every epoch of a feature table
+
+    Args:
+        table: Table returned by band_features.epoch_band_features with all MODEL_BANDS
+
+    Returns:
+        labels: 1D array of labels (indices into SLEEP_STAGE_LABELS), one per epoch
+    """
+    n_electrodes = 0
+    while MODEL_BANDS[0] + "_" + str(n_electrodes) in table:
+        n_electrodes += 1
+    #(epochs, bands, electrodes) -> mean log power over electrodes
+    powers = np.stack([np.stack([table[b + "_" + str(el)] for el in range(n_electrodes)], axis=1)
+                       for b in MODEL_BANDS], axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        logp = np.log(powers).mean(axis=2)
+        total = np.log(powers.sum(axis=1)).mean(axis=1)
+    invalid = ~np.all(np.isfinite(logp), axis=1) | ~np.isfinite(total)
+    logp[invalid] = np.nan
+    total[invalid] = np.nan
+    #Relative band powers make the model independent of the recording gain
+    z = robust_z(logp - total[:,None])
+    scores = z.dot(STAGE_WEIGHTS.T) + STAGE_BIAS
+    labels = np.argmax(np.nan_to_num(scores), axis=1)
+    with np.errstate(invalid="ignore"):
+        outlying = np.abs(total - np.nanmedian(total)) > np.log(MASK_OFF_FACTOR)
+    labels[invalid | outlying] = MASK_OFF
+    return smooth_labels(labels)
+
+def merge_epochs(labels, epoch_length=band_features.EPOCH_LENGTH):
+    """
+    Merges consecutive epochs with equal labels into segments
+
+    Returns:
+        (times, labels): Start times of the segments in seconds and their labels
+    """
+    labels = np.asarray(labels)
+    if len(labels) == 0:
+        return np.zeros(1), np.array([MASK_OFF])
+    starts = np.r_[0, np.flatnonzero(labels[1:] != labels[:-1]) + 1]
+    return starts*float(epoch_length), labels[starts]
+
+@instrumentation.timed("auto_label")
+def auto_label(spectral, name=None, date=None, sleep_block=None, sleep_length=None,
+               epoch_length=band_features.EPOCH_LENGTH, mask=None):
+    """
+    Pre-labels a recording from its spectrogram
+
+    Args:
+        spectral: EEGSpectralData covering at least 0.5-15 Hz
+        name, date, sleep_block: Passed to SleepStageLabel
+        sleep_length: Length of the recording in seconds, None = time of the last spectrogram window
+        epoch_length: Length of a scored epoch in seconds
+        mask: Sorted, disjoint [start, end) times in seconds labelled MASK OFF
+              (e.g. from artifacts.detect_artifacts), None = none
+
+    Returns:
+        labels: SleepStageLabel whose segments (also stored as loaded_stage_times/labels,
+                so Reload in label_manual returns to them) hold the automatic stages
+    """
+    if sleep_length is None:
+        sleep_length = float(spectral.timestamps[-1])
+    table = band_features.epoch_band_features(spectral, epoch_length,
+                                              n_epochs=int(np.ceil(sleep_length/epoch_length)))
+    times, labels = merge_epochs(stage_epochs(table), epoch_length)
+    if mask is not None:
+        times, labels = artifacts.mask_segments(times, labels, sleep_length, mask, MASK_OFF)
+    result = SleepStageLabel(name, date, sleep_block, sleep_length)
+    result.loaded_stage_times = times
+    result.loaded_stage_labels = labels
+    result.stage_times = times
+    result.stage_labels = labels
+    return result
@@ -0,0 +1,126 @@
+'''
+Contains extraction of per-epoch band power features from EEG spectral data
+'''
+import collections
+import csv
+import numpy as np
+
+#Classic sleep EEG bands, [low, high) in Hz
+BANDS = collections.OrderedDict([("delta", (0.5, 4)), ("theta", (4, 8)), ("alpha", (8, 12)),
+                                 ("sigma", (12, 15)), ("beta", (15, 30))])
+#Ratios of summed band powers, name: (numerator bands, denominator bands)
+RATIOS = collections.OrderedDict([("delta_beta", (("delta",), ("beta",))),
+                                  ("theta_alpha", (("theta",), ("alpha",))),
+                                  ("slow_fast", (("delta", "theta"), ("alpha", "beta")))])
+#Length of a scoring epoch in seconds
+EPOCH_LENGTH = 30
+
+def band_index_ranges(frequencystamps, bands=BANDS):
+    """
+    Returns (lo, hi) arrays of frequency indices, band b sums power values lo[b]:hi[b]
+
+    Args:
+        frequencystamps: Ascending frequencies of the power values
+        bands: Dictionary mapping band name to [low, high) frequency range
+    """
+    limits = np.array(list(bands.values()), dtype=np.float64).reshape(-1, 2)
+    lo = np.searchsorted(frequencystamps, limits[:,0], side="left")
+    hi = np.searchsorted(frequencystamps, limits[:,1], side="left")
+    return lo, hi
+
+def band_powers(power, frequencystamps, bands=BANDS):
+    """
+    Computes power of every band for all electrodes and windows from one cumulative
+    sum over the frequency axis
+
+    Args:
+        power: Array of shape (..., frequencies), e.g. EEGSpectralData.data
+        frequencystamps: Frequencies of the last axis of power
+        bands: Dictionary mapping band name to [low, high) frequency range
+
+    Returns:
+        powers: Array of shape (..., bands) with power integrated over each band
+    """
+    lo, hi = band_index_ranges(frequencystamps, bands)
+    top = int(np.max(hi)) if len(hi) else 0
+    csum = np.zeros(power.shape[:-1] + (top+1,), dtype=np.float64)
+    np.cumsum(power[...,:top], axis=-1, out=csum[...,1:])
+    df = frequencystamps[1] - frequencystamps[0] if len(frequencystamps) > 1 else 1.0
+    return (csum[...,hi] - csum[...,lo]) * df
+
+def epoch_index(samplestamps, window, sampling_rate, epoch_length=EPOCH_LENGTH):
+    """
+    Returns index of the epoch containing the centre of every window
+    """
+    return ((np.asarray(samplestamps) - window/2) / sampling_rate // epoch_length).astype(np.int64)
+
+def epoch_means(values, epochs, n_epochs=None):
+    """
+    Averages rows of values falling into the same epoch
+
+    Args:
+        values: Array of shape (windows, ...)
+        epochs: Non-decreasing epoch index of every window
+        n_epochs: N. of epochs returned, None = last epoch + 1
+
+    Returns:
+        means: Array of shape (n_epochs, ...), NaN for epochs without windows
+    """
+    if n_epochs is None:
+        n_epochs = int(epochs[-1]) + 1 if len(epochs) else 0
+    means = np.full((n_epochs,) + values.shape[1:], np.nan)
+    keep = epochs < n_epochs
+    values, epochs = values[keep], epochs[keep]
+    if len(epochs) == 0:
+        return means
+    starts = np.flatnonzero(np.r_[True, epochs[1:] != epochs[:-1]])
+    counts = np.diff(np.r_[starts, len(epochs)])
+    sums = np.add.reduceat(values, starts, axis=0)
+    means[epochs[starts]] = sums / counts.reshape((-1,) + (1,)*(values.ndim-1))
+    return means
+
+def epoch_band_features(spectral, epoch_length=EPOCH_LENGTH, bands=BANDS, ratios=RATIOS,
+                        n_epochs=None):
+    """
+    Computes mean band powers and band power ratios of every electrode per epoch
+
+    Args:
+        spectral: EEGSpectralData (before frequency_cutoff removes the upper bands)
+        epoch_length: Length of an epoch in seconds
+        bands: Dictionary mapping band name to [low, high) frequency range
+        ratios: Dictionary mapping ratio name to (numerator bands, denominator bands)
+        n_epochs: N. of epochs in the table, None = up to the last epoch covered by a window
+
+    Returns:
+        table: OrderedDict of equally long 1D columns: "epoch", "start" (seconds) and
+               "<band>_<electrode>", "<ratio>_<electrode>" for every electrode
+    """
+    powers = band_powers(spectral.data, spectral.frequencystamps, bands)
+    epochs = epoch_index(spectral.samplestamps, spectral.window, spectral.sampling_rate, epoch_length)
+    #(epochs, electrodes, bands)
+    means = epoch_means(np.transpose(powers, (1, 0, 2)), epochs, n_epochs)
+    names = list(bands)
+    table = collections.OrderedDict()
+    table["epoch"] = np.arange(means.shape[0])
+    table["start"] = table["epoch"] * float(epoch_length)
+    for el in range(means.shape[1]):
+        for b, name in enumerate(names):
+            table[name + "_" + str(el)] = means[:,el,b]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for name, (num, den) in ratios.items():
+                table[name + "_" + str(el)] = (means[:,el,[names.index(n) for n in num]].sum(axis=1) /
+                                               means[:,el,[names.index(n) for n in den]].sum(axis=1))
+    return table
+
+def save_csv(table, fname):
+    """
+    Saves feature table as CSV with a header row
+
+    Args:
+        table: Dictionary of equally long columns returned by epoch_band_features
+        fname: Path to file to be saved
+    """
+    with open(fname, 'w') as f:
+        wr = csv.writer(f, delimiter=',', lineterminator='\n')
+        wr.writerow(list(table))
+        wr.writerows(zip(*[c.tolist() for c in table.values()]))
@@ -0,0 +1,114 @@
+'''
+Contains anti-aliased decimation used to compute low frequency spectrograms at a reduced sampling rate
+'''
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+def decimation_factor(sampling_rate, cutoff, window, step, margin=1.25):
+    """
+    Returns the largest decimation factor q dividing window and step for which the
+    decimated rate sampling_rate/q still keeps frequencies up to cutoff free of aliasing
+    with a transition band of at least (margin-1)*2*cutoff
+
+    Args:
+        sampling_rate: Sampling rate of the signal
+        cutoff: Highest frequency that has to be kept
+        window, step: Window and step of the spectrogram in samples
+        margin: Min. ratio of the decimated Nyquist frequency to cutoff
+    """
+    best = 1
+    for q in range(2, int(sampling_rate / (2*cutoff*margin)) + 1):
+        if window % q == 0 and step % q == 0:
+            best = q
+    return best
+
+def lowpass_taps(sampling_rate, q, cutoff, attenuation=60.0):
+    """
+    Designs a Kaiser windowed sinc low-pass filter for decimation by q. Frequencies up to
+    cutoff are passed, frequencies that would alias below cutoff (above sampling_rate/q - cutoff)
+    are attenuated by the given number of decibels.
+
+    Returns:
+        taps: Odd length 1D array with unit DC gain
+    """
+    pass_edge = float(cutoff)
+    stop_edge = float(sampling_rate)/q - cutoff
+    width = 2*np.pi*(stop_edge - pass_edge)/sampling_rate
+    n_taps = int(np.ceil((attenuation - 8)/(2.285*width))) + 1
+    n_taps += 1 - n_taps % 2
+    beta = 0.1102*(attenuation - 8.7) if attenuation > 50 else 0.5842*(attenuation - 21)**0.4 + 0.07886*(attenuation - 21)
+    n = np.arange(n_taps) - (n_taps - 1)/2
+    taps = np.sinc((pass_edge + stop_edge)/sampling_rate*n) * np.kaiser(n_taps, beta)
+    return taps/np.sum(taps)
+
+def _padded(samples, lo, hi):
+    """
+    Returns samples[lo:hi] as float64, indices outside the signal are mirrored at its ends
+    """
+    n = samples.shape[0]
+    if lo >= 0 and hi <= n:
+        return np.array(samples[lo:hi], dtype=np.float64)
+    idx = np.abs(np.arange(lo, hi))
+    idx = np.where(idx >= n, 2*(n-1) - idx, idx)
+    return np.array(samples[np.clip(idx, 0, n-1)], dtype=np.float64)
+
+def decimate(samples, q, taps, block=4096, start=0, stop=None):
+    """
+    Low-pass filters a signal with zero phase and keeps every q-th sample, computing
+    only the kept outputs (polyphase form) block by block. A range of outputs reads
+    only its samples plus the filter overlap, so any range equals the same rows of
+    the whole decimated signal.
+
+    Args:
+        samples: 1D array (may be a column of a memory-mapped recording)
+        q: Decimation factor
+        taps: Odd length filter returned by lowpass_taps
+        block: N. of outputs computed at once
+        start, stop: Range of outputs computed, stop None = all
+
+    Returns:
+        decimated: 1D float64 array, decimated[j] is the filtered signal at sample (start+j)*q
+    """
+    n = samples.shape[0]
+    n_out = -(-n // q)
+    stop = n_out if stop is None else min(stop, n_out)
+    n_phases = -(-len(taps) // q)
+    bank = np.zeros(n_phases*q)
+    bank[:len(taps)] = taps
+    bank = bank.reshape(n_phases, q)
+    half = (len(taps) - 1)//2
+    out = np.empty(max(stop - start, 0))
+    for first in range(start, stop, block):
+        last = min(first + block, stop)
+        seg = _padded(samples, first*q - half, (last - 1 + n_phases)*q - half).reshape(-1, q)
+        #partial[r, m] is phase m applied to row r, output j sums partial[j+m, m] over m
+        partial = seg.dot(bank.T)
+        out[first-start:last-start] = as_strided(partial, shape=(last-first, n_phases),
+                                                 strides=(partial.strides[0], partial.strides[0]+partial.strides[1])).sum(axis=1)
+    return out
+
+class DecimatedSignal():
+    """
+    Decimated view of a 2D recording (samples x electrodes) that computes the rows
+    it is sliced for (signal[a:b, el]), so the decimated signal is never held whole
+    and memory stays bounded by the slices read (e.g. spectrogram batches)
+    """
+    def __init__(self, samples, q, taps):
+        """
+        Args:
+            samples: 2D array (n_samples, electrodes), may be memory-mapped
+            q: Decimation factor
+            taps: Odd length filter returned by lowpass_taps (including any gain)
+        """
+        self.samples = samples
+        self.q = q
+        self.taps = taps
+        self.shape = (-(-samples.shape[0] // q), samples.shape[1])
+        self.dtype = np.dtype(np.float64)
+
+    def __getitem__(self, key):
+        rows, el = key
+        start, stop, step = rows.indices(self.shape[0])
+        if step != 1:
+            raise IndexError("Only contiguous row ranges of a decimated signal can be read")
+        return decimate(self.samples[:,el], self.q, self.taps, start=start, stop=stop)
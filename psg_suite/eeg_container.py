@@ -0,0 +1,198 @@
+'''
+Native binary container for EEG and EEG spectral data
+
+A container file is laid out as follows (all integers little endian):
+
+    offset 0   8 bytes   magic b"PSGBIN1\n"
+    offset 8   4 bytes   uint32 length H of the metadata header
+    offset 12  H bytes   UTF-8 JSON metadata header
+    ...        padding   zero bytes up to the next multiple of 64
+    ...        arrays    contiguous C-order arrays, each starting at a multiple of 64
+
+The JSON metadata header is a dictionary with the keys
+    "kind": class of the stored object ("EEGData" or "EEGSpectralData")
+    "attrs": scalar attributes of the object, for EEGData bitrate, n_electrodes,
+             sampling_rate, origin, standartized and first_sample, for EEGSpectralData
+             window, step, n_electrodes, sampling_rate, estimator (description of the
+             spectral estimator), decimation (factor by which the signal was decimated
+             before computing the spectra) and first_sample, plus the extra attributes
+             passed to EEGSpectralData.save_bin (e.g. by spectrum_cache). Attributes
+             added later are missing in older files and read as their defaults:
+             estimator "periodogram", decimation 1 and first_sample 0. window, step and
+             n_electrodes missing in old pickles are derived from the arrays when they
+             are converted or loaded (see EEGSpectralData.migrate_legacy_attrs)
+    "arrays": dictionary mapping attribute name to {"dtype", "shape", "offset"},
+              offset being the absolute byte position of the array in the file.
+              EEGData stores "data" (samples x electrodes), EEGSpectralData stores
+              "data" (electrodes x windows x frequencies), "frequencystamps",
+              "samplestamps" and "timestamps"
+
+Arrays are opened with np.memmap, so opening a file only reads the header and
+the sample/power data is paged in from disk when it is accessed.
+'''
+import json
+import pickle
+import struct
+import sys
+import numpy as np
+
+MAGIC = b"PSGBIN1\n"
+ALIGNMENT = 64
+#Max. n. of bytes copied at once when writing non-contiguous or memory-mapped arrays
+WRITE_BLOCK = 1 << 26
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def _scalar(val):
+    if isinstance(val, np.generic):
+        return val.item()
+    return val
+
+def save_container(fname, kind, attrs, arrays, placeholders=None):
+    """
+    Writes attributes and arrays into a container file
+
+    Args:
+        fname: Path to file to be saved
+        kind: Name of the class of stored object
+        attrs: Dictionary of scalar attributes
+        arrays: Dictionary of arrays, None values are skipped
+        placeholders: Dictionary mapping names to (shape, dtype) of zero filled
+                      arrays whose content is written later (see allocate_container)
+    """
+    entries = [(name, np.asanyarray(arr)) for name, arr in arrays.items() if arr is not None]
+    entries = [(name, arr.shape, arr.dtype, arr) for name, arr in entries]
+    if placeholders is not None:
+        entries += [(name, tuple(shape), np.dtype(dtype), None)
+                    for name, (shape, dtype) in placeholders.items()]
+    meta = {"kind": kind,
+            "attrs": dict((k, _scalar(v)) for k, v in attrs.items()),
+            "arrays": {}}
+    #Header length depends on the offsets and the offsets on header length,
+    #grow the reserved space until the header fits
+    reserved = ALIGNMENT
+    while True:
+        offset = _aligned(len(MAGIC) + 4 + reserved)
+        for name, shape, dtype, arr in entries:
+            meta["arrays"][name] = {"dtype": dtype.str, "shape": list(shape), "offset": offset}
+            offset = _aligned(offset + int(np.prod(shape))*dtype.itemsize)
+        header = json.dumps(meta).encode("utf-8")
+        if len(header) <= reserved:
+            break
+        reserved = _aligned(len(header))
+    with open(fname, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for name, shape, dtype, arr in entries:
+            if arr is None:
+                continue
+            f.write(b"\0" * (meta["arrays"][name]["offset"] - f.tell()))
+            if arr.ndim == 0 or arr.nbytes == 0:
+                f.write(np.ascontiguousarray(arr).tobytes())
+                continue
+            rows = max(1, WRITE_BLOCK // max(1, arr.nbytes // arr.shape[0]))
+            for r in range(0, arr.shape[0], rows):
+                f.write(np.ascontiguousarray(arr[r:r+rows]).tobytes())
+        #Placeholders are left as a sparse zero filled region where supported
+        f.truncate(offset)
+
+def allocate_container(fname, kind, attrs, arrays, placeholders):
+    """
+    Writes a container file with zero filled placeholder arrays and opens
+    all of its arrays memory-mapped for writing
+
+    Args:
+        fname: Path to file to be saved
+        kind: Name of the class of stored object
+        attrs: Dictionary of scalar attributes
+        arrays: Dictionary of arrays, None values are skipped
+        placeholders: Dictionary mapping names to (shape, dtype) of arrays to be filled later
+
+    Returns:
+        arrays: Dictionary of memory-mapped arrays opened in 'r+' mode
+    """
+    save_container(fname, kind, attrs, arrays, placeholders)
+    return load_container(fname, kind, 'r+')[1]
+
+def read_header(fname):
+    """
+    Reads the metadata header of a container file
+
+    Args:
+        fname: Path to file to be read
+
+    Returns:
+        meta: Dictionary with "kind", "attrs" and "arrays" entries
+    """
+    with open(fname, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise IOError("Invalid file format. Not a PSG binary container.")
+        hlen, = struct.unpack("<I", f.read(4))
+        return json.loads(f.read(hlen).decode("utf-8"))
+
+def load_container(fname, kind, mode='r'):
+    """
+    Opens a container file, mapping its arrays into memory
+
+    Args:
+        fname: Path to file to be loaded
+        kind: Expected name of the class of stored object
+        mode: np.memmap mode, 'r' = read only, 'c' = copy on write, 'r+' = write through
+
+    Returns:
+        attrs: Dictionary of scalar attributes
+        arrays: Dictionary of memory-mapped arrays
+    """
+    meta = read_header(fname)
+    if meta["kind"] != kind:
+        raise IOError("Invalid file format. File contains " + str(meta["kind"]) +
+                      " instead of " + kind)
+    arrays = {}
+    for name, desc in meta["arrays"].items():
+        shape = tuple(desc["shape"])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=desc["dtype"])
+        else:
+            arrays[name] = np.memmap(fname, dtype=desc["dtype"], mode=mode,
+                                     offset=desc["offset"], shape=shape)
+    return meta["attrs"], arrays
+
+def convert_pkl(pkl_fname, fname=None):
+    """
+    Converts EEGData or EEGSpectralData pickle file into a container file
+
+    Args:
+        pkl_fname: Path to the pickle file
+        fname: Path to the container file, pkl_fname with .pkl replaced by .psgb by default
+
+    Returns:
+        fname: Path to the written container file
+    """
+    from .eeg_data import EEGData
+    from .eeg_spectrum import EEGSpectralData
+    if fname is None:
+        fname = (pkl_fname[:-4] if pkl_fname.endswith(".pkl") else pkl_fname) + ".psgb"
+    with open(pkl_fname, 'rb') as f:
+        ld = pickle.load(f)
+    if hasattr(ld, "frequencystamps"):
+        obj = EEGSpectralData()
+        for attr in ("timestamps", "samplestamps", "frequencystamps", "window", "step",
+                     "n_electrodes", "sampling_rate", "data"):
+            setattr(obj, attr, getattr(ld, attr, None))
+        obj.migrate_legacy_attrs()
+    else:
+        obj = EEGData()
+        for attr in ("bitrate", "n_electrodes", "sampling_rate", "origin",
+                     "standartized", "data"):
+            setattr(obj, attr, getattr(ld, attr, None))
+        obj.migrate_legacy_origin()
+    obj.save_bin(fname)
+    return fname
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python -m psg_suite.eeg_container file.pkl [file.psgb]")
+        sys.exit(1)
+    print("Written " + convert_pkl(*sys.argv[1:3]))
@@ -3,9 +3,73 @@ Class for storing EEG Sleep data
 '''
 import numpy as np
 import csv
+import os
 import warnings
 import pickle
-from timeit import default_timer as timer
+from . import eeg_container
+from . import instrumentation
+from . import text_ingest
+
+def _parse_raw_block(chunk, n_electrodes):
+    """
+    Parses complete raw data lines into an array of electrode values
+
+    Args:
+        chunk: String of whole lines, each holding at least n_electrodes space separated values
+        n_electrodes: Number of electrode traces to be returned
+    """
+    lines = chunk.splitlines()
+    n_fields = len(lines[0].split(' ')) if lines else 0
+    #Bulk parsing only if lines are split by newlines alone and all hold the same n. of fields
+    if (n_fields >= n_electrodes and chunk.isascii() and
+            len(lines) == chunk.count("\n") + (not chunk.endswith("\n"))):
+        buf = np.frombuffer(chunk.encode("ascii"), dtype=np.uint8)
+        line_of = np.cumsum(buf == ord("\n"))
+        spaces = np.bincount(line_of[buf == ord(" ")], minlength=len(lines)+1)[:len(lines)]
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                values = np.fromstring(chunk, dtype=np.float64, sep=" ")
+        except ValueError:
+            values = None
+        if (values is not None and values.size == len(lines)*n_fields and
+                np.all(spaces == n_fields - 1)):
+            return values.reshape(len(lines), n_fields)[:,:n_electrodes]
+    block = np.zeros((len(lines),n_electrodes),dtype=np.float64)
+    for n, ln in enumerate(lines):
+        strdata = ln.split(' ')
+        for elid in range(n_electrodes):
+            block[n][elid] = float(strdata[elid])
+    return block
+
+def _parse_openvibe_block(chunk, delim, n_values, n_electrodes):
+    """
+    Parses complete OpenVibe data lines into an array of electrode values
+
+    Args:
+        chunk: String of whole lines, each holding n_values entries and an empty sampling rate
+        delim: Delimiter used to separate entries in the file
+        n_values: Number of time and channel entries per line
+        n_electrodes: Number of electrode traces to be returned
+    """
+    n_lines = chunk.count("\n") + (not chunk.endswith("\n"))
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            values = np.fromstring(chunk.replace(delim, " "), dtype=np.float64, sep=" ")
+    except ValueError:
+        values = None
+    if values is not None and values.size == n_lines*n_values:
+        return values.reshape(n_lines, n_values)[:,1:n_electrodes+1]
+    #Irregular lines (extra fields, blank or malformed entries) are parsed one by one
+    #so that errors are the same as for the per-line reader
+    lines = chunk.split("\n")[:n_lines]
+    block = np.zeros((n_lines,n_electrodes),dtype=np.float64)
+    for n, ln in enumerate(lines):
+        strdata = ln.rstrip().split(delim)
+        for elid in range(n_electrodes):
+            block[n][elid] = float(strdata[elid+1])
+    return block
 
 
 
@@ -19,12 +83,15 @@ class EEGData():
     sampling_rate = None #Sampling rate of the signal
     origin = None #Number around which the signal is centered, usually 0 or 2^(bitrate-1)
     standartized = None #False = signal range 0 to 2^bitrate, True = s. range -1 to 1
-    data = None #Electrodes data
+    data = None #Electrodes data, float or compact integer samples (see standartized_data)
+    first_sample = 0 #Index of data[0] in the whole recording, non-zero for segments
     def __init__(self):
         pass
 
+    @instrumentation.timed("EEGData.load_raw")
     def load_raw(self, fname, n_electrodes=2, samp_rate=256,
-                 bitrate=10, origin=512, standartized=False):
+                 bitrate=10, origin=512, standartized=False, dtype=np.float64,
+                 workers=1, chunk_size=4194304):
         """
         Loads EEG data from a raw, space separated format.
 
@@ -35,17 +102,43 @@ class EEGData():
             bitrate: Bitrate of the recording
             origin: Origin around which the signal is centered, usually 0 or 2^(bitrate-1)
             standartized: False = signal range 0 to 2^bitrate, True = s. range -1 to 1
+            dtype: Type of the stored samples, integer types (e.g. np.int16) keep
+                   integer samples compact, files with non-integer or out of range
+                   values are loaded as float64 with a warning
+            workers: N. of processes parsing byte ranges of the file in parallel,
+                     1 = serial, None = n. of CPUs
+            chunk_size: Approximate number of characters parsed at once by a process
         """
         try:
-            with open(fname) as f:
-                lines = f.read().splitlines()
-                self.data = np.zeros((len(lines),n_electrodes),dtype=np.float)
-                n = 0
-                for ln in lines:
-                    strdata = ln.split(' ')
-                    for elid in range(n_electrodes):
-                        self.data[n][elid] = float(strdata[elid])
-                    n += 1
+            self.data = None
+            if workers != 1:
+                self.data = text_ingest.parse_lines(fname, 0, _parse_raw_block, (n_electrodes,),
+                                                    n_electrodes, dtype, workers, chunk_size)
+            if self.data is not None:
+                instrumentation.add_bytes(os.path.getsize(fname))
+                n = self.data.shape[0]
+            else:
+                with open(fname) as f:
+                    lines = f.read().splitlines()
+                    instrumentation.add_bytes(os.fstat(f.fileno()).st_size)
+                    self.data = np.zeros((len(lines),n_electrodes),dtype=dtype)
+                    integer = self.data.dtype.kind in "iu"
+                    info = np.iinfo(self.data.dtype) if integer else None
+                    n = 0
+                    for ln in lines:
+                        strdata = ln.split(' ')
+                        for elid in range(n_electrodes):
+                            value = float(strdata[elid])
+                            if integer and not (value.is_integer() and info.min <= value <= info.max):
+                                text_ingest.check_representable(np.array([value]), dtype)
+                            self.data[n][elid] = value
+                        n += 1
+            instrumentation.count("samples", n)
+        except text_ingest.UnrepresentableValues as e:
+            self.data = None
+            warnings.warn(str(e) + ", " + fname + " is loaded as float64")
+            return self.load_raw(fname, n_electrodes, samp_rate, bitrate, origin, standartized,
+                                 np.float64, workers, chunk_size)
         except Exception:
             self.data = None
             raise
@@ -55,64 +148,111 @@ class EEGData():
         self.origin = origin
         self.standartized = standartized
 
+    @instrumentation.timed("EEGData.load_openvibe")
     def load_openvibe(self, fname, n_electrodes=2, bitrate=10,
-                      origin=512, standartized=False, delim=';'):
+                      origin=512, standartized=False, delim=';', chunk_size=4194304,
+                      dtype=np.float64, workers=1):
         """
-        Loads EEG data from an OpenVibe file
+        Loads EEG data from an OpenVibe file in a single pass, parsing
+        the numeric rows in bulk chunks of roughly chunk_size characters
 
         Args:
             fname: Path to file to be loaded
             n_electrodes:  Number of electrode traces to be loaded
             bitrate: Bitrate of the recording
-            origin: Origin around which the signal is centered, usually 0 or 2^(bitrate-1)
+            origin: Origin around which the values in the file are centered, usually 2^(bitrate-1),
+                    the samples are stored shifted by -512 and the origin attribute accordingly
             standartized: False = signal range 0 to 2^bitrate, True = s. range -1 to 1
             delim: Delimiter used to separate entries in the file
+            chunk_size: Approximate number of characters parsed at once
+            dtype: Type of the stored samples, integer types (e.g. np.int16) keep
+                   integer samples compact, files with non-integer or out of range
+                   values are loaded as float64 with a warning
+            workers: N. of processes parsing byte ranges of the file in parallel,
+                     1 = serial, None = n. of CPUs
         """
         try:
             with open(fname) as f:
-                for i, l in enumerate(f):
-                    pass
-            nlines = i
-            with open(fname) as f:
-                if nlines+1 < 2:
+                header = f.readline().rstrip().split(delim)
+                first = f.readline()
+                if first == "":
                     raise IOError("Invalid file format")
-                self.data = np.zeros((nlines,n_electrodes),dtype=np.float)
-                n = 0;
-                for ln in f:
-                    ln=ln.rstrip()
-                    if n == 0:
-                        #print(ln)
-                        header = ln.split(delim)
-                        if header[0] != "Time (s)":
-                            raise IOError("Invalid file format. First column should be Time.")
-                        if header[-1] != "Sampling Rate":
-                            raise IOError("Invalid file format. Last column "+
-                                          "should be Sampling Rate.")
-                        for i in range(1, len(header)-1):
-                            if header[i] != "Channel " + str(i):
-                                raise IOError("Invalid file format. Column " + str(i+1) +
-                                              " should be Channel " + str(i))
-                        if len(header) - 2 < n_electrodes:
-                            n_electrodes = len(header) - 2
-                            warnings.warn("Not enough electrode channels in the file. Only "
-                                          + str(n_electrodes) + " will be read")
-                        n+=1
-                        continue
-                    strdata = ln.split(delim)
-                    if n == 1:
-                        self.sampling_rate = int(strdata[-1])
-                    for elid in range(n_electrodes):
-                        self.data[n-1][elid] = float(strdata[elid+1])-512
-                    n+=1
+                if header[0] != "Time (s)":
+                    raise IOError("Invalid file format. First column should be Time.")
+                if header[-1] != "Sampling Rate":
+                    raise IOError("Invalid file format. Last column "+
+                                  "should be Sampling Rate.")
+                for i in range(1, len(header)-1):
+                    if header[i] != "Channel " + str(i):
+                        raise IOError("Invalid file format. Column " + str(i+1) +
+                                      " should be Channel " + str(i))
+                n_columns = n_electrodes
+                if len(header) - 2 < n_electrodes:
+                    n_electrodes = len(header) - 2
+                    warnings.warn("Not enough electrode channels in the file. Only "
+                                  + str(n_electrodes) + " will be read")
+                strdata = first.rstrip().split(delim)
+                self.sampling_rate = int(strdata[-1])
+                #Rows after the first one are shorter (no sampling rate), so this overestimates
+                file_size = os.fstat(f.fileno()).st_size
+                instrumentation.add_bytes(file_size)
+                first_values = [float(strdata[elid+1]) for elid in range(n_electrodes)]
+                text_ingest.check_representable(np.array(first_values), dtype)
+                if workers != 1:
+                    with open(fname, 'rb') as fb:
+                        fb.readline()
+                        fb.readline()
+                        start = fb.tell()
+                    #Missing channels are kept as zero columns, same as the per-line reader
+                    self.data = text_ingest.parse_lines(fname, start, _parse_openvibe_block,
+                                                        (delim, len(header)-1, n_electrodes), n_columns,
+                                                        dtype, workers, chunk_size, lead=1)
+                if self.data is not None and workers != 1:
+                    self.data[0,:n_electrodes] = first_values
+                    n = self.data.shape[0]
+                else:
+                    capacity = file_size // max(len(first)-len(strdata[-1]), 1) + 1
+                    #Missing channels are kept as zero columns, same as the per-line reader
+                    self.data = np.zeros((capacity,n_columns),dtype=dtype)
+                    self.data[0,:n_electrodes] = first_values
+                    n = 1
+                    while True:
+                        chunk = f.read(chunk_size)
+                        if chunk == "":
+                            break
+                        if not chunk.endswith("\n"):
+                            chunk += f.readline()
+                        block = _parse_openvibe_block(chunk, delim, len(header)-1, n_electrodes)
+                        text_ingest.check_representable(block, dtype)
+                        if n + block.shape[0] > capacity:
+                            capacity = max(n + block.shape[0], int(capacity*1.25))
+                            self.data.resize((capacity,n_columns), refcheck=False)
+                        self.data[n:n+block.shape[0],:n_electrodes] = block
+                        n += block.shape[0]
+                        instrumentation.count("chunks")
+                instrumentation.count("samples", n)
+                self.data.resize((n,n_columns), refcheck=False)
+                if self.data.dtype.kind in "iu" and self.data.size:
+                    #The shifted samples have to stay in range as well
+                    text_ingest.check_representable(np.array([int(np.min(self.data)) - 512]), dtype)
+                self.data[:,:n_electrodes] -= 512
+        except text_ingest.UnrepresentableValues as e:
+            self.data = None
+            self.sampling_rate = None
+            warnings.warn(str(e) + ", " + fname + " is loaded as float64")
+            return self.load_openvibe(fname, n_electrodes, bitrate, origin, standartized, delim,
+                                      chunk_size, np.float64, workers)
         except Exception:
             self.data = None
             self.sampling_rate = None
             raise
         self.bitrate = bitrate
         self.n_electrodes = n_electrodes
-        self.origin = origin
+        #Samples are stored shifted by -512, so is the origin they are centered around
+        self.origin = origin - 512
         self.standartized = standartized
 
+    @instrumentation.timed("EEGData.load_pkl")
     def load_pkl(self, fname):
         """
         Loads EEG data from pickle file
@@ -120,18 +260,19 @@ class EEGData():
         Args:
             fname: Path to file to be loaded
         """
-        start = timer()
         with open(fname,'rb') as f:
+            instrumentation.add_bytes(os.fstat(f.fileno()).st_size)
             ld = pickle.load(f)
             self.bitrate = ld.bitrate
             self.n_electrodes = ld.n_electrodes
             self.sampling_rate = ld.sampling_rate
             self.origin = ld.origin
             self.standartized = ld.standartized
+            self.first_sample = getattr(ld, "first_sample", 0)
             self.data = ld.data
-        end = timer()
-        print(fname + " unpickled in " + str(end - start))
+        self.migrate_legacy_origin()
 
+    @instrumentation.timed("EEGData.save_pkl")
     def save_pkl(self, fname):
         """
         Saves EEG data to pickle file
@@ -142,17 +283,91 @@ class EEGData():
         with open(fname,'wb') as f:
             pickle.dump(self,f)
 
+    @instrumentation.timed("EEGData.load_bin")
+    def load_bin(self, fname, mode='r'):
+        """
+        Opens EEG data from native binary container (see eeg_container),
+        the samples are memory-mapped instead of being read into memory
 
-    def standartize(self):
+        Args:
+            fname: Path to file to be loaded
+            mode: np.memmap mode, 'r' = read only, 'c' = copy on write, 'r+' = write through
+        """
+        attrs, arrays = eeg_container.load_container(fname, "EEGData", mode)
+        self.bitrate = attrs["bitrate"]
+        self.n_electrodes = attrs["n_electrodes"]
+        self.sampling_rate = attrs["sampling_rate"]
+        self.origin = attrs["origin"]
+        self.standartized = attrs["standartized"]
+        self.first_sample = attrs.get("first_sample", 0)
+        self.data = arrays["data"]
+        self.migrate_legacy_origin()
+        instrumentation.add_bytes(self.data.nbytes)
+
+    @instrumentation.timed("EEGData.save_bin")
+    def save_bin(self, fname):
+        """
+        Saves EEG data to native binary container (see eeg_container)
+
+        Args:
+            fname: Path to file to be saved
+        """
+        instrumentation.add_bytes(self.data.nbytes)
+        eeg_container.save_container(fname, "EEGData",
+                                     {"bitrate": self.bitrate,
+                                      "n_electrodes": self.n_electrodes,
+                                      "sampling_rate": self.sampling_rate,
+                                      "origin": self.origin,
+                                      "standartized": self.standartized,
+                                      "first_sample": self.first_sample},
+                                     {"data": self.data})
+
+
+    def migrate_legacy_origin(self, n_probe=65536):
+        """
+        Fixes the origin of OpenVibe data saved before the origin was stored shifted
+        along with the samples: such data keeps origin 2^(bitrate-1) while the samples
+        are centered on 0, so the origin is set to 0 if the median of a sample of the
+        data is closer to 0 than to the origin
+
+        Args:
+            n_probe: Approximate n. of samples per electrode the median is taken of
+        """
+        half = 2**(self.bitrate - 1) if self.bitrate is not None else None
+        if (self.standartized or half is None or self.origin != half or
+                self.data is None or self.data.size == 0):
+            return
+        probe = np.asarray(self.data[::max(1, self.data.shape[0]//n_probe)], dtype=np.float64)
+        if abs(np.nanmedian(probe)) < half/2:
+            self.origin = 0
+
+    def standartized_data(self, dtype=np.float64):
+        """
+        Returns the data standartized to range -1 to 1 without modifying the stored
+        samples, allocating only the returned array
+
+        Args:
+            dtype: Floating point type of the returned array (np.float32 or np.float64)
+        """
+        if self.standartized:
+            return self.data.astype(dtype, copy=False)
+        out = np.subtract(self.data, self.origin, dtype=dtype)
+        out *= np.dtype(dtype).type(1)/np.power(2,self.bitrate - 1)
+        return out
+
+    @instrumentation.timed("EEGData.standartize")
+    def standartize(self, dtype=np.float64):
         """
         Standartizes the data by setting origin to 0 and range to -1 to 1
+
+        Args:
+            dtype: Floating point type of the standartized data (np.float32 or np.float64)
         """
 
         if self.standartized:
             return
-        self.data = self.data - self.origin
+        self.data = self.standartized_data(dtype)
         origin = 0
-        self.data = self.data / np.power(2,self.bitrate - 1)
         self.standartized = True
 
     def sleep_duration(self):
@@ -161,3 +376,60 @@ class EEGData():
         """
         return self.data.shape[0]/self.sampling_rate
 
+    def start_time(self):
+        """
+        Returns time of the first sample in the whole recording in seconds
+        """
+        return self.first_sample/self.sampling_rate
+
+    def segment(self, start, stop=None):
+        """
+        Returns EEG data of a time range sharing the samples of this one (a view, also of
+        memory-mapped samples), e.g. a sleep block of a long recording
+
+        Args:
+            start: Start of the range in seconds from the start of this data
+            stop: End of the range in seconds, None = end of the data
+
+        Returns:
+            segment: EEGData whose data[0] is the sample at start, first_sample holds its index in
+                     the whole recording
+        """
+        n = self.data.shape[0]
+        a = min(max(int(round(start*self.sampling_rate)), 0), n)
+        b = n if stop is None else min(max(int(round(stop*self.sampling_rate)), a), n)
+        segment = EEGData()
+        segment.bitrate = self.bitrate
+        segment.n_electrodes = self.n_electrodes
+        segment.sampling_rate = self.sampling_rate
+        segment.origin = self.origin
+        segment.standartized = self.standartized
+        segment.first_sample = self.first_sample + a
+        segment.data = self.data[a:b]
+        return segment
+
+
+def load_capture(fname, dtype=np.int16, workers=1):
+    """
+    Loads a capture file by its extension: OpenVIBE (.csv, .ovibe), raw (.dat)
+    or binary container (.psgb, memory-mapped)
+
+    Args:
+        fname: Path to the capture file
+        dtype: Type of the samples of text captures, captures with non-integer or out of
+               range values are loaded as float64 (see load_raw)
+        workers: N. of processes parsing text captures, None = n. of CPUs
+
+    Returns:
+        data: EEGData, None if the format is unknown
+    """
+    data = EEGData()
+    if fname.lower().endswith(".csv") or fname.lower().endswith(".ovibe"):
+        data.load_openvibe(fname, dtype=dtype, workers=workers)
+    elif fname.lower().endswith(".dat"):
+        data.load_raw(fname, dtype=dtype, workers=workers)
+    elif fname.lower().endswith(".psgb"):
+        data.load_bin(fname)
+    else:
+        return None
+    return data
@@ -0,0 +1,162 @@
+'''
+Incremental EEG spectral data for live recordings
+'''
+import numpy as np
+from .eeg_spectrum import EEGSpectralData, window_view, batched_periodogram
+
+class EEGRingBuffer():
+    """
+    EEGData-like buffer of the most recent samples of a live recording.
+    Samples older than the oldest one still needed are dropped when the
+    buffer fills up, so appending is amortized O(1) per sample.
+    """
+    bitrate = None
+    n_electrodes = None
+    sampling_rate = None
+    origin = None
+    standartized = None
+    n_samples = 0 #Total n. of samples appended since the start of the recording
+    first_sample = 0 #Index of the oldest retained sample since the start of the recording
+
+    def __init__(self, sampling_rate, n_electrodes=2, bitrate=10, origin=512,
+                 standartized=False, capacity=65536):
+        """
+        Args:
+            sampling_rate: Sampling rate of the recording device
+            n_electrodes: Number of electrode traces
+            bitrate: Bitrate of the recording
+            origin: Origin around which the signal is centered, usually 0 or 2^(bitrate-1)
+            standartized: False = signal range 0 to 2^bitrate, True = s. range -1 to 1
+            capacity: Initial n. of samples the buffer can hold
+        """
+        self.sampling_rate = sampling_rate
+        self.n_electrodes = n_electrodes
+        self.bitrate = bitrate
+        self.origin = origin
+        self.standartized = standartized
+        self.n_samples = 0
+        self.first_sample = 0
+        self._buf = np.zeros((capacity, n_electrodes), dtype=np.float64)
+
+    @property
+    def data(self):
+        """
+        Retained samples, row 0 is sample first_sample of the recording
+        """
+        return self._buf[:self.n_samples-self.first_sample]
+
+    def append(self, samples, keep_from=None):
+        """
+        Appends a block of samples
+
+        Args:
+            samples: Array of shape (n, n_electrodes)
+            keep_from: Index (since the start of the recording) of the oldest sample
+                       that has to be retained, None = keep everything
+        """
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, self.n_electrodes)
+        length = self.n_samples - self.first_sample
+        if length + samples.shape[0] > self._buf.shape[0]:
+            if keep_from is not None and keep_from > self.first_sample:
+                drop = min(keep_from, self.n_samples) - self.first_sample
+                self._buf[:length-drop] = self._buf[drop:length]
+                self.first_sample += drop
+                length -= drop
+            if length + samples.shape[0] > self._buf.shape[0]:
+                grown = np.zeros((max(2*self._buf.shape[0], length+samples.shape[0]),
+                                  self.n_electrodes), dtype=np.float64)
+                grown[:length] = self._buf[:length]
+                self._buf = grown
+        self._buf[length:length+samples.shape[0]] = samples
+        self.n_samples += samples.shape[0]
+
+    def sleep_duration(self):
+        """
+        Returns duration of the whole recording so far in seconds
+        """
+        return self.n_samples/self.sampling_rate
+
+class LiveSpectralData(EEGSpectralData):
+    """
+    EEG spectral data growing with a live recording. Every append computes only
+    the windows completed by the new samples, the result is the same as
+    EEGSpectralData computed over all samples appended so far.
+    """
+    buffer = None
+
+    def __init__(self, sampling_rate, n_electrodes=2, window=2048, step=1792, downsample=1,
+                 bitrate=10, origin=512, capacity=1024):
+        """
+        Args:
+            sampling_rate: Sampling rate of the recording device
+            n_electrodes: N. of electrodes to be used for computation
+            window: N. of samples in sliding window used to estiamte the power at given time point
+            step: N. of samples between individual power distribution estimations
+            downsample: Downsampling power in frequency dimension (1=no downsampling)
+            bitrate: Bitrate of the recording
+            origin: Origin around which the signal is centered, usually 0 or 2^(bitrate-1)
+            capacity: Initial n. of spectrogram columns allocated
+        """
+        EEGSpectralData.__init__(self)
+        self.sampling_rate = sampling_rate
+        self.window = window
+        self.step = step
+        self.n_electrodes = n_electrodes
+        self.downsample = downsample
+        self.estimator = "periodogram"
+        self.frequencystamps = np.arange(int(window/2)+1)/(int(window/2)) * self.sampling_rate/2
+        self.frequencystamps = self.frequencystamps[::downsample]
+        self.buffer = EEGRingBuffer(sampling_rate, n_electrodes, bitrate, origin,
+                                    capacity=2*(window+step))
+        self._n = 0
+        self._data = np.zeros((n_electrodes, capacity, len(self.frequencystamps)), dtype=np.float64)
+        self._samplestamps = np.zeros(capacity, dtype=np.int64)
+        self._timestamps = np.zeros(capacity, dtype=np.float64)
+        self._update_views()
+
+    def append(self, samples):
+        """
+        Appends a block of samples and computes the newly completed windows
+
+        Args:
+            samples: Array of shape (n, n_electrodes)
+
+        Returns:
+            n: N. of spectrogram columns added
+        """
+        #Window ending at d is computed once sample d exists, as in EEGSpectralData
+        next_end = self.window + self._n*self.step
+        self.buffer.append(samples, keep_from=next_end-self.window)
+        n_new = len(range(next_end, self.buffer.n_samples, self.step))
+        if n_new == 0:
+            return 0
+        if self._n + n_new > self._data.shape[1]:
+            self._grow(max(2*self._data.shape[1], self._n+n_new))
+        offset = next_end - self.window - self.buffer.first_sample
+        samples = self.buffer.data[offset:offset+(n_new-1)*self.step+self.window]
+        for el in range(self.n_electrodes):
+            windows = window_view(samples[:,el], self.window, self.step, n_new)
+            p = batched_periodogram(windows, self.sampling_rate)
+            self._data[el,self._n:self._n+n_new,:] = p[:,::self.downsample]
+        self._samplestamps[self._n:self._n+n_new] = np.arange(n_new)*self.step + next_end
+        self._timestamps[self._n:self._n+n_new] = self._samplestamps[self._n:self._n+n_new]/self.sampling_rate
+        self._n += n_new
+        self._update_views()
+        return n_new
+
+    def _grow(self, capacity):
+        data = np.zeros((self._data.shape[0], capacity, self._data.shape[2]), dtype=np.float64)
+        data[:,:self._n,:] = self._data[:,:self._n,:]
+        self._data = data
+        samplestamps = np.zeros(capacity, dtype=np.int64)
+        samplestamps[:self._n] = self._samplestamps[:self._n]
+        self._samplestamps = samplestamps
+        timestamps = np.zeros(capacity, dtype=np.float64)
+        timestamps[:self._n] = self._timestamps[:self._n]
+        self._timestamps = timestamps
+
+    def _update_views(self):
+        #Frequencies removed by frequency_cutoff stay removed
+        self.data = self._data[:,:self._n,:len(self.frequencystamps)]
+        self.samplestamps = self._samplestamps[:self._n]
+        self.timestamps = self._timestamps[:self._n]
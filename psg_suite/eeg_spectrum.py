@@ -3,11 +3,263 @@ Contains class representing EEG Spectral data
 '''
 import numpy as np
 import collections
-from  spectrum import *
-import matplotlib.pyplot as plt
-from . import plotting_util
+import copy
+import concurrent.futures
+import mmap
+import os
+import tempfile
+from numpy.lib.stride_tricks import as_strided
+from . import eeg_container
+from . import instrumentation
+from . import artifacts
+from .spectral_estimators import Periodogram, Decimated, get_estimator
+from . import band_features
+from . import decimation
+from .spectrogram_pyramid import LogPowerPyramid
 import pickle
-from timeit import default_timer as timer
+
+#Every PREVIEW_STRIDE-th window is computed first when the progress of a spectrogram is reported
+PREVIEW_STRIDE = 16
+
+def window_view(samples, window, step, n_windows=None):
+    """
+    Returns read-only strided view of all sliding windows of a 1D signal without copying it.
+    Row n holds samples[n*step:n*step+window], i.e. the window ending at range(window,len,step)[n]
+
+    Args:
+        samples: 1D array (may be a non-contiguous column of a 2D array)
+        window: N. of samples in a window
+        step: N. of samples between starts of consecutive windows
+        n_windows: N. of windows in the view, None = len(range(window,len(samples),step))
+    """
+    samples = np.asarray(samples)
+    if n_windows is None:
+        n_windows = len(range(window, samples.shape[0], step))
+    stride = samples.strides[0]
+    return as_strided(samples, shape=(n_windows, window),
+                      strides=(step*stride, stride), writeable=False)
+
+def batched_periodogram(windows, sampling_rate):
+    """
+    Computes speriodogram(w, detrend=False, sampling=sampling_rate) for every row w
+    of a 2D array of windows in a single vectorized FFT pass.
+
+    Args:
+        windows: 2D array of shape (n_windows, window)
+        sampling_rate: Sampling rate of the windowed signal
+
+    Returns:
+        power: 2D array of shape (n_windows, window/2+1)
+    """
+    return Periodogram()(windows, sampling_rate)
+
+def batch_size_for_budget(memory_budget, window, step, n_freqs, transforms=1):
+    """
+    Returns n. of windows that can be transformed in one batched FFT pass
+    without the working arrays exceeding the memory budget
+
+    Args:
+        memory_budget: Memory available for the working arrays in bytes
+        window: N. of samples in a window
+        step: N. of samples between consecutive windows
+        n_freqs: N. of frequencies kept per window
+        transforms: N. of FFTs per window (see SpectralEstimator.transforms_per_window)
+    """
+    #Source block, tapered windows, complex spectrum, power and its downsampled copy
+    per_window = 8*step + transforms*(8*window + 16*(window//2+1) + 8*(window//2+1)) + 8*n_freqs
+    return max(1, int(memory_budget // per_window))
+
+def spectrogram_block(source, out, el, start, stop, window, step, downsample, estimator,
+                      sampling_rate, batch_size):
+    """
+    Computes spectra of windows start:stop of one electrode into a preallocated array.
+    Source samples are read block by block (each block repeating the window-step
+    overlap of the previous one), so memory-mapped recordings are never loaded whole.
+
+    Args:
+        source: 2D array of samples (n_samples, electrodes) or decimation.DecimatedSignal
+        out: 3D output array (electrodes, windows, frequencies), frequencies beyond its
+             size are not stored
+        el: Index of the electrode
+        start, stop: Range of window indices computed, start should be a multiple of batch_size
+                     so that blocks are the same as in a single pass over all windows
+        window, step, downsample: Parameters of EEGSpectralData
+        estimator: SpectralEstimator
+        sampling_rate: Sampling rate of the source
+        batch_size: Max. n. of windows transformed in one FFT pass
+    """
+    for b in range(start, stop, batch_size):
+        nb = min(batch_size, stop-b)
+        samples = np.array(source[b*step:(b+nb-1)*step+window,el], dtype=np.float64)
+        windows = window_view(samples, window, step, nb)
+        p = estimator(windows, sampling_rate)
+        out[el,b:b+nb,:] = p[:,::downsample][:,:out.shape[2]]
+
+def unmasked_ranges(start, stop, skip, batch_size):
+    """
+    Splits window indices start:stop into ranges of windows that are not skipped, also split at
+    multiples of batch_size, so that FFT batches are parts of the batches of a single pass
+
+    Args:
+        skip: Boolean array, True for windows that are not computed, None = compute all
+
+    Returns:
+        ranges: List of (start, stop) window index ranges
+    """
+    if skip is None:
+        return [(start, stop)]
+    idx = np.arange(start, stop)
+    kept = ~skip[start:stop]
+    begin = kept & (np.r_[True, ~kept[:-1]] | (idx % batch_size == 0))
+    end = kept & (np.r_[~kept[1:], True] | ((idx + 1) % batch_size == 0))
+    return list(zip(idx[begin].tolist(), (idx[end] + 1).tolist()))
+
+def minute_ticks(duration):
+    """
+    Returns (ticks, labels): at most about 20 time ticks in seconds spaced by whole minutes
+    (5 minutes to an hour) and their labels in minutes
+
+    Args:
+        duration: Time range from 0 in seconds
+    """
+    xtickspacing = 300;
+    if len(np.arange(0,duration,300)) > 20:
+        xtickspacing = 600;
+    if len(np.arange(0,duration,600)) > 20:
+        xtickspacing = 1200;
+    if len(np.arange(0,duration,1200)) > 20:
+        xtickspacing = 1800;
+    if len(np.arange(0,duration,1800)) > 20:
+        xtickspacing = 3600;
+    xticks = np.arange(0,duration,xtickspacing)
+    return xticks, [str(int(i/60)) for i in xticks]
+
+def set_spectrogram_ticks(axes, frequencystamps, duration, column_time):
+    """
+    Sets frequency ticks and time ticks (in minutes) of a spectrogram plotted with one column per window
+
+    Args:
+        axes: matplotlib.axes.Axes of the spectrogram
+        frequencystamps: Frequencies of the rows of the plot
+        duration: Time of the last window in seconds
+        column_time: Time between consecutive windows in seconds
+    """
+    #Calculate Y axis labels
+    yticks = np.arange(0,len(frequencystamps), np.argmax(frequencystamps>5)-1)
+    yticklabels = ["{:6.2f}".format(i) for i in frequencystamps[yticks]]
+
+    #Calculate X axis labels
+    xticks, xticklabels = minute_ticks(duration)
+    xticks = xticks/column_time
+
+    axes.set_yticks(yticks)
+    axes.set_yticklabels(yticklabels)
+    axes.set_xticks(xticks)
+    axes.set_xticklabels(xticklabels)
+
+def time_partitions(n_windows, n_chunks, batch_size):
+    """
+    Splits window indices into contiguous chunks aligned to multiples of batch_size
+
+    Returns:
+        chunks: List of (start, stop) window index ranges
+    """
+    chunk = -(-n_windows // max(n_chunks, 1))
+    chunk = max(batch_size, -(-chunk // batch_size) * batch_size)
+    return [(start, min(start + chunk, n_windows)) for start in range(0, n_windows, chunk)]
+
+def _memmap_spec(array):
+    """
+    Returns (fname, offset, shape, dtype) of an array mapping a whole file region, None otherwise
+    """
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.filename:
+        return (array.filename, array.offset, array.shape, array.dtype.str)
+    return None
+
+def _spectrogram_chunk(source_spec, out_spec, el, start, stop, params, decimated=None):
+    """
+    Runs spectrogram_block in a worker process on memory-mapped source and output,
+    decimated = (q, taps) of a DecimatedSignal of the source, None = full rate source
+    """
+    source = np.memmap(source_spec[0], dtype=source_spec[3], mode='r', offset=source_spec[1],
+                       shape=source_spec[2])
+    if decimated is not None:
+        source = decimation.DecimatedSignal(source, *decimated)
+    out = np.memmap(out_spec[0], dtype=out_spec[3], mode='r+', offset=out_spec[1], shape=out_spec[2])
+    spectrogram_block(source, out, el, start, stop, *params)
+    out.flush()
+
+def parallel_spectrogram(source, out, n_electrodes, params, workers=None, pool="thread", skip=None,
+                         progress=None):
+    """
+    Computes the spectrogram of all electrodes as contiguous time chunks on a pool.
+    Every chunk reads its windows plus the window-step halo of samples and writes
+    its own rows of the output, so the result is bit-identical to a single pass.
+
+    Args:
+        source: 2D array of samples (n_samples, electrodes) or decimation.DecimatedSignal
+                (workers of a process pool decimate the shared full rate samples themselves)
+        out: Preallocated 3D output array (electrodes, windows, frequencies)
+        n_electrodes: N. of electrodes computed
+        params: (window, step, downsample, estimator, sampling_rate, batch_size)
+        workers: N. of workers, None = n. of CPUs
+        pool: "thread" shares the arrays directly, "process" shares them as memory-mapped
+              files (the arrays themselves if they are file backed, temporary copies otherwise)
+        skip: Boolean array, True for windows that are not computed, None = compute all
+        progress: Callable progress(el, start, stop) called from the calling thread when windows
+                  start:stop of electrode el are stored in out
+    """
+    if pool not in ("thread", "process"):
+        raise ValueError("Unknown pool: " + str(pool))
+    workers = os.cpu_count() if workers is None else workers
+    window, step, downsample, estimator, sampling_rate, batch_size = params
+    chunks = time_partitions(out.shape[1], 2*workers, batch_size)
+    #All electrodes of a chunk before the next chunk, so progress is reported in time order
+    tasks = [(el, a, b) for start, stop in chunks for el in range(n_electrodes)
+             for a, b in unmasked_ranges(start, stop, skip, batch_size)]
+    instrumentation.count("chunks", len(tasks))
+    if pool == "thread":
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(spectrogram_block, source, out, el, start, stop, *params)
+                       for el, start, stop in tasks]
+            for fut, task in zip(futures, tasks):
+                fut.result()
+                if progress is not None:
+                    progress(*task)
+        return
+    #RAM backed directory if available, the temporary copies are never meant to hit the disk
+    tmpdir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    decimated = None
+    if isinstance(source, decimation.DecimatedSignal):
+        #Workers decimate their own batches of the shared full rate samples
+        decimated = (source.q, source.taps)
+        source = source.samples
+    with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+        source_spec = _memmap_spec(source)
+        if source_spec is None:
+            shared = np.memmap(os.path.join(tmp, "source"), dtype=source.dtype, mode='w+', shape=source.shape)
+            shared[...] = source
+            shared.flush()
+            source_spec = _memmap_spec(shared)
+            del shared
+        out_spec = _memmap_spec(out)
+        shared_out = None
+        if out_spec is None or out.mode == 'r':
+            shared_out = np.memmap(os.path.join(tmp, "out"), dtype=out.dtype, mode='w+', shape=out.shape)
+            out_spec = _memmap_spec(shared_out)
+        else:
+            out.flush()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_spectrogram_chunk, source_spec, out_spec, el, start, stop, params, decimated)
+                       for el, start, stop in tasks]
+            for fut in futures:
+                fut.result()
+        if shared_out is not None:
+            out[...] = shared_out
+            del shared_out
+    if progress is not None:
+        for task in tasks:
+            progress(*task)
 
 class EEGSpectralData():
     """
@@ -15,15 +267,20 @@ class EEGSpectralData():
     EEG spectral data
     """
     timestamps = None
-    sapmlestamps = None
+    samplestamps = None
     frequencystamps = None
     window = None
     step = None
     n_electrodes = None
     sampling_rate = None
+    estimator = None #Description of the spectral estimator (see SpectralEstimator.describe)
+    decimation = 1 #Factor by which the signal was decimated before computing the spectra
+    first_sample = 0 #Index of sample 0 of samplestamps in the whole recording, non-zero for segments
     data = None
 
-    def __init__(self, eegdata=None, n_electrodes=2, window=2048, step=1792, downsample=1):
+    def __init__(self, eegdata=None, n_electrodes=2, window=2048, step=1792, downsample=1,
+                 mode="batched", batch_size=1024, memory_budget=None, out_fname=None, estimator=None,
+                 workers=1, pool="thread", cutoff=None, mask=None, progress=None):
         """
         Uses raw EEG data to create frequency power distribution histogram
 
@@ -33,26 +290,138 @@ class EEGSpectralData():
             window: N. of samples in sliding window used to estiamte the power at given time point
             step: N. of samples between individual power distribution estimations
             downsample: Downsampling power in frequency dimension (1=no downsampling)
+            mode: "batched" computes all windows of an electrode as strided views in
+                  vectorized FFT passes, "reference" calls speriodogram once per window
+                  (periodogram estimator only)
+            batch_size: Max. n. of FFTs (windows times segments and tapers of the estimator)
+                        computed in one pass (batched mode only)
+            memory_budget: Bytes available for working arrays, overrides batch_size (batched mode only)
+            out_fname: Path of a binary container (see eeg_container) the spectrogram is written to,
+                       data is then memory-mapped from that file instead of held in memory
+            estimator: SpectralEstimator or name from spectral_estimators.ESTIMATORS
+                       ("periodogram", "welch", "multitaper"), None = periodogram
+            workers: N. of workers computing time chunks in parallel (batched mode only),
+                     1 = single pass in the calling thread, None = n. of CPUs
+            pool: "thread" or "process" pool used when workers != 1 (see parallel_spectrogram)
+            cutoff: Frequency above which spectra are not needed, same as calling frequency_cutoff
+                    afterwards, but in batched mode the signal is low-pass filtered and decimated
+                    (see decimation) so that only the kept frequencies are computed.
+                    The frequency resolution is unchanged, self.decimation holds the factor.
+            mask: Array of sorted, disjoint [start, end) times in seconds (e.g. from
+                  artifacts.detect_artifacts), windows centred in them are not computed
+                  and hold NaN
+            progress: Callable progress(spectral, el, start, stop, stride) called from the computing
+                      thread when windows start:stop:stride of electrode el are stored in
+                      spectral.data (batched mode only). A preview of every PREVIEW_STRIDE-th
+                      window is computed first, then the windows are computed in time order.
         """
         if eegdata is None:
             return
+        if mode not in ("batched", "reference"):
+            raise ValueError("Unknown spectral mode: " + str(mode))
+        estimator = get_estimator(estimator)
+        if mode == "reference" and not isinstance(estimator, Periodogram):
+            raise ValueError("Reference mode supports only the periodogram estimator")
         self.sampling_rate = eegdata.sampling_rate
+        self.estimator = estimator.describe()
+        self.window = window
         self.step =step
-        self.frequencystamps = np.arange(int(window/2)+1)/(int(window/2)) * self.sampling_rate/2
-        self.frequencystamps = self.frequencystamps[::downsample]
-        self.data = np.zeros((n_electrodes,len(range(window,eegdata.data.shape[0],step)),len(self.frequencystamps)),dtype=np.float)
-        for el in range(n_electrodes):
-            n = 0;
-            for d in range(window,eegdata.data.shape[0],step):
-                w = eegdata.data[(d-window):d,el]
-                w = w.flatten()
-                p = speriodogram(w, detrend=False, sampling=eegdata.sampling_rate)
-                self.data[el,n,:]=p[::downsample]
-                n+=1
+        self.n_electrodes = n_electrodes
+        self.first_sample = getattr(eegdata, "first_sample", 0)
+        q = 1
+        if cutoff is not None and mode == "batched":
+            q = decimation.decimation_factor(self.sampling_rate, cutoff, window, step)
+        self.decimation = q
+        rate_estimator = Decimated(estimator, q) if q > 1 else estimator
+        rate = self.sampling_rate/q
+        self.frequencystamps = rate_estimator.frequencies(window//q, rate)[::downsample]
+        if cutoff is not None:
+            self.frequencystamps = self.frequencystamps[:np.searchsorted(self.frequencystamps, cutoff, side="right")]
         self.samplestamps = np.arange(window,eegdata.data.shape[0],step);
         self.timestamps = self.samplestamps/self.sampling_rate
+        shape = (n_electrodes,len(self.samplestamps),len(self.frequencystamps))
+        if out_fname is None:
+            self.data = np.zeros(shape,dtype=np.float64)
+        else:
+            arrays = self._container_arrays()
+            del arrays["data"]
+            self.data = eeg_container.allocate_container(out_fname, "EEGSpectralData",
+                                                         self._container_attrs(), arrays,
+                                                         {"data": (shape, np.float64)})["data"]
+        skip = None
+        n_masked = 0
+        if mask is not None:
+            skip = artifacts.masked_windows(self.samplestamps, window, self.sampling_rate, mask)
+            n_masked = int(np.sum(skip))
+            self.data[:,skip,:] = np.nan
+        transforms = rate_estimator.transforms_per_window(window//q, rate)
+        if memory_budget is not None:
+            batch_size = batch_size_for_budget(memory_budget, window//q, step//q, shape[2], transforms)
+        else:
+            batch_size = max(1, batch_size // transforms)
+        with instrumentation.span("EEGSpectralData." + mode):
+            instrumentation.add_bytes(n_electrodes*eegdata.data.shape[0]*eegdata.data.itemsize)
+            instrumentation.count("windows", n_electrodes*(shape[1] - n_masked))
+            source = eegdata.data
+            if q > 1:
+                #The sqrt(q) gain keeps the power at the level of the full rate spectra.
+                #Batches are decimated when they are read, so memory stays within the budget.
+                taps = decimation.lowpass_taps(self.sampling_rate, q, cutoff) * np.sqrt(q)
+                source = decimation.DecimatedSignal(eegdata.data, q, taps)
+            params = (window//q, step//q, downsample, rate_estimator, rate, batch_size)
+            if mode == "batched" and progress is not None:
+                self._preview(source, n_electrodes, skip, params, progress)
+            if mode == "batched" and workers != 1:
+                parallel_spectrogram(source, self.data, n_electrodes, params, workers, pool, skip,
+                                     None if progress is None else
+                                     lambda el, start, stop: progress(self, el, start, stop, 1))
+            elif mode == "batched" and progress is not None:
+                #Chunks of one batch, all electrodes of a chunk are reported before the next one
+                for start, stop in time_partitions(shape[1], -(-shape[1] // batch_size), batch_size):
+                    for el in range(n_electrodes):
+                        for a, b in unmasked_ranges(start, stop, skip, batch_size):
+                            spectrogram_block(source, self.data, el, a, b, *params)
+                        progress(self, el, start, stop, 1)
+            elif mode == "batched":
+                for el in range(n_electrodes):
+                    for start, stop in unmasked_ranges(0, shape[1], skip, batch_size):
+                        spectrogram_block(source, self.data, el, start, stop, *params)
+            else:
+                from spectrum import speriodogram
+                for el in range(n_electrodes):
+                    n = 0;
+                    for d in range(window,eegdata.data.shape[0],step):
+                        if skip is not None and skip[n]:
+                            n+=1
+                            continue
+                        w = eegdata.data[(d-window):d,el]
+                        w = w.flatten()
+                        p = speriodogram(w, detrend=False, sampling=eegdata.sampling_rate)
+                        self.data[el,n,:]=p[::downsample][:shape[2]]
+                        n+=1
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
 
 
+    def _preview(self, source, n_electrodes, skip, params, progress, stride=None):
+        """
+        Computes every stride-th window of all electrodes, they are computed again
+        (with the same result) by the full pass
+        """
+        stride = PREVIEW_STRIDE if stride is None else stride
+        window, step, downsample, estimator, sampling_rate, batch_size = params
+        #Batches span as many samples as full pass batches
+        batch_size = max(1, batch_size // stride)
+        out = self.data[:,::stride,:]
+        with instrumentation.span("preview"):
+            for el in range(n_electrodes):
+                for start, stop in unmasked_ranges(0, out.shape[1], None if skip is None else skip[::stride],
+                                                   batch_size):
+                    spectrogram_block(source, out, el, start, stop, window, step*stride, downsample,
+                                      estimator, sampling_rate, batch_size)
+                    progress(self, el, start*stride, (stop - 1)*stride + 1, stride)
+
+    @instrumentation.timed("EEGSpectralData.frequency_cutoff")
     def frequency_cutoff(self,cutoff = 45):
         """
         Reduces the histogram data by cutting off frequencies higher than specifed frequency
@@ -60,10 +429,24 @@ class EEGSpectralData():
         Args:
             cutoff: freqency above which the histogram data will be removed
         """
-        ci = np.argmax(self.frequencystamps>cutoff)
+        ci = np.searchsorted(self.frequencystamps, cutoff, side="right")
         self.data = self.data[:,:,:ci]
         self.frequencystamps = self.frequencystamps[:ci]
         
+    @instrumentation.timed("EEGSpectralData.band_features")
+    def band_features(self, epoch_length=band_features.EPOCH_LENGTH, bands=band_features.BANDS,
+                      ratios=band_features.RATIOS):
+        """
+        Returns columnar table of mean band powers and their ratios per epoch (see band_features.epoch_band_features)
+
+        Args:
+            epoch_length: Length of an epoch in seconds
+            bands: Dictionary mapping band name to [low, high) frequency range
+            ratios: Dictionary mapping ratio name to (numerator bands, denominator bands)
+        """
+        return band_features.epoch_band_features(self, epoch_length, bands, ratios)
+
+    @instrumentation.timed("EEGSpectralData.plot")
     def plot(self, elid=0, colormap="parula", vmin=None, vmax=None, xlabels=True, axes=None, title="EEG Spectrogram", figsize=(15,7), blocking=False):
         """
         Plots sperctrogram into an axes provided for desired electrode.
@@ -79,46 +462,31 @@ class EEGSpectralData():
             figsize: Size of the figure when plotting standalone (axes=None)
             blocking: True to block program execution, false to continue when plotting standalone (axes=None)
         """
-        #Log histogram for better visual interpretation
-        log_hist=np.log(self.data[elid,:,:])
+        #Plotting modules are imported on first use, so computing spectrograms needs no display,
+        #pyplot only when plotting standalone, so figures can be rendered without its global state
+        from . import plotting_util
+
+        #Log histogram for better visual interpretation, precomputed at several time resolutions
+        pyramid = self.log_pyramid(elid)
 
         #Determine vmin/vmax values
         if vmin is None:
-            vmin = np.min(log_hist)+0.43*np.ptp(log_hist)
+            vmin = pyramid.vmin
         if vmax is None:
-            vmax = np.max(log_hist)-0.03*np.ptp(log_hist)
+            vmax = pyramid.vmax
 
         if axes is None:
+            import matplotlib.pyplot as plt
             fig=plt.figure(figsize=figsize)
             plt.title(title)
             axes = fig.axes[0]
 
-        #Calculate Y axis labels
-        yticks = np.arange(0,len(self.frequencystamps), np.argmax(self.frequencystamps>5)-1)
-        yticklabels = ["{:6.2f}".format(i) for i in self.frequencystamps[yticks]]
-
-        #Calculate X axis labels
-        sleep_dur = self.timestamps[-1]
-        xtickspacing = 300;
-        if len(np.arange(0,sleep_dur,300)) > 20:
-            xtickspacing = 600;
-        if len(np.arange(0,sleep_dur,600)) > 20:
-            xtickspacing = 1200;
-        if len(np.arange(0,sleep_dur,1200)) > 20:
-            xtickspacing = 1800;
-        if len(np.arange(0,sleep_dur,1800)) > 20:
-            xtickspacing = 3600;
-        xticks = np.arange(0,sleep_dur,xtickspacing)
-        xticklabels = [str(int(i/60)) for i in xticks]
-        xticks = xticks/(self.step/self.sampling_rate)
-
         #Plot the histogram
-        axes.set_yticks(yticks)
-        axes.set_yticklabels(yticklabels)
-        axes.set_xticks(xticks)
-        axes.set_xticklabels(xticklabels)
-        axes.imshow(np.transpose(log_hist), origin="lower", aspect="auto", 
-                cmap=plotting_util.colormap(colormap), interpolation="none",vmin=vmin,vmax=vmax)
+        set_spectrogram_ticks(axes, self.frequencystamps, self.timestamps[-1], self.step/self.sampling_rate)
+        image = axes.imshow(np.transpose(pyramid.levels[0]), origin="lower", aspect="auto",
+                cmap=plotting_util.colormap(colormap), interpolation="none",vmin=vmin,vmax=vmax,
+                extent=pyramid.extent(0))
+        pyramid.attach(axes, image)
         axes.set_ylabel("Frequency (Hz)")
         if xlabels:
             axes.set_xlabel("Time (min)")
@@ -130,6 +498,21 @@ class EEGSpectralData():
                 plt.draw()
 
 
+    @instrumentation.timed("EEGSpectralData.log_pyramid")
+    def log_pyramid(self, elid=0):
+        """
+        Returns log power pyramid (see spectrogram_pyramid) of an electrode,
+        it is computed once and reused until data is replaced
+
+        Args:
+            elid: Index of the electrode
+        """
+        if getattr(self, "_pyramids", None) is None or self._pyramids[0] is not self.data:
+            self._pyramids = (self.data, {})
+        if elid not in self._pyramids[1]:
+            self._pyramids[1][elid] = LogPowerPyramid(self.data[elid,:,:])
+        return self._pyramids[1][elid]
+
     def index_to_time(self, index):
         """
         Transforms index to time in seconds.
@@ -142,6 +525,40 @@ class EEGSpectralData():
         """
         return index*self.step/self.sampling_rate
 
+    def start_time(self):
+        """
+        Returns time of sample 0 of samplestamps in the whole recording in seconds
+        """
+        return self.first_sample/self.sampling_rate
+
+    def segment(self, start, stop=None):
+        """
+        Returns spectral data of the windows lying wholly in a time range, sharing the power
+        data of this one (a view, also of memory-mapped data). Stamps are shifted to start at the
+        first window, so the result equals a spectrogram computed from
+        EEGData.segment(start, stop) whenever start is a multiple of the step.
+
+        Args:
+            start: Start of the range in seconds from sample 0 of samplestamps
+            stop: End of the range in seconds, None = end of the data
+
+        Returns:
+            segment: EEGSpectralData, first_sample holds the index of its sample 0 in the whole recording
+        """
+        a = int(round(start*self.sampling_rate))
+        k0 = np.searchsorted(self.samplestamps, a + self.window)
+        k1 = len(self.samplestamps) if stop is None else \
+            max(k0, np.searchsorted(self.samplestamps, int(round(stop*self.sampling_rate))))
+        offset = self.samplestamps[k0] - self.window if k0 < len(self.samplestamps) else a
+        segment = copy.copy(self)
+        segment._pyramids = None
+        segment.first_sample = self.first_sample + int(offset)
+        segment.samplestamps = self.samplestamps[k0:k1] - offset
+        segment.timestamps = segment.samplestamps/self.sampling_rate
+        segment.data = self.data[:,k0:k1,:]
+        return segment
+
+    @instrumentation.timed("EEGSpectralData.load_pkl")
     def load_pkl(self, fname):
         """
         Loads EEG spectral data data from pickle file
@@ -149,20 +566,41 @@ class EEGSpectralData():
         Args:
             fname: Path to file to be loaded
         """
-        start = timer()
         with open(fname,'rb') as f:
+            instrumentation.add_bytes(os.fstat(f.fileno()).st_size)
             ld = pickle.load(f)
             self.timestamps = ld.timestamps
             self.samplestamps = ld.samplestamps
-            self.frequencystmps = ld.frequencystamps
-            self.window = ld.window
-            self.step = ld.step
-            self.n_electrodes = ld.n_electrodes
+            self.frequencystamps = ld.frequencystamps
+            self.window = getattr(ld, "window", None)
+            self.step = getattr(ld, "step", None)
+            self.n_electrodes = getattr(ld, "n_electrodes", None)
             self.sampling_rate = ld.sampling_rate
+            self.estimator = getattr(ld, "estimator", "periodogram")
+            self.decimation = getattr(ld, "decimation", 1)
+            self.first_sample = getattr(ld, "first_sample", 0)
             self.data = ld.data
-        end = timer()
-        print(fname + " unpickled in " + str(end - start))
+        self.migrate_legacy_attrs()
 
+    def migrate_legacy_attrs(self):
+        """
+        Derives the attributes missing in spectral data saved before they were stored:
+        n_electrodes from the power data, window from the spacing of the rfft frequency
+        grid (sampling_rate/window, the grid may be cut off), step from the samplestamps
+        """
+        if self.n_electrodes is None and self.data is not None:
+            self.n_electrodes = self.data.shape[0]
+        freqs = self.frequencystamps
+        if self.window is None and freqs is not None and len(freqs) > 1:
+            if self.sampling_rate:
+                self.window = int(round(self.sampling_rate/(freqs[1] - freqs[0])))
+            else:
+                #Uncut grid from 0 to the Nyquist frequency
+                self.window = 2*(len(freqs) - 1)
+        if self.step is None and self.samplestamps is not None and len(self.samplestamps) > 1:
+            self.step = int(self.samplestamps[1] - self.samplestamps[0])
+
+    @instrumentation.timed("EEGSpectralData.save_pkl")
     def save_pkl(self, fname):
         """
         Saves EEG spectral data data to pickle file
@@ -173,4 +611,56 @@ class EEGSpectralData():
         with open(fname,'wb') as f:
             pickle.dump(self,f)
 
+    @instrumentation.timed("EEGSpectralData.load_bin")
+    def load_bin(self, fname, mode='r'):
+        """
+        Opens EEG spectral data from native binary container (see eeg_container),
+        the power data is memory-mapped instead of being read into memory
+
+        Args:
+            fname: Path to file to be loaded
+            mode: np.memmap mode, 'r' = read only, 'c' = copy on write, 'r+' = write through
+        """
+        attrs, arrays = eeg_container.load_container(fname, "EEGSpectralData", mode)
+        self.window = attrs["window"]
+        self.step = attrs["step"]
+        self.n_electrodes = attrs["n_electrodes"]
+        self.sampling_rate = attrs["sampling_rate"]
+        self.estimator = attrs.get("estimator", "periodogram")
+        self.decimation = attrs.get("decimation", 1)
+        self.first_sample = attrs.get("first_sample", 0)
+        self.timestamps = arrays.get("timestamps")
+        self.samplestamps = arrays.get("samplestamps")
+        self.frequencystamps = arrays.get("frequencystamps")
+        self.data = arrays["data"]
+        self.migrate_legacy_attrs()
+
+    @instrumentation.timed("EEGSpectralData.save_bin")
+    def save_bin(self, fname, attrs=None):
+        """
+        Saves EEG spectral data to native binary container (see eeg_container)
+
+        Args:
+            fname: Path to file to be saved
+            attrs: Dictionary of extra scalar attributes stored in the header
+        """
+        header_attrs = self._container_attrs()
+        if attrs is not None:
+            header_attrs.update(attrs)
+        eeg_container.save_container(fname, "EEGSpectralData",
+                                     header_attrs, self._container_arrays())
+
+    def _container_attrs(self):
+        return {"window": self.window,
+                "step": self.step,
+                "n_electrodes": self.n_electrodes,
+                "sampling_rate": self.sampling_rate,
+                "estimator": self.estimator,
+                "decimation": self.decimation,
+                "first_sample": self.first_sample}
 
+    def _container_arrays(self):
+        return {"data": self.data,
+                "frequencystamps": self.frequencystamps,
+                "samplestamps": self.samplestamps,
+                "timestamps": self.timestamps}
@@ -0,0 +1,177 @@
+'''
+Lightweight pipeline instrumentation
+
+Functions decorated with timed() and blocks wrapped in span() are recorded as
+named spans (nested spans are named by their path, e.g. "open/load/EEGData.load_raw")
+together with counters and bytes processed reported from inside them by count()
+and add_bytes(). Memory is tracked by the process-wide peak resident memory
+(ru_maxrss): a span records how much it raised that peak and the process peak
+when it last closed, not the peak of its own allocations. Nothing is recorded until enable() is called; while disabled
+every hook returns right after checking one module global.
+'''
+import functools
+import json
+import sys
+import threading
+from timeit import default_timer as timer
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_profiler = None
+
+class _NullSpan():
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = _NullSpan()
+
+def _peak_rss():
+    """
+    Returns peak resident memory of the process in bytes, None if unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak*1024
+
+class Profiler():
+    """
+    Collects span statistics, every thread has its own stack of active spans
+    (spans of background threads start at the top level)
+    """
+    def __init__(self):
+        self.stats = {}
+        self._local = threading.local()
+        self.start = timer()
+
+    @property
+    def stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _stat(self, path):
+        #peak_rss_increase_bytes: Max. rise of the process peak during a call of the span,
+        #process_peak_rss_bytes: Process peak when the span last closed, includes earlier spans
+        return self.stats.setdefault(path, {"calls": 0, "seconds": 0.0, "bytes": 0, "counters": {},
+                                            "peak_rss_increase_bytes": None,
+                                            "process_peak_rss_bytes": None})
+
+    def push(self, name):
+        self.stack.append(name)
+        return timer(), _peak_rss()
+
+    def pop(self, start):
+        start_time, start_rss = start
+        stat = self._stat("/".join(self.stack))
+        stat["calls"] += 1
+        stat["seconds"] += timer() - start_time
+        rss = _peak_rss()
+        if rss is not None:
+            stat["peak_rss_increase_bytes"] = max(stat["peak_rss_increase_bytes"] or 0, rss - start_rss)
+        stat["process_peak_rss_bytes"] = rss
+        self.stack.pop()
+
+    def current(self):
+        return self._stat("/".join(self.stack))
+
+    def report(self):
+        """
+        Returns dictionary with total run time, process peak memory and statistics of all spans
+        """
+        return {"seconds": timer() - self.start, "process_peak_rss_bytes": _peak_rss(),
+                "spans": self.stats}
+
+class _Span():
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+    def __enter__(self):
+        self.start = self.profiler.push(self.name)
+        return self
+    def __exit__(self, *exc):
+        self.profiler.pop(self.start)
+        return False
+
+def enable():
+    """
+    Starts recording, discarding previously recorded spans
+    """
+    global _profiler
+    _profiler = Profiler()
+
+def disable():
+    """
+    Stops recording
+
+    Returns:
+        report: Report of the recorded spans (see Profiler.report), None if recording was not enabled
+    """
+    global _profiler
+    report = None if _profiler is None else _profiler.report()
+    _profiler = None
+    return report
+
+def enabled():
+    return _profiler is not None
+
+def span(name):
+    """
+    Returns context manager recording the enclosed block as a span
+    """
+    if _profiler is None:
+        return NULL_SPAN
+    return _Span(_profiler, name)
+
+def timed(name):
+    """
+    Decorator recording every call of a function as a span
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return fn(*args, **kwargs)
+            with _Span(_profiler, name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    """
+    Adds n to a named counter of the innermost active span
+    """
+    if _profiler is None:
+        return
+    counters = _profiler.current()["counters"]
+    counters[name] = counters.get(name, 0) + n
+
+def add_bytes(n):
+    """
+    Adds n to the bytes processed by the innermost active span
+    """
+    if _profiler is None:
+        return
+    _profiler.current()["bytes"] += n
+
+def write_report(fname=None):
+    """
+    Writes report of the recorded spans as JSON
+
+    Args:
+        fname: Path to the report file, None or "-" = standard output
+    """
+    if _profiler is None:
+        return
+    report = _profiler.report()
+    if fname is None or fname == "-":
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    else:
+        with open(fname, "w") as f:
+            json.dump(report, f, indent=1)
@@ -0,0 +1,334 @@
+'''
+Contains a columnar corpus of the sleep stage labels of many nights
+
+Segments of all nights are kept in flat columns (start time, label, duration and
+night of every segment) and nights in per-night columns (path, mtime, name, sleep
+block, date, sleep length and offset of their first segment). Aggregate queries
+over thousands of nights are then a few vectorized numpy operations instead of
+parsing every .stages file. The corpus is saved as a binary container (see
+eeg_container) and ingest re-reads only .stages files whose mtime changed.
+'''
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import warnings
+import numpy as np
+from . import eeg_container
+from . import instrumentation
+from .sleep_stage_label import SleepStageLabel
+from .stage_timeline import SLEEP_STAGE_LABELS
+
+KIND = "LabelCorpus"
+STAGES_SUFFIX = ".stages"
+#String columns of the nights, indexed for select()
+METADATA = ("name", "sleep_block", "date")
+#Stages whose first occurrence marks sleep onset
+SLEEP_STAGES = ("NREM1", "NREM2", "NREM3", "REM")
+
+def label_index(stage):
+    """
+    Returns label value of a stage given by name from SLEEP_STAGE_LABELS or by value
+    """
+    if isinstance(stage, str):
+        return SLEEP_STAGE_LABELS.index(stage)
+    return int(stage)
+
+def read_stages(fname):
+    """
+    Reads a .stages file written by SleepStageLabel.save_txt
+
+    Returns:
+        (night, times, labels): Dictionary of the night metadata, segment start times and labels
+    """
+    labels = SleepStageLabel(None, None, None, None)
+    labels.load_txt(fname)
+    values = labels.loaded_stage_labels
+    if len(values) and (values.min() < 0 or values.max() >= len(SLEEP_STAGE_LABELS)):
+        raise ValueError("Invalid stage label in " + fname)
+    night = {"name": labels.name, "sleep_block": labels.sleep_block, "date": labels.date,
+             "sleep_length": labels.sleep_length}
+    return night, labels.loaded_stage_times, values
+
+def drop_closing_segments(columns):
+    """
+    Removes segments starting at or after the end of their night from the segment columns,
+    e.g. the zero-length [sleep_length, 6] segment label_manual adds before save_txt
+
+    Args:
+        columns: Dictionary with the "offsets", "times", "labels" and "sleep_lengths" columns,
+                 updated in place
+
+    Returns:
+        columns: The updated dictionary
+    """
+    counts = np.diff(columns["offsets"])
+    night = np.repeat(np.arange(len(counts)), counts)
+    keep = columns["times"] < columns["sleep_lengths"][night]
+    if not np.all(keep):
+        columns["times"] = columns["times"][keep]
+        columns["labels"] = columns["labels"][keep]
+        columns["offsets"] = np.r_[0, np.cumsum(np.bincount(night[keep], minlength=len(counts)),
+                                                dtype=np.int64)]
+    return columns
+
+class LabelCorpus():
+    """
+    Sleep stage labels of many nights stored column-wise
+    """
+    fname = None #Path to the saved corpus, None = not saved
+    paths = None #Absolute paths of the .stages files, one per night
+    mtimes = None #Modification times of the .stages files in ns when they were read
+    name = None #Name, sleep block and date of every night
+    sleep_block = None
+    date = None
+    sleep_lengths = None #Length of every night in seconds
+    offsets = None #Segments of night i are offsets[i]:offsets[i+1]
+    times = None #Start times of all segments
+    labels = None #Labels of all segments (indices into SLEEP_STAGE_LABELS)
+    durations = None #Durations of all segments
+    night = None #Night of every segment
+
+    def __init__(self, fname=None):
+        """
+        Opens a saved corpus, or creates an empty one
+
+        Args:
+            fname: Path to the corpus file, loaded if it exists, None = keep the corpus in memory only
+        """
+        self.fname = fname
+        self._set_columns({"paths": np.array([], dtype=str), "mtimes": np.zeros(0, dtype=np.int64),
+                           "name": np.array([], dtype=str), "sleep_block": np.array([], dtype=str),
+                           "date": np.array([], dtype=str), "sleep_lengths": np.zeros(0),
+                           "offsets": np.zeros(1, dtype=np.int64), "times": np.zeros(0),
+                           "labels": np.zeros(0, dtype=np.int8)})
+        if fname is not None and os.path.isfile(fname):
+            self.load(fname)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _set_columns(self, columns):
+        """
+        Replaces all stored columns and updates the derived ones and the metadata indexes
+        """
+        for name, column in columns.items():
+            setattr(self, name, column)
+        counts = np.diff(self.offsets)
+        self.night = np.repeat(np.arange(len(self.paths)), counts)
+        ends = np.empty(len(self.times))
+        ends[:-1] = self.times[1:]
+        #Last segment of a night ends at its sleep length
+        ends[self.offsets[1:][counts > 0] - 1] = self.sleep_lengths[counts > 0]
+        self.durations = ends - self.times
+        self._indexes = {}
+
+    def _columns(self):
+        return {name: getattr(self, name) for name in ("paths", "mtimes", "name", "sleep_block", "date",
+                                                       "sleep_lengths", "offsets", "times", "labels")}
+
+    @instrumentation.timed("LabelCorpus.ingest")
+    def ingest(self, directory):
+        """
+        Synchronizes the corpus with all .stages files in a directory tree. New files and
+        files whose mtime changed are read, nights of removed files are dropped and
+        unreadable files are skipped with a warning (and retried by the next ingest).
+        Segments starting at the end of a night are not kept (see drop_closing_segments).
+
+        Args:
+            directory: Path to the directory
+
+        Returns:
+            n_read: N. of files read
+        """
+        directory = os.path.abspath(directory)
+        found = {}
+        for root, dirs, files in os.walk(directory):
+            for f in files:
+                if f.endswith(STAGES_SUFFIX):
+                    path = os.path.join(root, f)
+                    found[path] = os.stat(path).st_mtime_ns
+        inside = [p == directory or p.startswith(directory + os.sep) for p in self.paths.tolist()]
+        keep = [i for i, p in enumerate(self.paths.tolist())
+                if not inside[i] or found.get(p) == self.mtimes[i]]
+        kept = set(self.paths[keep].tolist())
+        nights = [(self.paths[i], self.mtimes[i],
+                   {"name": self.name[i], "sleep_block": self.sleep_block[i], "date": self.date[i],
+                    "sleep_length": self.sleep_lengths[i]},
+                   self.times[self.offsets[i]:self.offsets[i+1]],
+                   self.labels[self.offsets[i]:self.offsets[i+1]]) for i in keep]
+        n_read = 0
+        for path in sorted(found):
+            if path in kept:
+                continue
+            try:
+                night, times, labels = read_stages(path)
+            except (IOError, OSError, ValueError, IndexError) as e:
+                warnings.warn("Skipping " + path + ": " + str(e))
+                continue
+            nights.append((path, found[path], night, times, labels))
+            n_read += 1
+        instrumentation.count("files", n_read)
+        nights.sort(key=lambda n: n[0])
+        self._set_columns(drop_closing_segments({
+            "paths": np.array([n[0] for n in nights], dtype=str),
+            "mtimes": np.array([n[1] for n in nights], dtype=np.int64),
+            "name": np.array([str(n[2]["name"]) for n in nights], dtype=str),
+            "sleep_block": np.array([str(n[2]["sleep_block"]) for n in nights], dtype=str),
+            "date": np.array([str(n[2]["date"]) for n in nights], dtype=str),
+            "sleep_lengths": np.array([n[2]["sleep_length"] for n in nights], dtype=np.float64),
+            "offsets": np.r_[0, np.cumsum([len(n[3]) for n in nights], dtype=np.int64)],
+            "times": np.concatenate([np.zeros(0)] + [n[3] for n in nights]).astype(np.float64),
+            "labels": np.concatenate([np.zeros(0, dtype=np.int8)] + [n[4] for n in nights]).astype(np.int8)}))
+        return n_read
+
+    @instrumentation.timed("LabelCorpus.save")
+    def save(self, fname=None):
+        """
+        Saves the corpus atomically
+
+        Args:
+            fname: Path to the corpus file, None = the file it was opened with
+        """
+        fname = self.fname if fname is None else fname
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(fname)))
+        os.close(fd)
+        try:
+            eeg_container.save_container(tmp, KIND, {"n_nights": len(self)}, self._columns())
+            os.replace(tmp, fname)
+        except Exception:
+            os.remove(tmp)
+            raise
+        self.fname = fname
+
+    @instrumentation.timed("LabelCorpus.load")
+    def load(self, fname):
+        """
+        Loads a saved corpus
+
+        Args:
+            fname: Path to the corpus file
+        """
+        attrs, arrays = eeg_container.load_container(fname, KIND)
+        #Copies, so the file can be replaced by save() while the corpus is open,
+        #corpora saved before closing segments were dropped still hold them
+        self._set_columns(drop_closing_segments({name: np.array(arr) for name, arr in arrays.items()}))
+        self.fname = fname
+
+    def index(self, field):
+        """
+        Returns dictionary mapping every value of a metadata column to the indices of its nights
+
+        Args:
+            field: Name from METADATA
+        """
+        if field not in self._indexes:
+            values, inverse = np.unique(getattr(self, field), return_inverse=True)
+            order = np.argsort(inverse, kind="stable")
+            splits = np.cumsum(np.bincount(inverse, minlength=len(values)))[:-1]
+            self._indexes[field] = dict(zip(values.tolist(), np.split(order, splits)))
+        return self._indexes[field]
+
+    def select(self, name=None, sleep_block=None, date=None, date_from=None, date_to=None, last=None):
+        """
+        Returns indices of the nights matching all given metadata, ordered by date and path
+
+        Args:
+            name, sleep_block, date: Required values of the metadata columns, None = any
+            date_from, date_to: Inclusive range of dates (compared as strings, e.g. ISO dates)
+            last: N. of latest nights returned, None = all
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for field, value in (("name", name), ("sleep_block", sleep_block), ("date", date)):
+            if value is not None:
+                match = np.zeros(len(self), dtype=bool)
+                match[self.index(field).get(value, [])] = True
+                mask &= match
+        if date_from is not None:
+            mask &= self.date >= date_from
+        if date_to is not None:
+            mask &= self.date <= date_to
+        nights = np.flatnonzero(mask)
+        nights = nights[np.argsort(self.date[nights], kind="stable")]
+        if last is not None:
+            nights = nights[max(len(nights) - last, 0):]
+        return nights
+
+    def stage_durations(self, nights=None):
+        """
+        Returns total time per stage of every night
+
+        Args:
+            nights: Indices of the nights (e.g. from select), None = all
+
+        Returns:
+            durations: Array of shape (nights, stages) in seconds, stages indexed like SLEEP_STAGE_LABELS
+        """
+        n_stages = len(SLEEP_STAGE_LABELS)
+        totals = np.bincount(self.night*n_stages + self.labels, weights=self.durations,
+                             minlength=len(self)*n_stages).reshape(len(self), n_stages)
+        return totals if nights is None else totals[nights]
+
+    def latencies(self, stages=SLEEP_STAGES, nights=None):
+        """
+        Returns start time of the first segment labelled with one of the stages in every night
+
+        Args:
+            stages: Stage names or labels, the default gives sleep onset latency
+            nights: Indices of the nights, None = all
+
+        Returns:
+            latencies: Array of times in seconds, NaN for nights without these stages
+        """
+        wanted = np.zeros(len(SLEEP_STAGE_LABELS), dtype=bool)
+        wanted[[label_index(s) for s in stages]] = True
+        first = np.flatnonzero(wanted[self.labels])
+        first = first[np.r_[True, self.night[first][1:] != self.night[first][:-1]]] if len(first) else first
+        latencies = np.full(len(self), np.nan)
+        latencies[self.night[first]] = self.times[first]
+        return latencies if nights is None else latencies[nights]
+
+    def transition_counts(self, nights=None):
+        """
+        Counts changes of the stage between consecutive segments of the same night
+
+        Args:
+            nights: Indices of the nights, None = all
+
+        Returns:
+            counts: Array of shape (stages, stages), counts[a, b] = n. of transitions from a to b
+        """
+        n_stages = len(SLEEP_STAGE_LABELS)
+        keep = (self.night[1:] == self.night[:-1]) & (self.labels[1:] != self.labels[:-1])
+        if nights is not None:
+            selected = np.zeros(len(self), dtype=bool)
+            selected[nights] = True
+            keep &= selected[self.night[1:]]
+        pairs = self.labels[:-1][keep].astype(np.int64)*n_stages + self.labels[1:][keep]
+        return np.bincount(pairs, minlength=n_stages*n_stages).reshape(n_stages, n_stages)
+
+def mf():
+    parser = argparse.ArgumentParser(description="Ingests .stages files and prints per-night stage durations")
+    parser.add_argument("directory", help="Directory tree with .stages files")
+    parser.add_argument("--corpus", default=None, help="Corpus file (default: <directory>/labels.psgb)")
+    parser.add_argument("--name", default=None, help="Only nights with this name")
+    parser.add_argument("--sleep-block", default=None, help="Only nights of this sleep block (e.g. c1)")
+    parser.add_argument("--last", type=int, default=None, help="Only the latest N nights")
+    args = parser.parse_args()
+    corpus = LabelCorpus(args.corpus or os.path.join(args.directory, "labels.psgb"))
+    n_read = corpus.ingest(args.directory)
+    corpus.save()
+    print("Read %d of %d .stages files" % (n_read, len(corpus)), file=sys.stderr)
+    nights = corpus.select(name=args.name, sleep_block=args.sleep_block, last=args.last)
+    durations = corpus.stage_durations(nights)/60
+    latencies = corpus.latencies(nights=nights)/60
+    wr = csv.writer(sys.stdout, delimiter=',', lineterminator='\n')
+    wr.writerow(["path", "name", "sleep_block", "date"] + [l + "_min" for l in SLEEP_STAGE_LABELS] +
+                ["sleep_latency_min"])
+    for row, i in enumerate(nights):
+        wr.writerow([corpus.paths[i], corpus.name[i], corpus.sleep_block[i], corpus.date[i]] +
+                    durations[row].tolist() + [latencies[row]])
+
+if __name__ == '__main__':
+    mf()
@@ -0,0 +1,212 @@
+'''
+Contains spectrogram computed in a background thread and plotted while it is computed
+
+The computing thread reports finished window ranges (see the progress argument of
+EEGSpectralData) through a queue. A GUI timer drains the queue, so all plotting
+happens in the GUI thread. Every PREVIEW_STRIDE-th window arrives first and is
+shown stretched over its neighbours, the columns are then replaced by the full
+resolution ones in time order. When the computation finishes, the plots switch
+to the log power pyramid of the result (see spectrogram_pyramid).
+'''
+import queue
+import threading
+import numpy as np
+from .eeg_spectrum import set_spectrogram_ticks
+
+class ProgressiveSpectrogram():
+    """
+    Stands in for EEGSpectralData in SleepStageLabel.label_manual while the
+    spectrogram is computed, result holds the EEGSpectralData when done
+    """
+    result = None
+    error = None
+
+    def __init__(self, compute, step, sampling_rate, cutoff=None, interval=200):
+        """
+        Args:
+            compute: Function compute(progress) returning EEGSpectralData, progress has to be
+                     passed as the progress argument of EEGSpectralData
+            step: N. of samples between windows of the spectrogram
+            sampling_rate: Sampling rate of the recording
+            cutoff: Frequency above which spectra are not plotted, None = plot all
+            interval: Time between updates of the plots in milliseconds
+        """
+        self.compute = compute
+        self.step = step
+        self.sampling_rate = sampling_rate
+        self.cutoff = cutoff
+        self.interval = interval
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self._updates = queue.Queue()
+        self._plots = []
+        self._timers = {}
+        self._callbacks = []
+        self._finished = False
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the computation in a background thread
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self.result = self.compute(self._progress)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def _progress(self, spectral, el, start, stop, stride):
+        self._updates.put((spectral, el, start, stop, stride))
+
+    def wait(self, timeout=None):
+        """
+        Waits for the computation to finish
+
+        Returns:
+            result: EEGSpectralData, None if the computation failed or timed out
+        """
+        self.done.wait(timeout)
+        return self.result
+
+    def on_complete(self, callback):
+        """
+        Registers function callback(result) called in the GUI thread once the plots
+        show the finished spectrogram, immediately if they already do
+        """
+        if self._finished:
+            callback(self.result)
+        else:
+            self._callbacks.append(callback)
+
+    def index_to_time(self, index):
+        """
+        Transforms index to time in seconds (see EEGSpectralData.index_to_time)
+        """
+        return index*self.step/self.sampling_rate
+
+    def plot(self, elid=0, colormap="parula", xlabels=True, axes=None, **kwargs):
+        """
+        Plots the spectrogram of an electrode into an axes and keeps updating it
+        until the computation finishes
+
+        Args:
+            elid: Index of the electrode for which spectrogram will be plotted
+            colormap: plot colormap (parula by default)
+            xlabels: True to display x axis label, false to hide
+            axes: matplotlib.axes.Axes object
+            kwargs: Other arguments of EEGSpectralData.plot, used once the computation finishes
+        """
+        plot = {"elid": elid, "colormap": colormap, "xlabels": xlabels, "axes": axes, "kwargs": kwargs,
+                "image": None, "display": None, "refined": None}
+        plot["text"] = axes.text(0.5, 0.5, "Computing spectrogram ...", ha="center", va="center",
+                                 transform=axes.transAxes)
+        axes.set_ylabel("Frequency (Hz)")
+        if xlabels:
+            axes.set_xlabel("Time (min)")
+        self._plots.append(plot)
+        canvas = axes.figure.canvas
+        if id(canvas) not in self._timers:
+            timer = canvas.new_timer(interval=self.interval)
+            timer.add_callback(self._poll)
+            timer.start()
+            self._timers[id(canvas)] = (canvas, timer)
+        self.start()
+
+    def _init_plot(self, plot, spectral):
+        #Display array of the log power, NaN (blank) until a window is computed
+        from . import plotting_util
+        freqs = spectral.frequencystamps
+        if self.cutoff is not None:
+            freqs = freqs[:np.searchsorted(freqs, self.cutoff, side="right")]
+        n = spectral.data.shape[1]
+        plot["display"] = np.full((n, len(freqs)), np.nan)
+        plot["refined"] = np.zeros(n, dtype=bool)
+        axes = plot["axes"]
+        plot["text"].remove()
+        set_spectrogram_ticks(axes, freqs, spectral.timestamps[-1], spectral.step/spectral.sampling_rate)
+        plot["image"] = axes.imshow(plot["display"].T, origin="lower", aspect="auto",
+                                    cmap=plotting_util.colormap(plot["colormap"]), interpolation="none",
+                                    extent=(-0.5, n - 0.5, -0.5, len(freqs) - 0.5))
+
+    def _update_plot(self, plot, spectral, start, stop, stride):
+        display = plot["display"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = np.log(spectral.data[plot["elid"],start:stop:stride,:display.shape[1]])
+        if stride == 1:
+            display[start:stop] = values
+            plot["refined"][start:stop] = True
+            return
+        #Every computed window also covers the following stride-1 columns until they are refined
+        cols = np.arange(start, min(stop - 1 + stride, display.shape[0]))
+        cols = cols[~plot["refined"][cols]]
+        display[cols] = values[(cols - start)//stride]
+
+    def _poll(self):
+        """
+        Moves queued updates into the plots (GUI thread)
+        """
+        changed = set()
+        while True:
+            try:
+                spectral, el, start, stop, stride = self._updates.get_nowait()
+            except queue.Empty:
+                break
+            for i, plot in enumerate(self._plots):
+                if plot["elid"] != el:
+                    continue
+                if plot["image"] is None:
+                    self._init_plot(plot, spectral)
+                self._update_plot(plot, spectral, start, stop, stride)
+                changed.add(i)
+        for i in changed:
+            plot = self._plots[i]
+            finite = plot["display"][np.isfinite(plot["display"])]
+            if finite.size:
+                #Same colour limits as LogPowerPyramid
+                lmin, lmax = np.min(finite), np.max(finite)
+                plot["image"].set_clim(lmin + 0.43*(lmax - lmin), lmax - 0.03*(lmax - lmin))
+            plot["image"].set_data(plot["display"].T)
+        if self.done.is_set() and self._updates.empty() and not self._finished:
+            self._finish()
+        elif changed:
+            for canvas, timer in self._timers.values():
+                canvas.draw_idle()
+
+    def _finish(self):
+        self._finished = True
+        for canvas, timer in self._timers.values():
+            timer.stop()
+        if self.error is not None:
+            print("Spectrogram computation failed: " + str(self.error))
+            for plot in self._plots:
+                if plot["image"] is None:
+                    plot["text"].set_text("Spectrogram computation failed")
+            for canvas, timer in self._timers.values():
+                canvas.draw_idle()
+            return
+        for plot in self._plots:
+            axes = plot["axes"]
+            if plot["image"] is None:
+                plot["text"].remove()
+                self.result.plot(elid=plot["elid"], colormap=plot["colormap"], xlabels=plot["xlabels"],
+                                 axes=axes, **plot["kwargs"])
+                continue
+            pyramid = self.result.log_pyramid(plot["elid"])
+            set_spectrogram_ticks(axes, self.result.frequencystamps, self.result.timestamps[-1],
+                                  self.result.step/self.result.sampling_rate)
+            plot["image"].set_clim(pyramid.vmin, pyramid.vmax)
+            pyramid.attach(axes, plot["image"])
+            axes.set_ylim(-0.5, self.result.data.shape[2] - 0.5)
+        for callback in self._callbacks:
+            callback(self.result)
+        self._callbacks = []
+        for canvas, timer in self._timers.values():
+            canvas.draw_idle()
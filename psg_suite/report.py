@@ -0,0 +1,191 @@
+'''
+Contains headless rendering of spectrogram and hypnogram reports
+
+A report shows the spectrograms of both electrodes of a capture above the
+hypnogram of its .stages file. Figures are built on matplotlib.figure.Figure
+with an Agg canvas instead of pyplot, so no global figure state is involved and
+reports of many captures are rendered in parallel worker processes.
+
+    python3 -m psg_suite.report capture1.dat capture2.psgb --out-dir reports --format pdf
+'''
+import argparse
+import concurrent.futures
+import os
+import sys
+import warnings
+from timeit import default_timer as timer
+import numpy as np
+from . import instrumentation
+from . import artifacts
+from .eeg_data import load_capture
+from .eeg_spectrum import EEGSpectralData, minute_ticks
+from .sleep_stage_label import SleepStageLabel
+from .stage_timeline import SLEEP_STAGE_LABELS
+
+CUTOFF = 25
+FORMATS = ("png", "pdf")
+
+def load_stages(fname):
+    """
+    Returns SleepStageLabel loaded from a .stages file, None if the file does not exist
+    """
+    if not os.path.isfile(fname):
+        return None
+    labels = SleepStageLabel("", "", "", None)
+    labels.load_txt(fname)
+    return labels
+
+def plot_hypnogram(axes, labels, length):
+    """
+    Plots the stage segments of a SleepStageLabel as a step line over time in minutes
+
+    Args:
+        axes: matplotlib.axes.Axes
+        labels: SleepStageLabel, None = only the axes with a note
+        length: Length of the time axis in seconds
+    """
+    axes.set_xlim(0, length)
+    axes.set_ylim(-0.5, len(SLEEP_STAGE_LABELS) - 0.5)
+    axes.set_yticks(np.arange(len(SLEEP_STAGE_LABELS)))
+    axes.set_yticklabels(SLEEP_STAGE_LABELS)
+    xticks, xticklabels = minute_ticks(length)
+    axes.set_xticks(xticks)
+    axes.set_xticklabels(xticklabels)
+    axes.set_xlabel("Time (min)")
+    axes.set_ylabel("Sleep Stage")
+    if labels is None:
+        axes.text(0.5, 0.5, "No stage data", ha="center", va="center", transform=axes.transAxes)
+        return
+    times = labels.timeline.times_array()
+    stages = labels.timeline.labels_array()
+    axes.plot(np.concatenate((times, [labels.sleep_length])), np.concatenate((stages, [stages[-1]])),
+              drawstyle="steps-post")
+
+def render_figure(spectrum, labels=None, title="", figsize=(16, 9), colormap="parula"):
+    """
+    Builds the report figure of a spectrogram and its stage labels without pyplot
+
+    Args:
+        spectrum: EEGSpectralData with at least two electrodes
+        labels: SleepStageLabel, None = empty hypnogram
+        title: Title of the figure
+        figsize: Size of the figure in inches
+        colormap: Colormap of the spectrograms (parula by default, see plotting_util)
+
+    Returns:
+        figure: matplotlib.figure.Figure attached to an Agg canvas
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    gs = fig.add_gridspec(3, 1, height_ratios=(3, 3, 1))
+    for el in range(2):
+        axes = fig.add_subplot(gs[el])
+        spectrum.plot(elid=el, colormap=colormap, xlabels=False, axes=axes)
+        axes.set_title(title if el == 0 else "")
+    length = spectrum.timestamps[-1] if labels is None else labels.sleep_length
+    plot_hypnogram(fig.add_subplot(gs[2]), labels, length)
+    fig.subplots_adjust(left=0.075, bottom=0.07, right=0.99, top=0.95, hspace=0.25)
+    return fig
+
+@instrumentation.timed("render_report")
+def render_report(fname, out_fname=None, stages_fname=None, fmt="png", estimator=None,
+                  cutoff=CUTOFF, dpi=100, figsize=(16, 9)):
+    """
+    Computes the spectrogram of a capture (see open.py) and renders its report
+
+    Args:
+        fname: Path to the capture file
+        out_fname: Path of the report, None = capture path with the format extension added
+        stages_fname: Path of the stage labels, None = capture path + ".stages"
+        fmt: "png" or "pdf"
+        estimator: Spectral estimator (see spectral_estimators), None = periodogram
+        cutoff: Frequency up to which spectra are computed and shown
+        dpi: Resolution of PNG reports
+        figsize: Size of the figure in inches
+
+    Returns:
+        out_fname: Path of the written report
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown report format: " + str(fmt))
+    out_fname = fname + "." + fmt if out_fname is None else out_fname
+    stages_fname = fname + ".stages" if stages_fname is None else stages_fname
+    data = load_capture(fname)
+    if data is None:
+        raise IOError("Unknown capture format: " + fname)
+    mask = artifacts.detect_artifacts(data)
+    spectrum = EEGSpectralData(data, estimator=estimator, cutoff=cutoff, mask=mask)
+    spectrum.frequency_cutoff(cutoff)
+    labels = load_stages(stages_fname)
+    title = os.path.basename(fname).rsplit('.', 1)[0]
+    if labels is not None and labels.sleep_block:
+        title += " " + labels.sleep_block
+    fig = render_figure(spectrum, labels, title, figsize)
+    with instrumentation.span("savefig"):
+        fig.savefig(out_fname, format=fmt, dpi=dpi)
+    return out_fname
+
+def render_reports(fnames, out_dir=None, fmt="png", workers=None, **kwargs):
+    """
+    Renders reports of several captures in worker processes, captures that fail are
+    skipped with a warning
+
+    Args:
+        fnames: Paths to the capture files
+        out_dir: Directory of the reports, None = next to the captures
+        fmt: "png" or "pdf"
+        workers: N. of worker processes, None = n. of CPUs, 1 = render in this process
+        kwargs: Other arguments of render_report
+
+    Returns:
+        out_fnames: Path of the report of every capture, None where rendering failed
+    """
+    out_fnames = [None if out_dir is None else
+                  os.path.join(out_dir, os.path.basename(fname) + "." + fmt) for fname in fnames]
+    if workers == 1:
+        results = []
+        for fname, out_fname in zip(fnames, out_fnames):
+            try:
+                results.append(render_report(fname, out_fname, fmt=fmt, **kwargs))
+            except Exception as e:
+                warnings.warn("Report of " + fname + " failed: " + str(e))
+                results.append(None)
+        return results
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render_report, fname, out_fname, fmt=fmt, **kwargs)
+                   for fname, out_fname in zip(fnames, out_fnames)]
+        results = []
+        for fname, fut in zip(fnames, futures):
+            try:
+                results.append(fut.result())
+            except Exception as e:
+                warnings.warn("Report of " + fname + " failed: " + str(e))
+                results.append(None)
+    return results
+
+def mf():
+    parser = argparse.ArgumentParser(description="Renders spectrogram and hypnogram reports of captures")
+    parser.add_argument("captures", nargs="+", help="Capture files (.dat, .csv, .ovibe, .psgb)")
+    parser.add_argument("--out-dir", default=None, help="Directory of the reports (default: next to the captures)")
+    parser.add_argument("--format", default="png", choices=FORMATS, help="Report file format")
+    parser.add_argument("--workers", type=int, default=0, help="N. of worker processes (0 = n. of CPUs)")
+    parser.add_argument("--dpi", type=int, default=100, help="Resolution of PNG reports")
+    args = parser.parse_args()
+    if args.out_dir is not None:
+        os.makedirs(args.out_dir, exist_ok=True)
+    start = timer()
+    results = render_reports(args.captures, args.out_dir, args.format, args.workers or None, dpi=args.dpi)
+    seconds = timer() - start
+    n_done = sum(r is not None for r in results)
+    for r in results:
+        if r is not None:
+            print(r)
+    print("%d of %d reports in %.1f s (%.1f renders per minute, %d workers)" %
+          (n_done, len(results), seconds, 60*n_done/seconds, args.workers or os.cpu_count()),
+          file=sys.stderr)
+    return 0 if n_done == len(results) else 1
+
+if __name__ == '__main__':
+    sys.exit(mf())
@@ -2,13 +2,31 @@
 Contains class for determing and storing sleep stage label data
 """
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import gridspec
-from matplotlib.widgets import Slider, Button, RadioButtons
-from matplotlib.table import Table
-from matplotlib.collections import LineCollection
-from matplotlib.colors import LinearSegmentedColormap
 import csv
+from timeit import default_timer as timer
+from .stage_timeline import StageTimeline, SLEEP_STAGE_LABELS
+from . import instrumentation
+
+def _read_only(array):
+    #In-place writes would be lost with the temporary array, so they fail instead
+    array.flags.writeable = False
+    return array
+
+def frame_time_report(frame_times):
+    """
+    Summarizes redraw durations of the labeling dialog
+
+    Args:
+        frame_times: List of redraw durations in seconds
+
+    Returns:
+        report: Dictionary with n. of frames and mean, median, 95th percentile and max frame time in ms
+    """
+    if len(frame_times) == 0:
+        return {"frames": 0}
+    ms = np.asarray(frame_times)*1000
+    return {"frames": len(ms), "mean_ms": float(np.mean(ms)), "median_ms": float(np.median(ms)),
+            "p95_ms": float(np.percentile(ms, 95)), "max_ms": float(np.max(ms))}
 
 class SleepStageLabel():
     """
@@ -20,9 +38,11 @@ class SleepStageLabel():
     date = None
     loaded_stage_times = None
     loaded_stage_labels = None
-    stage_times = None
-    stage_labels = None
+    timeline = None
     saving = False
+    frame_times = None #Durations of the redraws after clicks and label edits in the last label_manual
+    cursor_frame_times = None #Durations of the redraws of the cursor following the mouse
+    redraw_labels = None #Redraws the hypnogram of the open label_manual dialog
 
     def __init__(self, name, date, sleep_block, sleep_length):
         """
@@ -39,7 +59,37 @@ class SleepStageLabel():
         self.sleep_block = sleep_block
         self.sleep_length = sleep_length
 
-    def label_manual(self, display_elems, figsize=(15, 7.5), title="Sleep Stages"):
+    @property
+    def stage_times(self):
+        """
+        Start times of the stage segments as a read-only array built from the timeline,
+        assign the whole attribute (or edit the timeline) to change them
+        """
+        return None if self.timeline is None else _read_only(self.timeline.times_array())
+
+    @stage_times.setter
+    def stage_times(self, times):
+        if self.timeline is None:
+            self.timeline = StageTimeline(self.sleep_length, [], [])
+        self.timeline.set_segments(times=times)
+
+    @property
+    def stage_labels(self):
+        """
+        Labels of the stage segments as a read-only array built from the timeline,
+        assign the whole attribute (or edit the timeline) to change them
+        """
+        return None if self.timeline is None else _read_only(self.timeline.labels_array())
+
+    @stage_labels.setter
+    def stage_labels(self, labels):
+        if self.timeline is None:
+            self.timeline = StageTimeline(self.sleep_length, [], [])
+        self.timeline.set_segments(labels=labels)
+
+    @instrumentation.timed("SleepStageLabel.label_manual")
+    def label_manual(self, display_elems, figsize=(15, 7.5), title="Sleep Stages",
+                     blit=True, frame_report=False):
         """
         Displays dialog for manual stage labeling
 
@@ -51,49 +101,83 @@ class SleepStageLabel():
                           name-value pairs supplied to the function.
             figsize: Size of the figure
             block: Blocks code execution until label dialog is closed
+            blit: True to redraw only the hypnogram, cursor and stage totals on top of a cached
+                  background after a click, False to redraw the whole figure
+            frame_report: True to print frame_time_report of the redraws after clicks and label
+                          edits, and separately of the cursor redraws, when the dialog is closed
         """
+        #GUI modules are imported on first use, so loading and saving labels needs no display
+        import matplotlib.pyplot as plt
+        from matplotlib import gridspec
+        from matplotlib.widgets import Button, RadioButtons
+        from matplotlib.table import Table
+
         self.saving = False
-        sleep_stage_labels = ['NREM3','NREM2','REM','NREM1','WAKE','MASK OFF','???']
+        self.frame_times = []
+        self.cursor_frame_times = []
+        sleep_stage_labels = SLEEP_STAGE_LABELS
 
         height_ratios = np.ones(len(display_elems))*3;
         height_ratios = np.append(height_ratios,1)
         fig=plt.figure(figsize=figsize)
         gs = gridspec.GridSpec(len(display_elems)+1, 1, height_ratios=height_ratios)
         ax_transforms = {}
+        blit = blit and getattr(fig.canvas, 'supports_blit', hasattr(fig.canvas, 'copy_from_bbox'))
+        #Artists left out of the cached background and drawn over it on every refresh
+        animated = []
+        background = {'image': None}
+        def draw_animated():
+            for ax, artist in animated:
+                ax.draw_artist(artist)
+        def on_draw(event):
+            background['image'] = fig.canvas.copy_from_bbox(fig.bbox)
+            draw_animated()
+        def refresh(frame_times=None):
+            #frame_times: List the duration of the redraw is appended to, None = not recorded
+            start = timer()
+            if blit and background['image'] is not None:
+                fig.canvas.restore_region(background['image'])
+                draw_animated()
+                for ax in set(ax for ax, artist in animated):
+                    fig.canvas.blit(ax.bbox)
+                fig.canvas.flush_events()
+            else:
+                fig.canvas.draw()
+            if frame_times is not None:
+                frame_times.append(timer() - start)
+            instrumentation.count("redraws")
         def format_time_period(val):
             m, s = divmod(int(round(val)), 60)
             h, m = divmod(m, 60)
             return "%d:%02d:%02d" % (h, m, s)
         def reset_labels(event=None):
-            self.stage_times = [0]
-            self.stage_labels = [5]
+            self.timeline = StageTimeline(self.sleep_length)
             if event is not None:
                 redraw_labels(event)
         def reload_labels(event=None):
-            self.stage_times = np.append([], self.loaded_stage_times)
-            self.stage_labels = np.append([], self.loaded_stage_labels)
-            if self.stage_times[0] is None or self.stage_labels[0] is None or self.stage_times.size != self.stage_labels.size:
+            if (self.loaded_stage_times is None or self.loaded_stage_labels is None or
+                    np.size(self.loaded_stage_times) == 0 or
+                    np.size(self.loaded_stage_times) != np.size(self.loaded_stage_labels)):
                 print("data is bad, resetting labels")
                 reset_labels(event)
             else:
-                print("stage_times size is " + str(self.stage_times.size))
-                print("stage_labels size is " + str(self.stage_labels.size))
+                self.timeline = StageTimeline(self.sleep_length, self.loaded_stage_times,
+                                              self.loaded_stage_labels)
+                print("stage_times size is " + str(len(self.timeline)))
+                print("stage_labels size is " + str(len(self.timeline)))
             if event is not None:
                 redraw_labels(event)
-        def redraw_labels(event=None):
-            line1.set_xdata(np.concatenate((self.stage_times, [self.sleep_length])))
-            line1.set_ydata(np.concatenate((self.stage_labels, [self.stage_labels[-1]])))
-            data = [0, 0, 0, 0, 0, 0, 0, 0]
-            for x in range(0, len(self.stage_times)):
-                data_offset = int(len(sleep_stage_labels) - (self.stage_labels[x] + 1))
-                thisval = self.stage_times[x]
-                nextval = self.sleep_length if x is len(self.stage_times) - 1 else self.stage_times[x + 1]
-                diffval = nextval - thisval
-                data[data_offset] = data[data_offset] + diffval
-            data[len(data) - 1] = self.sleep_length
+        def redraw_labels(event=None, record=True):
+            times = self.timeline.times_array()
+            labels = self.timeline.labels_array()
+            line1.set_xdata(np.concatenate((times, [self.sleep_length])))
+            line1.set_ydata(np.concatenate((labels, [labels[-1]])))
+            data = list(self.timeline.durations()[::-1]) + [self.sleep_length]
             for x in range(0, len(data)):
-                table.get_celld()[x, 1].get_text().set_text(format_time_period(data[x]))
-            fig.canvas.draw()
+                text = value_table.get_celld()[x, 0].get_text()
+                if text.get_text() != format_time_period(data[x]):
+                    text.set_text(format_time_period(data[x]))
+            refresh(self.frame_times if record else None)
         def on_pick(event):
             #print(event.artist)
             if event.artist is None:
@@ -101,26 +185,20 @@ class SleepStageLabel():
             xmouse, ymouse = event.mouseevent.xdata, event.mouseevent.ydata
             xmouse = ax_transforms[event.artist].index_to_time(xmouse)
             #print('x, y of mouse: {:.2f},{:.2f}'.format(xmouse, ymouse))
-            larger=[x[0] for x in enumerate(self.stage_times) if x[1] > xmouse]
-            if len(larger)>0:
-                idx = larger[0]
-                if self.stage_labels[idx-1] != self.stage_label:
-                    self.stage_times[idx] = xmouse
-                    self.stage_labels[idx] = self.stage_label
-                else:
-                    self.stage_times = np.delete(self.stage_times, idx)
-                    self.stage_labels = np.delete(self.stage_labels, idx)
-            else:
-                if self.stage_labels[-1] != self.stage_label:
-                    self.stage_times = np.append(self.stage_times, xmouse)
-                    self.stage_labels = np.append(self.stage_labels, self.stage_label)
-            #print(stage_times)
-            #print(stage_labels)
-            for i in range(1, len(self.stage_labels) - 1):
-                if self.stage_labels[i] == self.stage_labels[i-1]:
-                    self.stage_labels = np.delete(self.stage_labels, i)
-                    self.stage_times = np.delete(self.stage_times, i)
+            self.timeline.paint(xmouse, self.stage_label)
+            instrumentation.count("edits")
             redraw_labels()
+        def on_move(event):
+            if event.inaxes in ax_transforms:
+                t = ax_transforms[event.inaxes].index_to_time(event.xdata)
+            elif event.inaxes is ax1:
+                t = event.xdata
+            else:
+                return
+            for ax, cursor in cursors.items():
+                cursor.set_xdata([t if ax is ax1 else t/ax_transforms[ax].index_to_time(1)]*2)
+                cursor.set_visible(True)
+            refresh(self.cursor_frame_times)
 
         
         for did in range(len(display_elems)):
@@ -134,10 +212,6 @@ class SleepStageLabel():
                 plt.title(title)
             #TODO
             ax.set_picker(True)
-            
-
-            fig.canvas.mpl_connect('pick_event', on_pick)
-            fig.set_picker(on_pick)
 
         xtickspacing = 300;
         if len(np.arange(0,self.sleep_length,300)) > 20:
@@ -152,6 +226,8 @@ class SleepStageLabel():
         xticklabels = [str(int(i/60)) for i in xticks]
 
         reload_labels()
+        #Lets display elements finishing in the background (see progressive) redraw replaced labels
+        self.redraw_labels = redraw_labels
         ax1 = plt.subplot(gs[-1])
         line1,=ax1.plot(np.concatenate((self.stage_times,[self.sleep_length])), 
                         np.concatenate((self.stage_labels,[self.stage_labels[-1]])),drawstyle="steps-post")
@@ -162,6 +238,13 @@ class SleepStageLabel():
         ax1.set_yticklabels(sleep_stage_labels)
         ax1.set_xticks(xticks)
         ax1.set_xticklabels(xticklabels)
+        cursors = {}
+        if blit:
+            line1.set_animated(True)
+            animated.append((ax1, line1))
+            for ax in list(ax_transforms) + [ax1]:
+                cursors[ax] = ax.axvline(0, color='red', linewidth=0.8, animated=True, visible=False)
+                animated.append((ax, cursors[ax]))
 
         self.stage_label = 6
         rax = plt.axes([0.0, 0.0, 0.2, 0.16], facecolor='lightgoldenrodyellow')
@@ -186,28 +269,54 @@ class SleepStageLabel():
         radio.on_clicked(stagepicker)
         tableax = plt.axes([0.2, 0.0, 0.25, 0.16], facecolor='lightblue')
         tableax.get_yaxis().set_visible(False)
-        table = Table(tableax, bbox=[0,0,1,1])
+        #Stage names and totals are separate tables so that only the totals are redrawn
+        table = Table(tableax, bbox=[0,0,0.6,1])
+        value_table = Table(tableax, bbox=[0.6,0,0.4,1])
         height = table._approx_text_height()
         lidx = 0
         for label in sleep_stage_labels[::-1]:
             table.add_cell(lidx, 0, width=0.6, height=height, text=label)
-            table.add_cell(lidx, 1, width=0.4, height=height, text='')
+            value_table.add_cell(lidx, 0, width=0.4, height=height, text='')
             lidx = lidx + 1
         table.add_cell(lidx, 0, width=0.6, height=height, text='Total Sleep Time')
-        table.add_cell(lidx, 1, width=0.4, height=height, text='')
+        value_table.add_cell(lidx, 0, width=0.4, height=height, text='')
         tableax.add_table(table)
+        tableax.add_table(value_table)
+        if blit:
+            value_table.set_animated(True)
+            animated.append((tableax, value_table))
+            fig.canvas.mpl_connect('draw_event', on_draw)
+            fig.canvas.mpl_connect('motion_notify_event', on_move)
         
         fig.canvas.callbacks.connect('pick_event', on_pick)
-        fig.canvas.set_window_title('EEG Spectrogram Analysis')
+        if hasattr(fig.canvas, 'set_window_title'):
+            fig.canvas.set_window_title('EEG Spectrogram Analysis')
+        elif fig.canvas.manager is not None:
+            fig.canvas.manager.set_window_title('EEG Spectrogram Analysis')
 
         plt.subplots_adjust(left=0.15 if figsize[0] < 10 else 0.075, bottom=0.2, right=0.99, top=0.97)
-        redraw_labels()
-        plt.show()
-        self.stage_times = np.array(self.stage_times)
-        self.stage_times = np.concatenate((self.stage_times, [self.sleep_length]))
-        self.stage_labels = np.concatenate((self.stage_labels, [6]))
+        redraw_labels(record=False)
+        #Time spent in the open dialog, label_manual minus this span is the setup time
+        with instrumentation.span("interactive"):
+            plt.show()
+        if frame_report:
+            print("frame times: " + str(frame_time_report(self.frame_times)))
+            print("cursor frame times: " + str(frame_time_report(self.cursor_frame_times)))
+        self.timeline.set_segments(self.timeline.times + [self.sleep_length],
+                                   self.timeline.labels + [6])
 
     
+    def stage_durations(self):
+        """
+        Returns total time spent in each stage
+
+        Returns:
+            durations: Dictionary mapping stage names from SLEEP_STAGE_LABELS to seconds
+        """
+        self.timeline.set_length(self.sleep_length)
+        return dict(zip(SLEEP_STAGE_LABELS, self.timeline.durations().tolist()))
+
+    @instrumentation.timed("SleepStageLabel.load_txt")
     def load_txt(self, fname):
         """
         Loads sleep label data in text fromat from provided file
@@ -222,10 +331,14 @@ class SleepStageLabel():
             self.date = f.readline().rstrip('\n')
 
             reader = csv.reader(f)
-            data = np.asfarray(np.array(list(reader)),float)
-            self.loaded_stage_times = self.stage_times = data[:,0]
-            self.loaded_stage_labels = self.stage_labels = data[:,1].astype(int)
+            data = np.asarray(list(reader),dtype=float)
+            instrumentation.count("segments", data.shape[0])
+            self.loaded_stage_times = data[:,0]
+            self.loaded_stage_labels = data[:,1].astype(int)
+            self.timeline = StageTimeline(self.sleep_length, self.loaded_stage_times,
+                                          self.loaded_stage_labels)
  
+    @instrumentation.timed("SleepStageLabel.save_txt")
     def save_txt(self,fname):
         """
         Saves sleep label data in text fromat to provided file
@@ -240,5 +353,4 @@ class SleepStageLabel():
             wrf.write(str(self.date)+"\n")
 
             wr = csv.writer(wrf, delimiter=',', lineterminator='\n')
-            for i in range(len(self.stage_times)):
-                wr.writerow([self.stage_times[i],self.stage_labels[i]])
+            wr.writerows(zip(self.timeline.times, self.timeline.labels))
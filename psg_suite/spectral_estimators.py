@@ -0,0 +1,206 @@
+'''
+Contains spectral estimators used by EEGSpectralData
+
+Every estimator is described by a taper bank: a 2D array of tapers applied to
+segments of the window. The power spectrum of a window is the sum of
+|rfft(segment*taper)|^2 over all segments and tapers, so all estimators are
+computed by the same batched FFT pass. Weights and scaling are folded into the
+tapers, which are computed once per (window, sampling rate) and cached.
+
+All estimates have the level of speriodogram(w, detrend=False) (Hamming window,
+2*pi/sampling_rate scaling) for white noise, so they can be plotted with the same
+colour limits.
+'''
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+#Taper banks cached by (estimator description, window, sampling rate)
+_TAPER_BANKS = {}
+
+class SpectralEstimator():
+    """
+    Base class of the estimators, subclasses implement name, params and _tapers
+    """
+    name = None
+
+    def params(self):
+        """
+        Returns dictionary of the estimator parameters
+        """
+        return {}
+
+    def describe(self):
+        """
+        Returns string identifying the estimator and its parameters, e.g. "welch(overlap=0.5,segment=512,taper=hann)"
+        """
+        params = self.params()
+        if not params:
+            return self.name
+        return self.name + "(" + ",".join(k + "=" + str(params[k]) for k in sorted(params)) + ")"
+
+    def _tapers(self, window):
+        """
+        Returns (tapers, segment_step, weights): unit energy tapers of shape (n. of tapers, segment length),
+        step between segments of a window and weight of every taper (summing to 1)
+        """
+        raise NotImplementedError
+
+    def taper_bank(self, window, sampling_rate):
+        """
+        Returns (bank, segment_step): scaled tapers of shape (n. of tapers, segment length) and
+        step between segments, computed once per (window, sampling_rate)
+        """
+        key = (self.describe(), window, sampling_rate)
+        if key not in _TAPER_BANKS:
+            tapers, segment_step, weights = self._tapers(window)
+            n_segments = len(range(0, window - tapers.shape[1] + 1, segment_step))
+            #Same white noise level as a Hamming windowed periodogram of the whole window
+            energy = np.sum(np.hamming(window)**2) * 2*np.pi/sampling_rate
+            scale = np.sqrt(energy * np.asarray(weights, dtype=np.float64) / n_segments)
+            bank = tapers / np.sqrt(np.sum(tapers**2, axis=1))[:,None] * scale[:,None]
+            bank.setflags(write=False)
+            _TAPER_BANKS[key] = (bank, segment_step)
+        return _TAPER_BANKS[key]
+
+    def frequencies(self, window, sampling_rate):
+        """
+        Returns frequencies of the estimated power values
+        """
+        bank, segment_step = self.taper_bank(window, sampling_rate)
+        return np.fft.rfftfreq(bank.shape[1], 1.0/sampling_rate)
+
+    def transforms_per_window(self, window, sampling_rate):
+        """
+        Returns n. of FFTs computed per window (segments times tapers)
+        """
+        bank, segment_step = self.taper_bank(window, sampling_rate)
+        return bank.shape[0] * len(range(0, window - bank.shape[1] + 1, segment_step))
+
+    def __call__(self, windows, sampling_rate):
+        """
+        Estimates power spectra of all rows of a 2D array of windows in one batched FFT pass
+
+        Args:
+            windows: 2D array of shape (n_windows, window)
+            sampling_rate: Sampling rate of the windowed signal
+
+        Returns:
+            power: 2D array of shape (n_windows, n. of frequencies)
+        """
+        bank, segment_step = self.taper_bank(windows.shape[1], sampling_rate)
+        segment = bank.shape[1]
+        if segment == windows.shape[1]:
+            segments = windows[:,None,:]
+        else:
+            n_segments = len(range(0, windows.shape[1] - segment + 1, segment_step))
+            segments = as_strided(windows, shape=(windows.shape[0], n_segments, segment),
+                                  strides=(windows.strides[0], segment_step*windows.strides[1],
+                                           windows.strides[1]), writeable=False)
+        if bank.shape[0] == 1 and segments.shape[1] == 1:
+            spec = np.fft.rfft(segments[:,0,:]*bank[0], axis=1)
+            return spec.real**2 + spec.imag**2
+        #(windows, segments, tapers, samples)
+        spec = np.fft.rfft(segments[:,:,None,:]*bank[None,None,:,:], axis=3)
+        power = spec.real**2 + spec.imag**2
+        return power.sum(axis=(1, 2))
+
+class Periodogram(SpectralEstimator):
+    """
+    Hamming windowed periodogram of the whole window, same as speriodogram(w, detrend=False)
+    """
+    name = "periodogram"
+
+    def _tapers(self, window):
+        return np.hamming(window)[None,:], window, [1.0]
+
+class Welch(SpectralEstimator):
+    """
+    Welch estimate, the mean of periodograms of overlapping tapered segments of the window
+    """
+    name = "welch"
+
+    def __init__(self, segment=512, overlap=0.5, taper="hann"):
+        """
+        Args:
+            segment: N. of samples in a segment (the whole window if it is shorter)
+            overlap: Overlapping fraction of consecutive segments
+            taper: "hann" or "hamming"
+        """
+        if taper not in ("hann", "hamming"):
+            raise ValueError("Unknown taper: " + str(taper))
+        self.segment = segment
+        self.overlap = overlap
+        self.taper = taper
+
+    def params(self):
+        return {"segment": self.segment, "overlap": self.overlap, "taper": self.taper}
+
+    def _tapers(self, window):
+        segment = min(self.segment, window)
+        taper = np.hanning(segment) if self.taper == "hann" else np.hamming(segment)
+        return taper[None,:], max(1, int(round(segment*(1 - self.overlap)))), [1.0]
+
+class Multitaper(SpectralEstimator):
+    """
+    Multitaper estimate, the eigenvalue weighted mean of periodograms tapered by
+    discrete prolate spheroidal sequences (DPSS)
+    """
+    name = "multitaper"
+
+    def __init__(self, nw=4, k=None):
+        """
+        Args:
+            nw: Time half bandwidth product
+            k: N. of tapers, None = 2*nw-1
+        """
+        self.nw = nw
+        self.k = int(2*nw - 1) if k is None else k
+
+    def params(self):
+        return {"nw": self.nw, "k": self.k}
+
+    def _tapers(self, window):
+        #spectrum imports scipy.signal, which is slow, so it is imported only when tapers are built
+        import spectrum
+        tapers, eigen = spectrum.dpss(window, self.nw, self.k)
+        return np.transpose(tapers), window, eigen/np.sum(eigen)
+
+class Decimated(SpectralEstimator):
+    """
+    Equivalent of another estimator for a signal decimated by q, its tapers are every
+    q-th sample of the full rate tapers, so a window of a low-passed signal gives the
+    same spectrum as the full rate window
+    """
+    def __init__(self, estimator, q):
+        """
+        Args:
+            estimator: Full rate SpectralEstimator
+            q: Decimation factor, windows are q times shorter than at the full rate
+        """
+        self.estimator = estimator
+        self.q = q
+        self.name = estimator.name
+
+    def describe(self):
+        return self.estimator.describe() + "/" + str(self.q)
+
+    def _tapers(self, window):
+        tapers, segment_step, weights = self.estimator._tapers(window*self.q)
+        return tapers[:,::self.q], max(1, segment_step//self.q), weights
+
+ESTIMATORS = {"periodogram": Periodogram, "welch": Welch, "multitaper": Multitaper}
+
+def get_estimator(estimator):
+    """
+    Returns estimator instance
+
+    Args:
+        estimator: SpectralEstimator instance, or name from ESTIMATORS (default parameters), None = periodogram
+    """
+    if estimator is None:
+        return Periodogram()
+    if isinstance(estimator, SpectralEstimator):
+        return estimator
+    if estimator not in ESTIMATORS:
+        raise ValueError("Unknown spectral estimator: " + str(estimator))
+    return ESTIMATORS[estimator]()
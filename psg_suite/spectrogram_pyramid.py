@@ -0,0 +1,75 @@
+'''
+Contains level-of-detail pyramid of log spectrogram used for plotting
+'''
+import numpy as np
+
+class LogPowerPyramid():
+    """
+    Log power of one electrode at several time resolutions. Level k averages
+    2^k neighbouring columns of level 0, so a plot only ever has to hand
+    about as many columns to imshow as the axes has pixels.
+    """
+    levels = None
+    vmin = None
+    vmax = None
+
+    def __init__(self, power, min_columns=64):
+        """
+        Args:
+            power: 2D array of shape (windows, frequencies)
+            min_columns: Levels are added while they have at least this many columns
+        """
+        self.levels = [np.log(power)]
+        #Colour limits of the full resolution data, shared by all levels, masked windows are NaN
+        lmin = np.nanmin(self.levels[0])
+        lmax = np.nanmax(self.levels[0])
+        ptp = lmax - lmin
+        self.vmin = lmin + 0.43*ptp
+        self.vmax = lmax - 0.03*ptp
+        while self.levels[-1].shape[0] >= 2*min_columns:
+            prev = self.levels[-1]
+            if prev.shape[0] % 2:
+                prev = np.concatenate((prev, prev[-1:]))
+            self.levels.append(0.5*(prev[0::2] + prev[1::2]))
+
+    def level_for(self, visible_columns, pixels):
+        """
+        Returns the coarsest level that still has at least one column per pixel
+
+        Args:
+            visible_columns: N. of full resolution columns in the visible range
+            pixels: Width of the axes in pixels
+        """
+        if pixels <= 0 or visible_columns <= pixels:
+            return 0
+        return min(int(np.log2(visible_columns / pixels)), len(self.levels) - 1)
+
+    def extent(self, level):
+        """
+        Returns imshow extent placing columns of a level at full resolution column indices
+        """
+        cols, freqs = self.levels[level].shape
+        return (-0.5, cols * 2**level - 0.5, -0.5, freqs - 0.5)
+
+    def attach(self, axes, image):
+        """
+        Shows the level matching the current view in an image and swaps levels
+        when the axes is zoomed, panned or resized
+
+        Args:
+            axes: matplotlib.axes.Axes the image is drawn into
+            image: AxesImage returned by imshow
+        """
+        state = {'level': None}
+        def update(event=None):
+            x0, x1 = axes.get_xlim()
+            level = self.level_for(abs(x1 - x0), axes.get_window_extent().width)
+            if level != state['level']:
+                state['level'] = level
+                image.set_data(np.transpose(self.levels[level]))
+                image.set_extent(self.extent(level))
+                axes.set_xlim(x0, x1)
+        update()
+        axes.callbacks.connect('xlim_changed', update)
+        axes.figure.canvas.mpl_connect('resize_event', update)
+        return update
@@ -0,0 +1,210 @@
+'''
+Persistent content-addressed cache of computed spectrograms
+'''
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from . import eeg_container
+from . import instrumentation
+from .eeg_spectrum import EEGSpectralData
+
+ENTRY_SUFFIX = ".psgb"
+
+def default_cache_dir():
+    """
+    Returns cache directory from PSG_CACHE_DIR environment variable, ~/.cache/psg_suite by default
+    """
+    return os.environ.get("PSG_CACHE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "psg_suite"))
+
+def file_digest(fname, block_size=1 << 20):
+    """
+    Returns SHA-256 hex digest of the content of a file
+
+    Args:
+        fname: Path to the file
+        block_size: N. of bytes hashed at once
+    """
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class SpectrumCache():
+    """
+    Stores EEGSpectralData as binary containers named by a hash of the capture
+    content and of the spectrogram parameters. Entries are written atomically,
+    the least recently used ones are evicted when the cache exceeds max_bytes,
+    and bookkeeping is serialized by a lock file so several labeling sessions
+    can share one cache directory.
+    """
+    directory = None
+    max_bytes = None
+    hits = 0
+    misses = 0
+
+    def __init__(self, directory=None, max_bytes=4 << 30):
+        """
+        Opens (and creates if needed) the cache directory
+
+        Args:
+            directory: Path to the cache directory, None = default_cache_dir()
+            max_bytes: Size cap of all cache entries in bytes
+        """
+        self.directory = default_cache_dir() if directory is None else directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    @instrumentation.timed("SpectrumCache.key")
+    def key(self, fname, window=2048, step=1792, downsample=1, cutoff=None, estimator="periodogram",
+            decimated=False, masked=False, segment=None):
+        """
+        Returns cache key of a capture file and spectrogram parameters
+
+        Args:
+            fname: Path to the capture file
+            window, step, downsample: Parameters of EEGSpectralData
+            cutoff: Frequency supplied to frequency_cutoff, None = no cutoff
+            estimator: Description of the spectral estimator (see SpectralEstimator.describe)
+            decimated: True if the cutoff was supplied to EEGSpectralData (decimated computation)
+            masked: True if artifact intervals were supplied to EEGSpectralData as mask
+            segment: (start, stop) time range in seconds of the capture the spectrogram was computed
+                     from (see EEGData.segment), None = whole capture
+        """
+        params = [window, step, downsample, cutoff]
+        #Keys of periodogram spectrograms are the same as before estimators were added
+        if estimator != "periodogram" or decimated:
+            params.append(estimator)
+        if decimated:
+            params.append("decimated")
+        if masked:
+            params.append("masked")
+        if segment is not None:
+            params.append(["segment", segment[0], segment[1]])
+        params = json.dumps(params)
+        return hashlib.sha256((file_digest(fname) + params).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    @instrumentation.timed("SpectrumCache.get")
+    def get(self, key):
+        """
+        Looks up a spectrogram in the cache
+
+        Args:
+            key: Cache key returned by key()
+
+        Returns:
+            (spectrum, attrs): Memory-mapped EEGSpectralData and extra attributes
+                               stored with it, (None, None) on a miss
+        """
+        fname = self.path(key)
+        try:
+            spectrum = EEGSpectralData()
+            spectrum.load_bin(fname)
+            attrs = eeg_container.read_header(fname)["attrs"]
+            #Access time is tracked through mtime, atime is often disabled
+            os.utime(fname, None)
+        except (IOError, OSError, ValueError, KeyError):
+            self._record(hit=False)
+            instrumentation.count("misses")
+            return None, None
+        self._record(hit=True)
+        instrumentation.count("hits")
+        return spectrum, attrs
+
+    @instrumentation.timed("SpectrumCache.put")
+    def put(self, key, spectrum, **attrs):
+        """
+        Stores a spectrogram in the cache and evicts least recently used entries
+
+        Args:
+            key: Cache key returned by key()
+            spectrum: EEGSpectralData to be stored
+            attrs: Extra scalar attributes stored with the spectrogram (e.g. sleep_duration)
+        """
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        os.close(fd)
+        try:
+            spectrum.save_bin(tmp, attrs=attrs)
+            os.replace(tmp, self.path(key))
+        except Exception:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+    @instrumentation.timed("SpectrumCache.evict")
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits into max_bytes
+        """
+        with self._lock():
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(ENTRY_SUFFIX):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+            total = sum(e[1] for e in entries)
+            for mtime, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    total -= size
+                except OSError:
+                    #Entry is open by another session (Windows), try the next one
+                    pass
+
+    def stats(self):
+        """
+        Returns dictionary of hits and misses of this session and all sessions sharing the cache
+        """
+        with self._lock():
+            totals = self._load_totals()
+        return {"session_hits": self.hits, "session_misses": self.misses,
+                "total_hits": totals["hits"], "total_misses": totals["misses"]}
+
+    def _record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        with self._lock():
+            totals = self._load_totals()
+            totals["hits" if hit else "misses"] += 1
+            tmp = os.path.join(self.directory, "stats.json.tmp" + str(os.getpid()))
+            with open(tmp, 'w') as f:
+                json.dump(totals, f)
+            os.replace(tmp, os.path.join(self.directory, "stats.json"))
+
+    def _load_totals(self):
+        try:
+            with open(os.path.join(self.directory, "stats.json")) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {"hits": 0, "misses": 0}
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.directory, ".lock"), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,131 @@
+'''
+Contains indexed timeline of sleep stage segments
+'''
+from bisect import bisect_right
+import numpy as np
+
+#Stage names indexed by the label values stored in stage_labels
+SLEEP_STAGE_LABELS = ['NREM3','NREM2','REM','NREM1','WAKE','MASK OFF','???']
+
+class StageTimeline():
+    """
+    Sorted sleep stage segments, segment i starts at times[i], has label
+    labels[i] and ends where segment i+1 starts (the last one at length).
+    Segments are found by bisection and total time per stage is updated
+    with every edit instead of being recomputed.
+    """
+    length = None
+    times = None
+    labels = None
+
+    def __init__(self, length, times=(0,), labels=(5,)):
+        """
+        Args:
+            length: Time at which the last segment ends in seconds
+            times: Start times of the segments in ascending order
+            labels: Labels of the segments (indices into SLEEP_STAGE_LABELS)
+        """
+        self.length = length
+        self.set_segments(times, labels)
+
+    def set_segments(self, times=None, labels=None):
+        """
+        Replaces segment start times and/or labels as they are (no merging)
+
+        Args:
+            times: Start times of the segments in ascending order, None = keep current
+            labels: Labels of the segments, None = keep current
+        """
+        if times is not None:
+            self.times = [float(t) for t in times]
+        if labels is not None:
+            self.labels = [int(l) for l in labels]
+        self._totals = None
+
+    def set_length(self, length):
+        """
+        Changes the end of the last segment
+        """
+        if self._totals is not None and len(self.times) == len(self.labels) and self.times:
+            self._totals[self.labels[-1]] += length - self.length
+        self.length = length
+
+    def __len__(self):
+        return len(self.times)
+
+    def times_array(self):
+        return np.array(self.times, dtype=float)
+
+    def labels_array(self):
+        return np.array(self.labels, dtype=int)
+
+    def find(self, t):
+        """
+        Returns index of the segment containing time t (0 if t precedes all segments)
+        """
+        return max(bisect_right(self.times, t) - 1, 0)
+
+    def label_at(self, t):
+        """
+        Returns label of the segment containing time t
+        """
+        return self.labels[self.find(t)]
+
+    def durations(self):
+        """
+        Returns array of total time per label, indexed like SLEEP_STAGE_LABELS
+        """
+        if self._totals is None:
+            self._totals = np.zeros(len(SLEEP_STAGE_LABELS))
+            for i in range(len(self.times)):
+                self._totals[self.labels[i]] += self._duration(i)
+        return self._totals.copy()
+
+    def paint(self, t, label):
+        """
+        Labels time from t to the end of the segment following the one containing t
+        (or to the end if t is in the last segment), then merges adjacent segments
+        with equal labels. This is the edit performed by a click in label_manual.
+
+        Args:
+            t: Time in seconds
+            label: New label
+        """
+        t = max(float(t), self.times[0])
+        idx = bisect_right(self.times, t)
+        if idx < len(self.times):
+            if self.labels[idx-1] != label:
+                self._update(idx-1, idx+1, [self.times[idx-1], t], [self.labels[idx-1], label])
+            else:
+                self._update(idx-1, idx+1, [self.times[idx-1]], [label])
+                idx -= 1
+        elif self.labels[-1] != label:
+            self._update(idx-1, idx, [self.times[idx-1], t], [self.labels[idx-1], label])
+        self._merge(idx+1)
+        self._merge(idx)
+
+    def _merge(self, i):
+        """
+        Merges segment i into segment i-1 if they have the same label
+        """
+        if 0 < i < len(self.times) and self.labels[i] == self.labels[i-1]:
+            self._update(i-1, i+1, [self.times[i-1]], [self.labels[i-1]])
+
+    def _duration(self, i):
+        end = self.length if i == len(self.times) - 1 else self.times[i+1]
+        return end - self.times[i]
+
+    def _update(self, start, stop, times, labels):
+        """
+        Replaces segments start:stop with new ones and updates the totals of
+        the replaced, inserted and preceding segment
+        """
+        first = max(start - 1, 0)
+        if self._totals is not None:
+            for i in range(first, stop):
+                self._totals[self.labels[i]] -= self._duration(i)
+        self.times[start:stop] = times
+        self.labels[start:stop] = labels
+        if self._totals is not None:
+            for i in range(first, start + len(times)):
+                self._totals[self.labels[i]] += self._duration(i)
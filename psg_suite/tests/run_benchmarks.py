@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+"""
+Benchmarks of the EEG pipeline on deterministic synthetic recordings
+
+Generates raw .dat and OpenVibe captures of several lengths, measures run time
+and peak traced memory of every pipeline stage, as well as import time of the
+compute-only and GUI modules in a fresh interpreter, and saves the results as JSON.
+When a baseline file is supplied, the run fails if any stage is slower or uses
+more memory than the baseline by more than the threshold.
+
+    python3 run_benchmarks.py --lengths nap,core --out results.json
+    python3 run_benchmarks.py --baseline results.json --threshold 0.25
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from timeit import default_timer as timer
+import numpy as np
+sys.path.append("../..")
+from psg_suite.eeg_data import EEGData
+from psg_suite.eeg_spectrum import EEGSpectralData
+from psg_suite.artifacts import detect_artifacts
+from psg_suite.stage_timeline import StageTimeline
+from psg_suite.report import render_report
+
+SAMPLING_RATE = 256
+#Recording lengths in seconds
+LENGTHS = {"nap": 20*60, "core": 90*60, "24h": 24*3600, "multiday": 3*24*3600}
+#N. of rows generated and written at once
+BLOCK = 1 << 20
+
+def synthetic_samples(n_samples, n_electrodes=2, seed=0, start=0):
+    """
+    Returns deterministic 10-bit EEG-like samples (drifting sleep rhythms plus noise)
+
+    Args:
+        n_samples: N. of samples returned
+        n_electrodes: N. of electrode traces
+        seed: Seed of the noise generator
+        start: Index of the first returned sample within the recording
+    """
+    rng = np.random.RandomState(seed + start)
+    t = (start + np.arange(n_samples)) / SAMPLING_RATE
+    out = np.empty((n_samples, n_electrodes))
+    for el in range(n_electrodes):
+        cycle = 0.5 + 0.5*np.sin(2*np.pi*t/5400 + el) #90 minute sleep cycle
+        sig = (60*cycle*np.sin(2*np.pi*1.5*t) + 25*(1-cycle)*np.sin(2*np.pi*10*t) +
+               10*np.sin(2*np.pi*13.5*t + el) + 20*rng.randn(n_samples))
+        out[:, el] = sig
+    return np.clip(np.round(out + 512), 0, 1023).astype(np.int16)
+
+def write_captures(length, directory):
+    """
+    Writes raw and OpenVibe captures of a recording length unless they already exist
+
+    Returns:
+        (raw, openvibe): Paths to the captures
+    """
+    n_samples = LENGTHS[length]*SAMPLING_RATE
+    raw = os.path.join(directory, length + ".dat")
+    ovibe = os.path.join(directory, length + ".ovibe")
+    if not os.path.isfile(raw) or not os.path.isfile(ovibe):
+        with open(raw + ".tmp", "w") as fr, open(ovibe + ".tmp", "w") as fo:
+            fo.write("Time (s);Channel 1;Channel 2;Sampling Rate\n")
+            for start in range(0, n_samples, BLOCK):
+                s = synthetic_samples(min(BLOCK, n_samples - start), start=start)
+                np.savetxt(fr, s, fmt="%d", delimiter=" ")
+                t = (start + np.arange(s.shape[0])) / SAMPLING_RATE
+                rows = ["%f;%d;%d;" % (t[n], s[n, 0], s[n, 1]) for n in range(s.shape[0])]
+                if start == 0:
+                    rows[0] += str(SAMPLING_RATE)
+                fo.write("\n".join(rows) + "\n")
+        os.replace(raw + ".tmp", raw)
+        os.replace(ovibe + ".tmp", ovibe)
+    return raw, ovibe
+
+def measure(fn, repeat=1, memory=True):
+    """
+    Runs fn repeat times for timing and once more with tracemalloc for peak memory
+    (tracing slows down Python loops too much to time the same run)
+
+    Returns:
+        (result, stats): Result of the last run and dictionary with the best time
+                         in seconds and the traced peak memory in bytes
+    """
+    best = None
+    for r in range(repeat):
+        gc.collect()
+        start = timer()
+        result = fn()
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = 0
+    if memory:
+        del result
+        gc.collect()
+        tracemalloc.start()
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, {"seconds": best, "peak_bytes": peak}
+
+def approximation_error(reference, approx):
+    """
+    Returns errors of approximate spectra relative to the mean reference power of
+    every electrode and frequency (per-window relative errors are meaningless for
+    the many near-zero periodogram values)
+    """
+    scale = np.mean(reference, axis=1, keepdims=True)
+    err = np.abs(approx - reference)/scale
+    return {"median_error": float(np.median(err)), "p99_error": float(np.percentile(err, 99)),
+            "max_error": float(np.max(err)),
+            "max_mean_spectrum_db": float(np.max(np.abs(10*np.log10(np.mean(approx, axis=1)/scale[:,0]))))}
+
+def run_length(length, directory, repeat=1, memory=True, n_edits=2000):
+    """
+    Benchmarks all stages on one recording length
+
+    Returns:
+        results: Dictionary mapping stage name to measure() stats
+    """
+    raw, ovibe = write_captures(length, directory)
+    results = {}
+    def load_raw(workers=1):
+        d = EEGData()
+        d.load_raw(raw, workers=workers)
+        return d
+    def load_openvibe(workers=1):
+        d = EEGData()
+        d.load_openvibe(ovibe, workers=workers)
+        return d
+    raw_data, results["load_raw"] = measure(load_raw, repeat, memory)
+    #Parallel parsing on all CPUs, peak memory of the worker processes is not traced
+    data, results["load_raw_parallel"] = measure(lambda: load_raw(None), repeat, memory)
+    data, results["load_openvibe"] = measure(load_openvibe, repeat, memory)
+    data, results["load_openvibe_parallel"] = measure(lambda: load_openvibe(None), repeat, memory)
+    pkl = os.path.join(directory, length + ".pkl")
+    def pickle_roundtrip():
+        data.save_pkl(pkl)
+        d = EEGData()
+        d.load_pkl(pkl)
+        return d
+    unused, results["pickle_roundtrip"] = measure(pickle_roundtrip, repeat, memory)
+    os.remove(pkl)
+    #data holds the OpenVibe capture, raw_data the same signal from the raw capture
+    mask, results["detect_artifacts"] = measure(lambda: detect_artifacts(raw_data), repeat, memory)
+    ovibe_mask, results["detect_artifacts_ovibe"] = measure(lambda: detect_artifacts(data), repeat, memory)
+    if not np.array_equal(ovibe_mask, mask):
+        raise AssertionError("Artifacts of the OpenVibe capture differ from the raw capture: " +
+                             str(ovibe_mask) + " vs " + str(mask))
+    del raw_data
+    spectrum, results["spectrum"] = measure(lambda: EEGSpectralData(data), repeat, memory)
+    def cutoff():
+        s = EEGSpectralData()
+        s.data = spectrum.data
+        s.frequencystamps = spectrum.frequencystamps
+        s.frequency_cutoff(25)
+        return s
+    unused, results["frequency_cutoff"] = measure(cutoff, repeat, memory)
+    decimated, results["spectrum_decimated"] = measure(lambda: EEGSpectralData(data, cutoff=25), repeat, memory)
+    results["spectrum_decimated"].update(approximation_error(spectrum.data[:,:,:decimated.data.shape[2]],
+                                                             decimated.data))
+    rng = np.random.RandomState(0)
+    clicks = rng.uniform(0, data.sleep_duration(), n_edits)
+    stages = rng.randint(0, 7, n_edits)
+    def stage_edits():
+        tl = StageTimeline(data.sleep_duration())
+        tl.durations()
+        for n in range(n_edits):
+            tl.paint(clicks[n], stages[n])
+            tl.durations()
+        return tl
+    unused, results["stage_edits"] = measure(stage_edits, repeat, memory)
+    #Whole report of the raw capture: loading, artifacts, spectrogram and the Agg render
+    png = os.path.join(directory, length + ".png")
+    unused, results["render_report"] = measure(lambda: render_report(raw, png), repeat, memory)
+    os.remove(png)
+    return results
+
+#Modules imported by headless compute-only use and by the labeling GUI
+STARTUP_IMPORTS = {"compute_import": "psg_suite.eeg_data, psg_suite.eeg_spectrum, psg_suite.band_features, "
+                                     "psg_suite.auto_stage, psg_suite.spectrum_cache",
+                   "gui_import": "psg_suite.eeg_spectrum, matplotlib.pyplot, psg_suite.plotting_util"}
+STARTUP_SCRIPT = ("import resource, sys, timeit; start = timeit.default_timer(); import %s; "
+                  "print(timeit.default_timer() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024, "
+                  "int('matplotlib' in sys.modules))")
+
+def measure_startup(repeat=3):
+    """
+    Measures import time and peak resident memory of STARTUP_IMPORTS in fresh interpreters
+
+    Returns:
+        results: Dictionary mapping import set name to stats with the best time in seconds,
+                 peak resident memory in bytes and whether matplotlib got imported
+    """
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+    results = {}
+    for name, modules in STARTUP_IMPORTS.items():
+        best = None
+        for r in range(repeat):
+            out = subprocess.check_output([sys.executable, "-c", STARTUP_SCRIPT % modules], cwd=root)
+            seconds, peak, plotting = out.split()
+            best = float(seconds) if best is None else min(best, float(seconds))
+        results[name] = {"seconds": best, "peak_bytes": int(peak), "matplotlib": bool(int(plotting))}
+    return results
+
+#Differences below these are treated as noise
+MIN_DIFFERENCE = {"seconds": 0.01, "peak_bytes": 1 << 20}
+
+def compare(results, baseline, threshold):
+    """
+    Returns list of regressions of results against baseline exceeding threshold (0.2 = 20 %)
+    and MIN_DIFFERENCE
+    """
+    regressions = []
+    for length, stages in results.items():
+        for stage, stats in stages.items():
+            base = baseline.get(length, {}).get(stage)
+            if base is None:
+                continue
+            for key in ("seconds", "peak_bytes"):
+                if (stats[key] > base[key]*(1 + threshold) and
+                        stats[key] - base[key] > MIN_DIFFERENCE[key]):
+                    regressions.append("%s/%s %s: %.4g -> %.4g (+%.0f %%)" %
+                                       (length, stage, key, base[key], stats[key],
+                                        100*(stats[key]/max(base[key], 1e-12) - 1)))
+    return regressions
+
+def mf():
+    parser = argparse.ArgumentParser(description="Benchmarks the EEG pipeline on synthetic recordings")
+    parser.add_argument("--lengths", default="nap,core", help="Comma separated recording lengths: " + ",".join(LENGTHS))
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "psg_benchmark_data"),
+                        help="Directory for the generated captures, reused by later runs")
+    parser.add_argument("--repeat", type=int, default=3, help="N. of runs per stage, the best time is reported")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the traced peak memory runs")
+    parser.add_argument("--out", default="benchmark_results.json", help="Results JSON file")
+    parser.add_argument("--baseline", default=None, help="Results JSON file of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative slowdown/memory growth")
+    args = parser.parse_args()
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = {}
+    print("Benchmarking startup ...")
+    results["startup"] = measure_startup(args.repeat)
+    for stage, stats in results["startup"].items():
+        print("  %-22s %9.3f s %10.1f MB%s" % (stage, stats["seconds"], stats["peak_bytes"]/2**20,
+                                                " (loads matplotlib)" if stats["matplotlib"] else ""))
+    for length in args.lengths.split(","):
+        print("Benchmarking " + length + " ...")
+        results[length] = run_length(length, args.data_dir, args.repeat, not args.no_memory)
+        for stage, stats in results[length].items():
+            print("  %-22s %9.3f s %10.1f MB" % (stage, stats["seconds"], stats["peak_bytes"]/2**20) +
+                  ("  error p99 %.2g max %.2g" % (stats["p99_error"], stats["max_error"]) if "p99_error" in stats else ""))
+    with open(args.out, "w") as f:
+        json.dump({"meta": {"python": platform.python_version(), "numpy": np.__version__,
+                            "machine": platform.machine(), "processor": platform.processor()},
+                   "results": results}, f, indent=1)
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    for r in regressions:
+        print("REGRESSION " + r)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(mf())
@@ -2,8 +2,36 @@
 
 import unittest
 import sys
-sys.path.append("..")
-import eeg_data
+import os
+import tempfile
+import numpy as np
+sys.path.append("../..")
+from psg_suite import eeg_data
+from psg_suite import eeg_spectrum
+from psg_suite import eeg_container
+from psg_suite import spectrum_cache
+from psg_suite import eeg_live
+from psg_suite import sleep_stage_label
+from psg_suite import instrumentation
+from psg_suite import spectral_estimators
+from psg_suite import band_features
+from psg_suite import auto_stage
+from psg_suite import label_corpus
+from psg_suite import artifacts
+from psg_suite import progressive
+from psg_suite import report
+from psg_suite.stage_timeline import StageTimeline, SLEEP_STAGE_LABELS
+
+def synthetic_eegdata(n_samples=60000, n_electrodes=2, seed=0):
+    rng = np.random.RandomState(seed)
+    d = eeg_data.EEGData()
+    d.data = rng.randint(0, 1024, size=(n_samples, n_electrodes)).astype(np.float64)
+    d.bitrate = 10
+    d.n_electrodes = n_electrodes
+    d.sampling_rate = 256
+    d.origin = 512
+    d.standartized = False
+    return d
 
 class EEGDataTest(unittest.TestCase):
 
@@ -34,6 +62,697 @@ class EEGDataTest(unittest.TestCase):
         self.assertEqual(l.standartized,d.standartized)
         self.assertEqual(l.data.all(),d.data.all())
 
+    def test_load_openvibe_chunked(self):
+        rng = np.random.RandomState(0)
+        values = rng.randint(0, 1024, size=(1000, 2))
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'recording.ovibe')
+            with open(fname, 'w') as f:
+                f.write("Time (s);Channel 1;Channel 2;Sampling Rate\n")
+                for n in range(values.shape[0]):
+                    f.write("%f;%d;%d;%s\n" % (n/256, values[n,0], values[n,1], "256" if n == 0 else ""))
+            d = eeg_data.EEGData()
+            d.load_openvibe(fname, chunk_size=100)
+            c = eeg_data.EEGData()
+            c.load_openvibe(fname, dtype=np.int16)
+        self.assertEqual(d.sampling_rate,256)
+        self.assertEqual(d.n_electrodes,2)
+        np.testing.assert_array_equal(d.data, values - 512)
+        self.assertEqual(c.data.dtype, np.int16)
+        np.testing.assert_array_equal(c.data, d.data)
+
+    def test_load_parallel(self):
+        rng = np.random.RandomState(0)
+        values = rng.randint(0, 1024, size=(1000, 3))
+        with tempfile.TemporaryDirectory() as tmp:
+            raw = os.path.join(tmp, 'recording.dat')
+            with open(raw, 'w') as f:
+                f.write("\n".join("%d %d %d" % tuple(v) for v in values))
+            ovibe = os.path.join(tmp, 'recording.ovibe')
+            with open(ovibe, 'w') as f:
+                f.write("Time (s);Channel 1;Channel 2;Sampling Rate\r\n")
+                for n in range(values.shape[0]):
+                    f.write("%f;%d;%d;%s\r\n" % (n/256, values[n,0], values[n,1], "256" if n == 0 else ""))
+            for fname, load in ((raw, "load_raw"), (ovibe, "load_openvibe")):
+                for dtype in (np.float64, np.int16):
+                    d = eeg_data.EEGData()
+                    getattr(d, load)(fname, dtype=dtype)
+                    p = eeg_data.EEGData()
+                    getattr(p, load)(fname, dtype=dtype, workers=3, chunk_size=500)
+                    self.assertEqual(p.data.dtype, d.data.dtype)
+                    self.assertEqual(p.sampling_rate, d.sampling_rate)
+                    np.testing.assert_array_equal(p.data, d.data)
+            #Errors are raised for the first bad line, as by the serial loaders
+            with open(raw, 'a') as f:
+                f.write("\n1 x 2\n1\n")
+            with open(ovibe, 'a') as f:
+                f.write("1.0;1;y;\n")
+            for fname, load in ((raw, "load_raw"), (ovibe, "load_openvibe")):
+                errors = []
+                for workers in (1, 3):
+                    with self.assertRaises(ValueError) as cm:
+                        getattr(eeg_data.EEGData(), load)(fname, workers=workers, chunk_size=500)
+                    errors.append(str(cm.exception))
+                self.assertEqual(errors[0], errors[1])
+            #Lone carriage returns fall back to the serial loader
+            with open(raw, 'w') as f:
+                f.write("1 2\r3 4\n5 6\r")
+            d = eeg_data.EEGData()
+            d.load_raw(raw, workers=2, chunk_size=1)
+            np.testing.assert_array_equal(d.data, [[1,2],[3,4],[5,6]])
+
+    def test_load_non_integer(self):
+        values = np.array([[512, 513.5], [40000, 7], [-3, 1023]])
+        with tempfile.TemporaryDirectory() as tmp:
+            raw = os.path.join(tmp, 'recording.dat')
+            with open(raw, 'w') as f:
+                f.write("\n".join("%g %g" % tuple(v) for v in values))
+            ovibe = os.path.join(tmp, 'recording.ovibe')
+            with open(ovibe, 'w') as f:
+                f.write("Time (s);Channel 1;Channel 2;Sampling Rate\n")
+                for n in range(values.shape[0]):
+                    f.write("%f;%g;%g;%s\n" % (n/256, values[n,0], values[n,1], "256" if n == 0 else ""))
+            for fname, expected in ((raw, values), (ovibe, values - 512)):
+                for workers in (1, 2):
+                    with self.assertWarns(UserWarning):
+                        d = eeg_data.load_capture(fname, workers=workers)
+                    self.assertEqual(d.data.dtype, np.float64)
+                    np.testing.assert_array_equal(d.data, expected)
+            #Integer values below the int16 range once shifted by -512
+            with open(ovibe, 'w') as f:
+                f.write("Time (s);Channel 1;Channel 2;Sampling Rate\n0.0;-32500;1;256\n")
+            with self.assertWarns(UserWarning):
+                d = eeg_data.load_capture(ovibe)
+            np.testing.assert_array_equal(d.data, [[-33012, -511]])
+
+    def test_compact_standartize(self):
+        d = synthetic_eegdata()
+        c = synthetic_eegdata()
+        c.data = c.data.astype(np.int16)
+        np.testing.assert_array_equal(eeg_spectrum.EEGSpectralData(c).data,
+                                      eeg_spectrum.EEGSpectralData(d).data)
+        s32 = c.standartized_data(np.float32)
+        self.assertEqual(s32.dtype, np.float32)
+        self.assertEqual(c.data.dtype, np.int16)
+        d.standartize()
+        np.testing.assert_array_equal(d.data, (c.data - 512) / 512.0)
+        np.testing.assert_allclose(s32, d.data, rtol=1e-6)
+
+class EEGSpectralDataTest(unittest.TestCase):
+
+    def test_batched_matches_reference(self):
+        d = synthetic_eegdata()
+        ref = eeg_spectrum.EEGSpectralData(d, mode="reference")
+        bat = eeg_spectrum.EEGSpectralData(d, batch_size=7)
+        self.assertEqual(bat.data.shape, ref.data.shape)
+        np.testing.assert_allclose(bat.data, ref.data, rtol=1e-9)
+        np.testing.assert_array_equal(bat.samplestamps, ref.samplestamps)
+
+    def test_estimators(self):
+        d = synthetic_eegdata()
+        ref = eeg_spectrum.EEGSpectralData(d)
+        #Welch with a single Hamming segment is the periodogram
+        welch = spectral_estimators.Welch(segment=2048, taper="hamming")
+        np.testing.assert_allclose(eeg_spectrum.EEGSpectralData(d, estimator=welch).data, ref.data, rtol=1e-9)
+        welch = eeg_spectrum.EEGSpectralData(d, estimator="welch", batch_size=20)
+        self.assertEqual(welch.data.shape, (2, ref.data.shape[1], 257))
+        self.assertEqual(welch.frequencystamps[-1], d.sampling_rate/2)
+        mt = eeg_spectrum.EEGSpectralData(d, estimator=spectral_estimators.Multitaper(nw=3), batch_size=50)
+        self.assertEqual(mt.estimator, "multitaper(k=5,nw=3)")
+        import spectrum
+        tapers, eigen = spectrum.dpss(2048, 3, 5)
+        w = d.data[mt.samplestamps[3]-2048:mt.samplestamps[3], 1]
+        power = np.abs(np.fft.rfft(w[:,None]*tapers, axis=0))**2
+        expected = power.dot(eigen/np.sum(eigen)) * np.sum(np.hamming(2048)**2) * 2*np.pi/d.sampling_rate
+        np.testing.assert_allclose(mt.data[1,3], expected, rtol=1e-9)
+        with self.assertRaises(ValueError):
+            eeg_spectrum.EEGSpectralData(d, estimator="welch", mode="reference")
+
+    def test_band_features(self):
+        d = synthetic_eegdata(n_samples=256*600)
+        s = eeg_spectrum.EEGSpectralData(d)
+        table = s.band_features()
+        centres = (s.samplestamps - s.window/2)/s.sampling_rate
+        self.assertEqual(len(table["epoch"]), int(centres[-1]//30) + 1)
+        self.assertEqual(len(table), 2 + 2*(len(band_features.BANDS) + len(band_features.RATIOS)))
+        df = s.frequencystamps[1]
+        for ep in (0, 7, len(table["epoch"])-1):
+            rows = (centres >= 30*ep) & (centres < 30*(ep+1))
+            for el in range(2):
+                theta = (s.frequencystamps >= 4) & (s.frequencystamps < 8)
+                expected = np.mean([np.sum(s.data[el,w,theta])*df for w in np.flatnonzero(rows)])
+                self.assertAlmostEqual(table["theta_" + str(el)][ep]/expected, 1, places=9)
+        slow = table["delta_1"] + table["theta_1"]
+        np.testing.assert_allclose(table["slow_fast_1"], slow/(table["alpha_1"] + table["beta_1"]))
+        with tempfile.TemporaryDirectory() as tmp:
+            band_features.save_csv(table, os.path.join(tmp, 'features.csv'))
+            ld = np.genfromtxt(os.path.join(tmp, 'features.csv'), delimiter=',', names=True)
+        np.testing.assert_allclose(ld["alpha_0"], table["alpha_0"])
+
+    def test_parallel_bit_identical(self):
+        d = synthetic_eegdata()
+        ref = eeg_spectrum.EEGSpectralData(d, batch_size=7)
+        self.assertEqual(eeg_spectrum.time_partitions(30, 4, 7), [(0, 14), (14, 28), (28, 30)])
+        for pool in ("thread", "process"):
+            s = eeg_spectrum.EEGSpectralData(d, batch_size=7, workers=3, pool=pool)
+            np.testing.assert_array_equal(s.data, ref.data)
+        with tempfile.TemporaryDirectory() as tmp:
+            d.save_bin(os.path.join(tmp, 'recording.psgb'))
+            ld = eeg_data.EEGData()
+            ld.load_bin(os.path.join(tmp, 'recording.psgb'))
+            s = eeg_spectrum.EEGSpectralData(ld, batch_size=7, workers=2, pool="process",
+                                             out_fname=os.path.join(tmp, 'spectrum.psgb'))
+            np.testing.assert_array_equal(s.data, ref.data)
+            del s, ld
+
+    def test_decimated_cutoff(self):
+        d = synthetic_eegdata(n_samples=256*1800)
+        ref = eeg_spectrum.EEGSpectralData(d)
+        ref.frequency_cutoff(25)
+        for estimator in ("periodogram", "welch"):
+            full = eeg_spectrum.EEGSpectralData(d, estimator=estimator)
+            full.frequency_cutoff(25)
+            s = eeg_spectrum.EEGSpectralData(d, cutoff=25, estimator=estimator, batch_size=50)
+            self.assertEqual(s.decimation, 4)
+            np.testing.assert_array_equal(s.frequencystamps, full.frequencystamps)
+            np.testing.assert_array_equal(s.timestamps, full.timestamps)
+            #Errors come from out of band leakage of the full rate windows
+            err = np.abs(s.data - full.data)/np.mean(full.data, axis=1, keepdims=True)
+            self.assertLess(np.percentile(err, 99), 0.05)
+        #Batches are decimated when they are read, the decimated signal is never held whole
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            budgeted = eeg_spectrum.EEGSpectralData(d, cutoff=25, estimator="welch", memory_budget=1 << 18)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        np.testing.assert_array_equal(budgeted.data, s.data)
+        self.assertLess(peak - budgeted.data.nbytes, d.data.shape[0]//4*2*8//2)
+        for pool in ("thread", "process"):
+            parallel = eeg_spectrum.EEGSpectralData(d, cutoff=25, estimator="welch", batch_size=50,
+                                                    workers=3, pool=pool)
+            np.testing.assert_array_equal(parallel.data, s.data)
+        s.frequency_cutoff(25)
+        self.assertEqual(s.data.shape[2], len(s.frequencystamps))
+        s = eeg_spectrum.EEGSpectralData(d, cutoff=100)
+        self.assertEqual(s.decimation, 1)
+        self.assertEqual(s.frequencystamps[-1], 100)
+
+    def test_artifact_mask(self):
+        d = synthetic_eegdata(n_samples=256*1200)
+        rng = np.random.RandomState(1)
+        d.data[256*300:256*400,:] = 512 #Electrodes off
+        d.data[256*600:256*630,0] = np.clip(512 + 2000*rng.randn(256*30), 0, 1023).round()
+        t = np.arange(256*60)/256.0
+        d.data[256*900:256*960,1] = 512 + 100*rng.randn(256*60) + 300*np.sin(2*np.pi*50*t)
+        stats = artifacts.window_stats(d)
+        seg = d.data[256*600:256*602,0] - 512
+        self.assertAlmostEqual(stats["variance"][600,0], np.var(seg), delta=1e-6*np.var(seg))
+        self.assertAlmostEqual(stats["clipped"][600,0], np.mean((seg <= -512) | (seg >= 511)))
+        mask = artifacts.detect_artifacts(d)
+        np.testing.assert_allclose(mask, [[300, 400], [599, 631], [899, 961]], atol=1)
+        #OpenVibe samples are stored centered on 0, the clip levels follow
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'recording.ovibe')
+            with open(fname, 'w') as f:
+                f.write("Time (s);Channel 1;Channel 2;Sampling Rate\n")
+                for n in range(d.data.shape[0]):
+                    f.write("%f;%d;%d;%s\n" % (n/256, d.data[n,0], d.data[n,1], "256" if n == 0 else ""))
+            o = eeg_data.EEGData()
+            o.load_openvibe(fname, dtype=np.int16)
+            self.assertEqual(artifacts.clip_levels(o), (-512, 511))
+            np.testing.assert_array_equal(artifacts.detect_artifacts(o), mask)
+            #OpenVibe pickles written before the shifted origin was stored carry origin 512
+            o.origin = 512
+            o.save_pkl(fname + '.pkl')
+            legacy = eeg_data.EEGData()
+            legacy.load_pkl(fname + '.pkl')
+            converted = eeg_data.EEGData()
+            converted.load_bin(eeg_container.convert_pkl(fname + '.pkl'))
+            d.save_pkl(fname + '.raw.pkl')
+            raw = eeg_data.EEGData()
+            raw.load_pkl(fname + '.raw.pkl')
+        for l in (legacy, converted):
+            self.assertEqual(artifacts.clip_levels(l), (-512, 511))
+            np.testing.assert_array_equal(artifacts.detect_artifacts(l), mask)
+        self.assertEqual(raw.origin, 512)
+        full = eeg_spectrum.EEGSpectralData(d)
+        masked = eeg_spectrum.EEGSpectralData(d, mask=mask, batch_size=8)
+        skip = artifacts.masked_windows(full.samplestamps, full.window, full.sampling_rate, mask)
+        self.assertTrue(np.any(skip))
+        self.assertTrue(np.all(np.isnan(masked.data[:,skip,:])))
+        np.testing.assert_allclose(masked.data[:,~skip,:], full.data[:,~skip,:], rtol=1e-12)
+        parallel = eeg_spectrum.EEGSpectralData(d, mask=mask, batch_size=8, workers=3)
+        np.testing.assert_array_equal(parallel.data, masked.data)
+        labels = auto_stage.auto_label(masked, sleep_length=d.sleep_duration(), mask=mask)
+        for start, end in mask:
+            self.assertEqual(labels.timeline.label_at(start), auto_stage.MASK_OFF)
+            self.assertEqual(labels.timeline.label_at(end - 0.1), auto_stage.MASK_OFF)
+        self.assertAlmostEqual(sum(labels.stage_durations().values()), 1200)
+
+    def test_progressive(self):
+        d = synthetic_eegdata(n_samples=256*1200)
+        mask = np.array([[300.0, 400.0]])
+        ref = eeg_spectrum.EEGSpectralData(d, mask=mask, batch_size=8)
+        for workers in (1, 3):
+            reports = []
+            s = eeg_spectrum.EEGSpectralData(d, mask=mask, batch_size=8, workers=workers,
+                                             progress=lambda *args: reports.append(args[1:]))
+            np.testing.assert_array_equal(s.data, ref.data)
+            stride = eeg_spectrum.PREVIEW_STRIDE
+            coarse = [r for r in reports if r[3] == stride]
+            self.assertTrue(coarse and reports[:len(coarse)] == coarse)
+            skip = artifacts.masked_windows(s.samplestamps, s.window, s.sampling_rate, mask)
+            for el in range(2):
+                #Masked windows are never computed
+                covered = skip.copy()
+                for r in reports[len(coarse):]:
+                    if r[0] == el:
+                        covered[r[1]:r[2]] = True
+                self.assertTrue(np.all(covered))
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        p = progressive.ProgressiveSpectrogram(
+            lambda progress: eeg_spectrum.EEGSpectralData(d, mask=mask, batch_size=8, progress=progress),
+            ref.step, ref.sampling_rate, cutoff=25)
+        fig, axes = plt.subplots(2)
+        completed = []
+        p.on_complete(completed.append)
+        p.plot(elid=0, axes=axes[0])
+        p.plot(elid=1, axes=axes[1])
+        self.assertIsNotNone(p.wait(60))
+        p._poll()
+        self.assertEqual(completed, [p.result])
+        np.testing.assert_array_equal(p.result.data, ref.data)
+        self.assertEqual(p.index_to_time(10), ref.index_to_time(10))
+        self.assertEqual(axes[1].images[0].get_array().shape[1], ref.data.shape[1])
+        plt.close(fig)
+
+    def test_segments(self):
+        d = synthetic_eegdata(n_samples=256*1200)
+        seg = d.segment(70, 700)
+        self.assertTrue(np.shares_memory(seg.data, d.data))
+        self.assertEqual(seg.first_sample, 70*256)
+        self.assertEqual(seg.sleep_duration(), 630)
+        self.assertEqual(seg.segment(10).start_time(), 80)
+        full = eeg_spectrum.EEGSpectralData(d)
+        computed = eeg_spectrum.EEGSpectralData(seg)
+        view = full.segment(70, 700)
+        self.assertTrue(np.shares_memory(view.data, full.data))
+        np.testing.assert_array_equal(view.data, computed.data)
+        np.testing.assert_array_equal(view.samplestamps, computed.samplestamps)
+        np.testing.assert_array_equal(view.timestamps, computed.timestamps)
+        self.assertEqual(view.first_sample, computed.first_sample)
+        self.assertEqual(full.segment(1200).data.shape[1], 0)
+        with tempfile.TemporaryDirectory() as tmp:
+            computed.save_bin(os.path.join(tmp, 'segment.psgb'))
+            ld = eeg_spectrum.EEGSpectralData()
+            ld.load_bin(os.path.join(tmp, 'segment.psgb'))
+            self.assertEqual(ld.start_time(), 70)
+            del ld
+
+    def test_bin_roundtrip(self):
+        d = synthetic_eegdata()
+        s = eeg_spectrum.EEGSpectralData(d)
+        with tempfile.TemporaryDirectory() as tmp:
+            d.save_bin(os.path.join(tmp, 'recording.psgb'))
+            s.save_pkl(os.path.join(tmp, 'spectrum.pkl'))
+            fname = eeg_container.convert_pkl(os.path.join(tmp, 'spectrum.pkl'))
+            ld = eeg_data.EEGData()
+            ld.load_bin(os.path.join(tmp, 'recording.psgb'))
+            ls = eeg_spectrum.EEGSpectralData()
+            ls.load_bin(fname)
+            self.assertIsInstance(ld.data, np.memmap)
+            self.assertEqual(ld.sampling_rate, d.sampling_rate)
+            self.assertEqual(ld.origin, d.origin)
+            np.testing.assert_array_equal(ld.data, d.data)
+            self.assertEqual((ls.window, ls.step), (s.window, s.step))
+            np.testing.assert_array_equal(ls.data, s.data)
+            np.testing.assert_array_equal(ls.frequencystamps, s.frequencystamps)
+            np.testing.assert_array_equal(ls.timestamps, s.timestamps)
+            del ld, ls
+            #Spectral pickles written before window, step and n_electrodes were stored
+            s.frequency_cutoff(25)
+            segment = s.segment(20, 100).data
+            features = s.band_features()
+            for attr in ("window", "step", "n_electrodes"):
+                delattr(s, attr)
+            s.save_pkl(os.path.join(tmp, 'legacy.pkl'))
+            legacy = eeg_spectrum.EEGSpectralData()
+            legacy.load_pkl(os.path.join(tmp, 'legacy.pkl'))
+            converted = eeg_spectrum.EEGSpectralData()
+            converted.load_bin(eeg_container.convert_pkl(os.path.join(tmp, 'legacy.pkl')))
+            for l in (legacy, converted):
+                self.assertEqual((l.window, l.step, l.n_electrodes), (2048, 1792, 2))
+                np.testing.assert_array_equal(l.segment(20, 100).data, segment)
+                np.testing.assert_array_equal(l.band_features()["delta_1"], features["delta_1"])
+            del converted
+
+    def test_out_of_core(self):
+        d = synthetic_eegdata()
+        ref = eeg_spectrum.EEGSpectralData(d)
+        with tempfile.TemporaryDirectory() as tmp:
+            d.save_bin(os.path.join(tmp, 'recording.psgb'))
+            md = eeg_data.EEGData()
+            md.load_bin(os.path.join(tmp, 'recording.psgb'))
+            s = eeg_spectrum.EEGSpectralData(md, memory_budget=200000,
+                                             out_fname=os.path.join(tmp, 'spectrum.psgb'))
+            self.assertIsInstance(s.data, np.memmap)
+            np.testing.assert_allclose(s.data, ref.data, rtol=1e-9)
+            ls = eeg_spectrum.EEGSpectralData()
+            ls.load_bin(os.path.join(tmp, 'spectrum.psgb'))
+            np.testing.assert_array_equal(ls.data, s.data)
+            np.testing.assert_array_equal(ls.samplestamps, ref.samplestamps)
+            del md, s, ls
+
+    def test_live_matches_batch(self):
+        d = synthetic_eegdata()
+        ref = eeg_spectrum.EEGSpectralData(d)
+        live = eeg_live.LiveSpectralData(d.sampling_rate, capacity=2)
+        rng = np.random.RandomState(1)
+        pos = 0
+        while pos < d.data.shape[0]:
+            n = rng.randint(1, 5000)
+            live.append(d.data[pos:pos+n])
+            pos += n
+            self.assertEqual(live.data.shape[1], len(range(live.window, min(pos, d.data.shape[0]), live.step)))
+        np.testing.assert_allclose(live.data, ref.data, rtol=1e-12)
+        np.testing.assert_array_equal(live.samplestamps, ref.samplestamps)
+        np.testing.assert_array_equal(live.timestamps, ref.timestamps)
+        self.assertLess(live.buffer.data.shape[0], d.data.shape[0])
+
+    def test_log_pyramid(self):
+        s = eeg_spectrum.EEGSpectralData(synthetic_eegdata(n_samples=600000))
+        pyramid = s.log_pyramid(1)
+        self.assertIs(s.log_pyramid(1), pyramid)
+        log_hist = np.log(s.data[1])
+        self.assertAlmostEqual(pyramid.vmin, np.min(log_hist)+0.43*np.ptp(log_hist))
+        np.testing.assert_allclose(pyramid.levels[1][:10], 0.5*(log_hist[0:20:2]+log_hist[1:20:2]))
+        self.assertEqual(pyramid.level_for(log_hist.shape[0], 80), 2)
+        s.frequency_cutoff(25)
+        self.assertIsNot(s.log_pyramid(1), pyramid)
+
+class SpectrumCacheTest(unittest.TestCase):
+
+    def test_hit_miss_evict(self):
+        d = synthetic_eegdata()
+        s = eeg_spectrum.EEGSpectralData(d)
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'recording.dat')
+            np.savetxt(fname, d.data, fmt='%d')
+            cache = spectrum_cache.SpectrumCache(os.path.join(tmp, 'cache'), max_bytes=s.data.nbytes*3//2)
+            key = cache.key(fname, cutoff=25)
+            self.assertNotEqual(key, cache.key(fname, cutoff=30))
+            self.assertEqual(cache.get(key), (None, None))
+            cache.put(key, s, sleep_duration=d.sleep_duration())
+            cached, attrs = cache.get(key)
+            np.testing.assert_array_equal(cached.data, s.data)
+            self.assertEqual(attrs["sleep_duration"], d.sleep_duration())
+            self.assertEqual(cache.stats()["total_hits"], 1)
+            self.assertEqual(cache.stats()["total_misses"], 1)
+            os.utime(cache.path(key), (0, 0))
+            cache.put(cache.key(fname, cutoff=30), s, sleep_duration=d.sleep_duration())
+            self.assertFalse(os.path.exists(cache.path(key)))
+            del cached
+
+class SleepStageLabelTest(unittest.TestCase):
+
+    def test_timeline_paint(self):
+        tl = StageTimeline(100.0)
+        tl.durations()
+        tl.paint(10, 4)
+        tl.paint(40, 1)
+        tl.paint(70, 2)
+        self.assertEqual(tl.times, [0.0, 10.0, 40.0, 70.0])
+        self.assertEqual(tl.labels, [5, 4, 1, 2])
+        tl.paint(20, 4) #Previous segment is already WAKE, merges up to the REM segment
+        self.assertEqual(tl.times, [0.0, 10.0, 70.0])
+        self.assertEqual(tl.labels, [5, 4, 2])
+        tl.paint(5, 4) #Relabels from 5 s and merges with the following WAKE segment
+        self.assertEqual(tl.times, [0.0, 5.0, 70.0])
+        self.assertEqual(tl.label_at(69.9), 4)
+        np.testing.assert_allclose(tl.durations(), StageTimeline(100.0, tl.times, tl.labels).durations())
+        np.testing.assert_allclose(tl.durations(), [0, 0, 30, 0, 65, 5, 0])
+
+    def test_auto_label(self):
+        np.testing.assert_array_equal(auto_stage.smooth_labels(np.array([1,1,4,1,1,2,2,0,3])),
+                                      [1,1,1,1,1,2,2,0,3])
+        times, labels = auto_stage.merge_epochs([4,4,3,1,1,1])
+        np.testing.assert_array_equal(times, [0, 60, 90])
+        np.testing.assert_array_equal(labels, [4, 3, 1])
+        d = synthetic_eegdata(n_samples=256*3600)
+        d.data[256*1200:256*1500,:] = 512 #Electrodes off for 5 minutes
+        s = eeg_spectrum.EEGSpectralData(d)
+        s.frequency_cutoff(25)
+        l = auto_stage.auto_label(s, "rec", "", "", d.sleep_duration())
+        self.assertEqual(l.sleep_length, 3600)
+        self.assertEqual(l.stage_times[0], 0)
+        self.assertTrue(np.all(l.stage_labels[1:] != l.stage_labels[:-1]))
+        np.testing.assert_array_equal(l.loaded_stage_labels, l.stage_labels)
+        self.assertEqual(l.timeline.label_at(1350), auto_stage.MASK_OFF)
+        self.assertAlmostEqual(sum(l.stage_durations().values()), 3600)
+
+    def test_auto_stage_epochs(self):
+        #Band powers of a mixed EEG epoch, scaled per band by the profile of each block
+        base = np.array([100.0, 30.0, 15.0, 8.0, 10.0])
+        profiles = {"mixed": np.ones(5), "delta": np.array([6, 1, 0.5, 0.5, 0.3]),
+                    "alpha": np.array([0.3, 1, 6, 1, 2]), "beta": np.array([0.3, 1, 1.5, 1, 8]),
+                    "flat": np.full(5, 1e-4), "outlier": np.full(5, 1e4)}
+        blocks = [("mixed", 20), ("delta", 10), ("mixed", 10), ("alpha", 10), ("mixed", 10),
+                  ("beta", 10), ("mixed", 10), ("flat", 5), ("mixed", 10), ("outlier", 5), ("mixed", 10)]
+        rng = np.random.RandomState(0)
+        powers = np.concatenate([np.tile(base*profiles[p], (n, 1)) for p, n in blocks])
+        table = {}
+        for el in range(2):
+            noisy = powers*np.exp(0.1*rng.randn(*powers.shape))
+            for b, band in enumerate(auto_stage.MODEL_BANDS):
+                table[band + "_" + str(el)] = noisy[:,b]
+        labels = auto_stage.stage_epochs(table)
+        expected = {"delta": "NREM3", "alpha": "WAKE", "beta": "WAKE", "flat": "MASK OFF", "outlier": "MASK OFF"}
+        start = 0
+        for profile, n in blocks:
+            if profile in expected:
+                np.testing.assert_array_equal(labels[start:start+n],
+                                              SLEEP_STAGE_LABELS.index(expected[profile]), err_msg=profile)
+            start += n
+        #Missing power is MASK OFF too
+        table["delta_0"][:3] = np.nan
+        self.assertTrue(np.all(auto_stage.stage_epochs(table)[:3] == auto_stage.MASK_OFF))
+
+    def test_label_corpus(self):
+        rng = np.random.RandomState(0)
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "sub"))
+            nights = []
+            for n in range(12):
+                labels = sleep_stage_label.SleepStageLabel("rec" + str(n % 2), "2018-01-%02d" % (n+1),
+                                                           "c1" if n % 3 else "n1", 3600.0)
+                labels.stage_times = np.r_[0, np.sort(rng.choice(np.arange(30, 3600, 30), 20, replace=False))]
+                labels.stage_labels = rng.randint(0, 7, size=21)
+                fname = os.path.join(tmp, "sub" if n % 4 == 0 else "", "night%d.stages" % n)
+                labels.save_txt(fname)
+                nights.append(fname)
+            corpus = label_corpus.LabelCorpus(os.path.join(tmp, "labels.psgb"))
+            self.assertEqual(corpus.ingest(tmp), 12)
+            corpus.save()
+            corpus = label_corpus.LabelCorpus(os.path.join(tmp, "labels.psgb"))
+            self.assertEqual(len(corpus), 12)
+            sel = corpus.select(sleep_block="c1", last=3)
+            self.assertEqual(corpus.date[sel].tolist(), ["2018-01-09", "2018-01-11", "2018-01-12"])
+            self.assertEqual(len(corpus.select(name="rec0", sleep_block="n1")), 2)
+            durations = corpus.stage_durations(sel)
+            latencies = corpus.latencies(nights=sel)
+            transitions = np.zeros((7, 7), dtype=int)
+            for row, i in enumerate(sel):
+                labels = sleep_stage_label.SleepStageLabel(None, None, None, None)
+                labels.load_txt(corpus.paths[i])
+                np.testing.assert_allclose(durations[row], [labels.stage_durations()[l]
+                                                            for l in SLEEP_STAGE_LABELS])
+                sleep = np.flatnonzero(np.isin(labels.loaded_stage_labels, [0, 1, 2, 3]))
+                self.assertEqual(latencies[row], labels.loaded_stage_times[sleep[0]])
+                l = labels.loaded_stage_labels
+                np.add.at(transitions, (l[:-1][l[1:] != l[:-1]], l[1:][l[1:] != l[:-1]]), 1)
+            np.testing.assert_array_equal(corpus.transition_counts(sel), transitions)
+            #Only changed files are read again, removed ones are dropped
+            labels.stage_labels = np.full(21, 4)
+            labels.save_txt(nights[11])
+            os.utime(nights[11], ns=(0, 10**18))
+            os.remove(nights[0])
+            self.assertEqual(corpus.ingest(tmp), 1)
+            self.assertEqual(len(corpus), 11)
+            self.assertEqual(corpus.stage_durations(corpus.select(date="2018-01-12"))[0,4], 3600)
+            self.assertEqual(corpus.ingest(tmp), 0)
+
+    def test_label_corpus_closing_segment(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            labels = sleep_stage_label.SleepStageLabel("rec", "2018-01-01", "c1", 3600.0)
+            labels.stage_times = [0, 600, 1800]
+            labels.stage_labels = [4, 1, 0]
+            #Closing segment added by label_manual when the dialog is closed
+            labels.timeline.set_segments(labels.timeline.times + [labels.sleep_length],
+                                         labels.timeline.labels + [6])
+            fname = os.path.join(tmp, "night.stages")
+            labels.save_txt(fname)
+            with open(fname) as f:
+                self.assertEqual(f.read().splitlines()[-1], "3600.0,6")
+            corpus = label_corpus.LabelCorpus(os.path.join(tmp, "labels.psgb"))
+            corpus.ingest(tmp)
+            np.testing.assert_array_equal(corpus.labels, [4, 1, 0])
+            np.testing.assert_array_equal(corpus.durations, [600, 1200, 1800])
+            expected = np.zeros((7, 7), dtype=int)
+            expected[4, 1] = expected[1, 0] = 1
+            np.testing.assert_array_equal(corpus.transition_counts(), expected)
+            np.testing.assert_array_equal(corpus.stage_durations()[0], [1800, 1200, 0, 0, 600, 0, 0])
+            #Corpora saved with the closing segment drop it when loaded
+            corpus.offsets = np.array([0, 4])
+            corpus.times = np.r_[corpus.times, 3600.0]
+            corpus.labels = np.r_[corpus.labels, 6].astype(np.int8)
+            corpus.save()
+            corpus = label_corpus.LabelCorpus(os.path.join(tmp, "labels.psgb"))
+            np.testing.assert_array_equal(corpus.transition_counts(), expected)
+
+    def test_txt_roundtrip(self):
+        labels = sleep_stage_label.SleepStageLabel("rec", "2017-12-21", "c1", 120.0)
+        labels.stage_times = [0, 30, 90, 120]
+        labels.stage_labels = [4, 1, 2, 6]
+        with tempfile.TemporaryDirectory() as tmp:
+            labels.save_txt(os.path.join(tmp, 'rec.stages'))
+            l = sleep_stage_label.SleepStageLabel(None, None, None, None)
+            l.load_txt(os.path.join(tmp, 'rec.stages'))
+        self.assertEqual((l.name, l.sleep_block, l.sleep_length), ("rec", "c1", 120.0))
+        np.testing.assert_array_equal(l.stage_times, [0, 30, 90, 120])
+        np.testing.assert_array_equal(l.stage_labels, [4, 1, 2, 6])
+        self.assertEqual(l.stage_durations()['NREM2'], 60.0)
+        with self.assertRaises(ValueError):
+            l.stage_labels[1] = 3
+        self.assertEqual(l.timeline.labels[1], 1)
+
+    def test_label_manual_frames(self):
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        from matplotlib.backend_bases import MouseEvent, PickEvent
+        s = eeg_spectrum.EEGSpectralData(synthetic_eegdata(n_samples=256*600))
+        s.frequency_cutoff(25)
+        labels = sleep_stage_label.SleepStageLabel("rec", "", "", 600.0)
+        labels.label_manual(((s, {"elid": 0, "xlabels": False}),))
+        fig = plt.gcf()
+        fig.canvas.draw() #Caches the background as the first draw of a GUI window does
+        blits = []
+        canvas_blit = fig.canvas.blit
+        fig.canvas.blit = lambda bbox=None: (blits.append(bbox), canvas_blit(bbox))
+        ax = fig.axes[0]
+        for x in (5, 10, 15):
+            px, py = ax.transData.transform((x, 10))
+            fig.canvas.callbacks.process('motion_notify_event',
+                                         MouseEvent('motion_notify_event', fig.canvas, px, py))
+        self.assertEqual(labels.frame_times, [])
+        self.assertEqual(len(labels.cursor_frame_times), 3)
+        labels.stage_label = 2
+        px, py = ax.transData.transform((20, 10))
+        click = MouseEvent('button_press_event', fig.canvas, px, py, button=1)
+        fig.canvas.callbacks.process('pick_event', PickEvent('pick_event', fig.canvas, click, ax))
+        self.assertEqual(sleep_stage_label.frame_time_report(labels.frame_times)["frames"], 1)
+        self.assertGreater(len(blits), 3)
+        self.assertEqual(labels.timeline.label_at(s.index_to_time(21)), 2)
+        plt.close(fig)
+
+class ReportTest(unittest.TestCase):
+
+    def test_render_reports(self):
+        d = synthetic_eegdata(n_samples=256*600)
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'recording.psgb')
+            d.save_bin(fname)
+            labels = sleep_stage_label.SleepStageLabel("recording", "", "n1", 600.0)
+            labels.timeline = StageTimeline(600.0, [0, 100, 300], [5, 3, 1])
+            labels.save_txt(fname + '.stages')
+            missing = os.path.join(tmp, 'missing.dat')
+            for fmt, magic in (("png", b"\x89PNG"), ("pdf", b"%PDF")):
+                with self.assertWarns(UserWarning):
+                    out = report.render_reports([fname, missing], tmp, fmt, workers=2)
+                self.assertEqual(out, [os.path.join(tmp, 'recording.psgb.' + fmt), None])
+                with open(out[0], 'rb') as f:
+                    self.assertEqual(f.read(4), magic)
+            fig = report.render_figure(eeg_spectrum.EEGSpectralData(d), report.load_stages(fname + '.stages'))
+            self.assertEqual(len(fig.axes), 3)
+            np.testing.assert_array_equal(fig.axes[2].lines[0].get_xdata(), [0, 100, 300, 600])
+
+class BatchTest(unittest.TestCase):
+
+    def test_run_twice(self):
+        import batch
+        d = synthetic_eegdata(n_samples=256*120)
+        with tempfile.TemporaryDirectory() as indir:
+            os.makedirs(os.path.join(indir, 'sub'))
+            np.savetxt(os.path.join(indir, 'a.dat'), d.data, fmt='%d')
+            d.save_bin(os.path.join(indir, 'sub', 'b.psgb'))
+            with open(os.path.join(indir, 'bad.dat'), 'w') as f:
+                f.write("not a capture\n")
+            #Outputs inside the input tree are not captures
+            outdir = os.path.join(indir, 'out')
+            failed = batch.run(indir, outdir, workers=1)
+            self.assertEqual([os.path.basename(f) for f, tb in failed], ['bad.dat'])
+            outputs = [p for name in ('a.dat', os.path.join('sub', 'b.psgb'))
+                       for p in batch.output_paths(os.path.join(indir, name), indir, outdir)]
+            mtimes = [os.path.getmtime(p) for p in outputs]
+            self.assertEqual([os.path.basename(f) for f in batch.find_captures(indir, outdir)],
+                             ['a.dat', 'bad.dat', 'b.psgb'])
+            failed = batch.run(indir, outdir, workers=1)
+            self.assertEqual([os.path.basename(f) for f, tb in failed], ['bad.dat'])
+            self.assertEqual([os.path.getmtime(p) for p in outputs], mtimes)
+            #A newer .stages file makes its capture out of date
+            labels = sleep_stage_label.SleepStageLabel("a", "", "", 120.0)
+            labels.timeline = StageTimeline(120.0, [0, 60], [3, 1])
+            labels.save_txt(os.path.join(indir, 'a.dat.stages'))
+            future = max(mtimes) + 10
+            os.utime(os.path.join(indir, 'a.dat.stages'), (future, future))
+            batch.run(indir, outdir, workers=1)
+            self.assertGreater(os.path.getmtime(outputs[2]), mtimes[2])
+            self.assertEqual(os.path.getmtime(outputs[5]), mtimes[5])
+            with open(os.path.join(outdir, 'summary.csv')) as f:
+                self.assertEqual(len(f.read().splitlines()), 3)
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_spans(self):
+        d = synthetic_eegdata()
+        eeg_spectrum.EEGSpectralData(d).frequency_cutoff(25)
+        self.assertIsNone(instrumentation.disable())
+        instrumentation.enable()
+        try:
+            with instrumentation.span("pipeline"):
+                s = eeg_spectrum.EEGSpectralData(d)
+                s.frequency_cutoff(25)
+        finally:
+            report = instrumentation.disable()
+        spans = report["spans"]
+        self.assertEqual(set(spans), {"pipeline", "pipeline/EEGSpectralData.batched",
+                                      "pipeline/EEGSpectralData.frequency_cutoff"})
+        stat = spans["pipeline/EEGSpectralData.batched"]
+        self.assertEqual(stat["calls"], 1)
+        self.assertEqual(stat["bytes"], d.data.nbytes)
+        self.assertEqual(stat["counters"]["windows"], 2*s.data.shape[1])
+        self.assertGreaterEqual(spans["pipeline"]["seconds"], stat["seconds"])
+        if report["process_peak_rss_bytes"] is not None:
+            #Spans report how much they raised the process peak, not the process peak itself
+            self.assertGreaterEqual(spans["pipeline"]["peak_rss_increase_bytes"], stat["peak_rss_increase_bytes"])
+            self.assertLess(stat["peak_rss_increase_bytes"], stat["process_peak_rss_bytes"])
+            self.assertGreaterEqual(report["process_peak_rss_bytes"], spans["pipeline"]["process_peak_rss_bytes"])
+
+class ImportTest(unittest.TestCase):
+
+    def test_headless_imports(self):
+        import subprocess
+        script = ("import sys; import psg_suite.eeg_data, psg_suite.eeg_spectrum, psg_suite.sleep_stage_label, "
+                  "psg_suite.auto_stage, psg_suite.spectrum_cache, psg_suite.eeg_live, psg_suite.progressive, "
+                  "psg_suite.report; "
+                  "print(' '.join(m for m in ('matplotlib', 'spectrum', 'scipy', 'tkinter') if m in sys.modules))")
+        out = subprocess.check_output([sys.executable, "-c", script], cwd="../..")
+        self.assertEqual(out.strip(), b"")
+
 
 if __name__ == '__main__':
     unittest.main()
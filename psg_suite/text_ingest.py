@@ -0,0 +1,167 @@
+'''
+Contains parallel parsing of large text captures
+
+The file is split into byte ranges ending at line boundaries. Worker processes
+first count the lines of every range, so the first row of every range is known
+up front, then parse their ranges with the same block parser as the serial
+loader into a shared memory-mapped array. The error of the first failing range
+is raised, which is the error the serial loader raises at the same line.
+'''
+import concurrent.futures
+import io
+import os
+import tempfile
+import numpy as np
+from . import instrumentation
+
+class _IrregularLines(Exception):
+    """
+    Raised by a worker when its range splits into a different n. of lines than counted
+    (e.g. lone carriage returns), the caller then falls back to the serial loader
+    """
+    pass
+
+class UnrepresentableValues(ValueError):
+    """
+    Raised when parsed values would change when stored in an integer output type
+    (non-integer or out of range values), the loaders then fall back to float64
+    """
+    pass
+
+def check_representable(block, dtype):
+    """
+    Raises UnrepresentableValues if the float values of block are not stored unchanged
+    in an array of dtype, floating point types take any value
+
+    Args:
+        block: Array of parsed values
+        dtype: Type of the output
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in "iu" or block.size == 0:
+        return
+    info = np.iinfo(dtype)
+    #NaN is unequal to its floor, infinities fail the range check
+    if not np.all(block == np.floor(block)):
+        raise UnrepresentableValues("Non-integer values can not be stored as " + dtype.name)
+    if np.min(block) < info.min or np.max(block) > info.max:
+        raise UnrepresentableValues("Values out of the range of " + dtype.name)
+
+def line_ranges(fname, start, n_ranges):
+    """
+    Splits the file from byte start to its end into up to n_ranges byte ranges of
+    roughly equal size, every range except the last ends just after a newline
+
+    Returns:
+        ranges: List of (lo, hi) byte offsets
+    """
+    size = os.path.getsize(fname)
+    bounds = [start]
+    with open(fname, 'rb') as f:
+        for i in range(1, n_ranges):
+            pos = start + (size - start)*i//n_ranges
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()
+            if bounds[-1] < f.tell() < size:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+def count_lines(fname, lo=0, hi=None, block=4194304):
+    """
+    Returns n. of lines in bytes lo:hi of the file (hi=None = end of the file),
+    a last line without newline included
+    """
+    hi = os.path.getsize(fname) if hi is None else hi
+    n = 0
+    last = b"\n"
+    with open(fname, 'rb') as f:
+        f.seek(lo)
+        for pos in range(lo, hi, block):
+            data = f.read(min(block, hi - pos))
+            n += data.count(b"\n")
+            last = data[-1:] or last
+    return n + (last != b"\n")
+
+def _chunks(f, hi, chunk_size):
+    """
+    Yields text of whole lines from the current position up to byte hi in chunks of roughly
+    chunk_size bytes, decoded and newline-translated the same way as a file opened in text mode
+    """
+    while f.tell() < hi:
+        data = f.read(min(chunk_size, hi - f.tell()))
+        if not data.endswith(b"\n") and f.tell() < hi:
+            data += f.readline()
+        yield io.TextIOWrapper(io.BytesIO(data)).read()
+
+def _parse_range(fname, lo, hi, first_row, n_rows, out_spec, parser, args, chunk_size):
+    """
+    Parses the lines in bytes lo:hi of the file into rows first_row:first_row+n_rows
+    of the memory-mapped output
+    """
+    out = np.memmap(out_spec[0], dtype=out_spec[3], mode='r+', offset=out_spec[1], shape=out_spec[2])
+    n = first_row
+    with open(fname, 'rb') as f:
+        f.seek(lo)
+        for chunk in _chunks(f, hi, chunk_size):
+            block = parser(chunk, *args)
+            if n + block.shape[0] > first_row + n_rows:
+                raise _IrregularLines()
+            check_representable(block, out.dtype)
+            out[n:n+block.shape[0],:block.shape[1]] = block
+            n += block.shape[0]
+    if n != first_row + n_rows:
+        raise _IrregularLines()
+    out.flush()
+
+def parse_lines(fname, start, parser, args, n_columns, dtype, workers=None, chunk_size=4194304, lead=0):
+    """
+    Parses the lines of a text file from byte start to its end on a process pool
+
+    Args:
+        fname: Path to the file
+        start: Byte offset of the first parsed line
+        parser: Picklable function parser(chunk, *args) returning a 2D array with a row
+                per line of a string of whole lines
+        args: Additional arguments of parser
+        n_columns: N. of columns of the output, columns past the parser output stay zero
+        dtype: Type of the output
+        workers: N. of worker processes, None = n. of CPUs
+        chunk_size: Approximate n. of bytes parsed at once by a worker
+        lead: N. of zero rows preceding the parsed lines, e.g. for a first line parsed by the caller
+
+    Returns:
+        data: Array of shape (lead + n. of lines, n_columns), None if the lines could not be
+              split consistently into byte ranges (the serial loader has to be used)
+    """
+    workers = os.cpu_count() if workers is None else workers
+    ranges = line_ranges(fname, start, 2*workers)
+    instrumentation.count("chunks", len(ranges))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        counts = list(executor.map(count_lines, [fname]*len(ranges), [lo for lo, hi in ranges],
+                                   [hi for lo, hi in ranges]))
+        first_rows = lead + np.r_[0, np.cumsum(counts, dtype=np.int64)]
+        shape = (int(first_rows[-1]), n_columns)
+        if len(ranges) == 0 or shape[0] == lead:
+            return np.zeros(shape, dtype=dtype)
+        #RAM backed directory if available, the shared output is never meant to hit the disk
+        tmpdir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+            shared = np.memmap(os.path.join(tmp, "out"), dtype=dtype, mode='w+', shape=shape)
+            out_spec = (shared.filename, shared.offset, shape, shared.dtype.str)
+            futures = [executor.submit(_parse_range, fname, lo, hi, int(first_rows[i]), counts[i],
+                                       out_spec, parser, args, chunk_size)
+                       for i, (lo, hi) in enumerate(ranges)]
+            #Results in file order, so the first failing range decides the error
+            for fut in futures:
+                try:
+                    fut.result()
+                except _IrregularLines:
+                    for f in futures:
+                        f.cancel()
+                    return None
+            data = np.array(shared)
+            del shared
+    return data